@@ -0,0 +1,973 @@
+#!/usr/bin/env python3
+"""
+DeepSeek-OCR micro-benchmarks
+
+Each sub-command times one stage of the pipeline on synthetic data, so it can
+be run without model weights or a GPU. Inside the Docker image run it from
+/app so that the DeepSeek-OCR-vllm modules are importable.
+
+Usage:
+    python benchmark.py serialization --pages 500
+    python benchmark.py config-import
+    python benchmark.py tokens
+    python benchmark.py decode --width 8000 --height 6000
+    python benchmark.py pixels --pages 16
+    python benchmark.py encoder --mode default --crops 6
+    python benchmark.py weights --mb 1024
+    python benchmark.py ngram --seqs 100
+    python benchmark.py loops --recorded outputs/
+    python benchmark.py speculate --recorded outputs/ --k 5
+    python benchmark.py cascade --recorded outputs/small.jsonl
+    python benchmark.py load --peak 4 --capacity 2
+    python benchmark.py grounding --blocks 10 100 500
+    python benchmark.py det --refs 10 100 1000
+    python benchmark.py int8 --checkpoint /app/models/deepseek-ai/DeepSeek-OCR
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, '/app/DeepSeek-OCR-vllm')
+
+
+class Colors:
+    RED = '\033[31m'
+    GREEN = '\033[32m'
+    YELLOW = '\033[33m'
+    BLUE = '\033[34m'
+    RESET = '\033[0m'
+
+
+def timeit(fn, repeat=5):
+    """Return the best wall time of ``repeat`` calls to fn, in milliseconds"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def synthetic_page(page_num, chars=4000):
+    """A markdown page with grounding tags, tables and formulas"""
+    block = (
+        '<|ref|>title<|/ref|><|det|>[[102, 58, 897, 96]]<|/det|>\n# Section {n}\n\n'
+        '<|ref|>text<|/ref|><|det|>[[100, 120, 900, 260]]<|/det|>\n'
+        'Lorem ipsum dolor sit amet, consectetur adipiscing elit \\(x \\coloneqq y\\).\n\n'
+        '<|ref|>table<|/ref|><|det|>[[100, 300, 900, 600]]<|/det|>\n'
+        '<table><tr><td>Item</td><td>Qty</td></tr><tr><td>A</td><td>{n}</td></tr></table>\n\n\n\n'
+    )
+    text = ''
+    while len(text) < chars:
+        text += block.format(n=page_num)
+    return text[:chars]
+
+
+def bench_serialization(args):
+    from response_encoding import (available_encodings, available_formats,
+                                   compress, serialize)
+
+    payload = {
+        "success": True,
+        "results": [
+            {"success": True, "result": synthetic_page(i, args.chars), "error": None, "page_count": i + 1}
+            for i in range(args.pages)
+        ],
+        "total_pages": args.pages,
+        "filename": "synthetic.pdf",
+    }
+
+    print(f"{Colors.BLUE}Serializing {args.pages} pages x {args.chars} chars{Colors.RESET}")
+    print(f"{'format':<10}{'encoding':<10}{'size (KB)':>12}{'serialize (ms)':>16}{'compress (ms)':>16}")
+    for fmt in available_formats():
+        serialize_ms = timeit(lambda: serialize(payload, fmt), args.repeat)
+        body, _ = serialize(payload, fmt)
+        print(f"{fmt:<10}{'identity':<10}{len(body) / 1024:>12.1f}{serialize_ms:>16.2f}{0:>16.2f}")
+        for encoding in available_encodings():
+            compress_ms = timeit(lambda: compress(body, encoding), args.repeat)
+            size = len(compress(body, encoding))
+            print(f"{fmt:<10}{encoding:<10}{size / 1024:>12.1f}{serialize_ms:>16.2f}{compress_ms:>16.2f}")
+
+
+def bench_config_import(args):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in ['/app/DeepSeek-OCR-vllm', env.get('PYTHONPATH', '')] if p)
+    cases = [
+        ('import config', 'import config'),
+        ('import config + get_tokenizer() (old eager import)', 'import config; config.get_tokenizer()'),
+    ]
+    for label, code in cases:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], env=env, check=True)
+            timings.append((time.perf_counter() - start) * 1000)
+        print(f"{label:<55}{min(timings):>10.1f} ms (best of {args.repeat}, includes interpreter start)")
+
+
+def reference_token_assembly(text_segments, image_token_counts, image_token_id, bos_id, eos_id, pad_id, ignore_id):
+    """The per-token list assembly tokenize_with_images used before token templates"""
+    import torch
+
+    tokenized_str, images_seq_mask = [], []
+    for idx, segment in enumerate(text_segments):
+        tokenized_str += list(segment)
+        images_seq_mask += [False] * len(segment)
+        if idx < len(image_token_counts):
+            tokenized_image = [image_token_id] * image_token_counts[idx]
+            tokenized_str += tokenized_image
+            images_seq_mask += [True] * len(tokenized_image)
+    tokenized_str = [bos_id] + tokenized_str + [eos_id]
+    images_seq_mask = [False] + images_seq_mask + [False]
+
+    masked_tokenized_str = []
+    for token_index in tokenized_str:
+        if token_index != image_token_id:
+            masked_tokenized_str.append(token_index)
+        else:
+            masked_tokenized_str.append(ignore_id)
+
+    input_ids = torch.LongTensor(tokenized_str)
+    target_ids = torch.LongTensor(masked_tokenized_str)
+    images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
+    target_ids[(input_ids < 0) | (input_ids == image_token_id)] = ignore_id
+    input_ids[input_ids < 0] = pad_id
+    return input_ids[:-1], target_ids[:-1], images_seq_mask[:-1]
+
+
+def bench_tokens(args):
+    import torch
+    from process.image_process import build_token_template
+
+    # ids of the DeepSeek-OCR tokenizer; the prompt segments are arbitrary token ids
+    image_token_id, bos_id, eos_id, pad_id, ignore_id = 128815, 0, 1, 2, -100
+    text_segments = ((), (201, 128820, 37, 5013, 279, 2197, 311, 51594, 13))
+    # global view (1024) plus Gundam local views (640) for 1x1, 2x3 and 3x3 tile grids
+    layouts = {'1x1': 16 * 17 + 1, '2x3': 16 * 17 + 1 + (10 * 2 + 1) * (10 * 3), '3x3': 16 * 17 + 1 + (10 * 3 + 1) * (10 * 3)}
+
+    print(f"{'layout':<8}{'tokens':>8}{'python lists (us)':>20}{'template build (us)':>22}{'template hit (us)':>20}")
+    for name, count in layouts.items():
+        key = (text_segments, (count,), image_token_id, bos_id, eos_id, pad_id, ignore_id)
+        reference = reference_token_assembly(*key)
+        template = build_token_template(*key)
+        assert all(torch.equal(a, b) for a, b in zip(reference, template)), f"template mismatch for {name}"
+
+        loops = 200
+        list_us = timeit(lambda: [reference_token_assembly(*key) for _ in range(loops)], args.repeat) * 1000 / loops
+        build_us = timeit(lambda: [build_token_template.__wrapped__(*key) for _ in range(loops)], args.repeat) * 1000 / loops
+        hit_us = timeit(lambda: [[t.clone() for t in build_token_template(*key)] for _ in range(loops)], args.repeat) * 1000 / loops
+        print(f"{name:<8}{len(reference[0]):>8}{list_us:>20.1f}{build_us:>22.1f}{hit_us:>20.1f}")
+
+
+def reference_no_repeat_ngram(input_ids, scores, ngram_size, window_size, whitelist_token_ids):
+    """The per-sequence NoRepeatNGramLogitsProcessor.__call__ used before the batched processor"""
+    if len(input_ids) < ngram_size:
+        return scores
+
+    current_prefix = tuple(input_ids[-(ngram_size - 1):])
+    search_start = max(0, len(input_ids) - window_size)
+    search_end = len(input_ids) - ngram_size + 1
+
+    banned_tokens = set()
+    for i in range(search_start, search_end):
+        ngram = tuple(input_ids[i:i + ngram_size])
+        if ngram[:-1] == current_prefix:
+            banned_tokens.add(ngram[-1])
+
+    banned_tokens = banned_tokens - whitelist_token_ids
+    if banned_tokens:
+        scores = scores.clone()
+        for token in banned_tokens:
+            scores[token] = -float("inf")
+    return scores
+
+
+def bench_ngram(args):
+    import random
+    from types import SimpleNamespace
+    import torch
+    from process.ngram_norepeat import NoRepeatNGramLogitsProcessor, batched_logits_processors
+
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    ngram_size, window_size, whitelist = 20, 50, {128821, 128822}
+    vocab, steps = 129280, 64
+    random.seed(0)
+    # table-like output: a short row pattern repeated with variations, so repeated n-grams actually occur
+    pattern = [random.randrange(1000) for _ in range(22)] + [128821, 128822]
+    outputs = [[pattern[i % len(pattern)] if random.random() < 0.995 else random.randrange(vocab)
+                for i in range(args.tokens + steps)] for _ in range(args.seqs)]
+    logits = torch.randn(args.seqs, vocab, device=device)
+
+    def sync():
+        if device == 'cuda':
+            torch.cuda.synchronize()
+
+    def per_row(out, prefixes):
+        for row, ids in enumerate(prefixes):
+            out[row] = reference_no_repeat_ngram(ids, out[row], ngram_size, window_size, whitelist)
+        sync()
+        return out
+
+    processor = NoRepeatNGramLogitsProcessor(ngram_size=ngram_size, window_size=window_size, whitelist_token_ids=whitelist)
+    params = SimpleNamespace(logits_processors=[processor])
+
+    def batched(out, prefixes):
+        seq_data = {seq_id: SimpleNamespace(output_token_ids=ids) for seq_id, ids in enumerate(prefixes)}
+        metadata = SimpleNamespace(seq_groups=[
+            SimpleNamespace(sampling_params=params, seq_ids=[seq_id], sample_indices=[seq_id], seq_data=seq_data)
+            for seq_id in range(args.seqs)])
+        with batched_logits_processors(metadata) as apply:
+            out = apply(out)
+        sync()
+        return out
+
+    # decode steps: each step sees one more token per sequence, so the batched state only appends
+    banned = 0
+    per_row_ms, batched_ms = [], []
+    for step in range(steps):
+        prefixes = [ids[:args.tokens + step] for ids in outputs]
+        expected, actual = logits.clone(), logits.clone()
+        sync()
+        start = time.perf_counter()
+        expected = per_row(expected, prefixes)
+        per_row_ms.append((time.perf_counter() - start) * 1000)
+        start = time.perf_counter()
+        actual = batched(actual, prefixes)
+        batched_ms.append((time.perf_counter() - start) * 1000)
+        banned += int(torch.isinf(expected).sum())
+
+    print(f"{Colors.BLUE}{args.seqs} sequences, ngram_size={ngram_size}, window_size={window_size}, on {device}{Colors.RESET}")
+    print(f"{banned} banned tokens over {steps} steps (bit-identity is checked in tests/test_ngram_norepeat.py)")
+    print(f"{'processor':<28}{'median per step (ms)':>22}")
+    for label, timings in (('per-sequence (old)', per_row_ms), ('batched', batched_ms)):
+        print(f"{label:<28}{sorted(timings)[len(timings) // 2]:>22.2f}")
+
+
+def load_recorded_outputs(path):
+    """Token ids of recorded model outputs: .jsonl files with a token_ids list per line, or text files (tokenized)"""
+    import glob
+    import json
+
+    files = sorted(glob.glob(os.path.join(path, '*'))) if os.path.isdir(path) else [path]
+    outputs = []
+    for file in files:
+        if file.endswith('.jsonl'):
+            with open(file, encoding='utf-8') as f:
+                for line_num, line in enumerate(f):
+                    if line.strip():
+                        outputs.append((f"{os.path.basename(file)}:{line_num + 1}", json.loads(line)['token_ids']))
+        else:
+            from config import get_tokenizer
+            with open(file, encoding='utf-8') as f:
+                outputs.append((os.path.basename(file), get_tokenizer().encode(f.read(), add_special_tokens=False)))
+    return outputs
+
+
+def synthetic_outputs():
+    """Token streams shaped like OCR output: clean pages, a table that loops on one row, a near-repeat that must not trip"""
+    import random
+
+    random.seed(0)
+    text = [random.randrange(1000, 100000) for _ in range(600)]
+    row = [128821] + [random.randrange(1000, 100000) for _ in range(40)] + [128822]
+    numbered = [tok for k in range(200) for tok in (128821, 500 + k, 501, 502, 128822)]
+    return [
+        ('clean page', text + [random.randrange(1000, 100000) for _ in range(1400)]),
+        ('table loop', text + row * 180),
+        ('paragraph loop', text + text[100:400] * 25),
+        ('numbered rows', text + numbered),
+    ]
+
+
+def bench_loops(args):
+    from types import SimpleNamespace
+    import torch
+    from config import MAX_TOKENS
+    from loop_guard import LoopAbortLogitsProcessor, find_loop
+    from process.ngram_norepeat import batched_logits_processors
+
+    outputs = load_recorded_outputs(args.recorded) if args.recorded else synthetic_outputs()
+    print(f"{Colors.BLUE}Loop detection on {len(outputs)} {'recorded' if args.recorded else 'synthetic'} outputs{Colors.RESET}")
+    print(f"{'output':<28}{'tokens':>8}{'loop':>8}{'period':>8}{'abort at':>10}{'kept':>8}{'steps saved':>13}")
+    loops = {}
+    for name, ids in outputs:
+        loop = find_loop(ids)
+        loops[name] = loop
+        if loop is None:
+            print(f"{name:<28}{len(ids):>8}{'-':>8}")
+        else:
+            # a looping page would otherwise have run on to max_tokens
+            saved = max(len(ids), MAX_TOKENS) - (loop.end + 1)
+            print(f"{name:<28}{len(ids):>8}{'yes':>8}{loop.period:>8}{loop.end + 1:>10}{loop.salvaged:>8}{saved:>13}")
+
+    # replay all outputs as one decode batch through the online processor; it must abort exactly where find_loop says
+    processor = LoopAbortLogitsProcessor(eos_token_id=1)
+    params = SimpleNamespace(logits_processors=[processor])
+    streams = [(name, ids) for name, ids in outputs] * max(1, args.seqs // len(outputs))
+    lengths = [0] * len(streams)
+    aborted = {}
+    step_ms = []
+    vocab = 129280
+    while True:
+        live = [idx for idx, (_, ids) in enumerate(streams) if idx not in aborted and lengths[idx] <= len(ids)]
+        if not live:
+            break
+        metadata = SimpleNamespace(seq_groups=[
+            SimpleNamespace(sampling_params=params, seq_ids=[idx], sample_indices=[row],
+                            seq_data={idx: SimpleNamespace(output_token_ids=streams[idx][1][:lengths[idx]])})
+            for row, idx in enumerate(live)])
+        logits = torch.zeros(len(live), vocab)
+        start = time.perf_counter()
+        with batched_logits_processors(metadata) as apply:
+            logits = apply(logits)
+        step_ms.append((time.perf_counter() - start) * 1000)
+        forced = torch.isinf(logits[:, 0]).tolist()
+        for row, idx in enumerate(live):
+            if forced[row]:
+                aborted[idx] = lengths[idx]
+            lengths[idx] += 1
+    for idx, (name, _) in enumerate(streams):
+        loop = loops[name]
+        assert aborted.get(idx) == (None if loop is None else loop.end + 1), f"online detector disagrees on {name}"
+    print(f"online detector agrees on all {len(streams)} replayed sequences; "
+          f"median {sorted(step_ms)[len(step_ms) // 2]:.2f} ms per step for up to {len(streams)} sequences")
+
+
+DECODE_SNIPPET = """
+import io, resource, sys, time
+from PIL import Image
+from process.image_process import decode_image
+data = open(sys.argv[1], 'rb').read()
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if sys.argv[2] == 'full':
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+else:
+    image = decode_image(data)
+elapsed = (time.perf_counter() - start) * 1000
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+print(elapsed, peak, image.size[0], image.size[1])
+"""
+
+
+def synthetic_document(num_pages):
+    """Token streams shaped like grounded OCR pages of one document: running header, tagged paragraphs, a table"""
+    import random
+
+    random.seed(1)
+    ref, end_ref, det, end_det, tr, end_tr, td, end_td = range(10, 18)
+    digits = list(range(20, 30))
+    header = [random.randrange(1000, 100000) for _ in range(12)]
+    pages = []
+    for _ in range(num_pages):
+        page = [ref, 40, end_ref, det] + [random.choice(digits) for _ in range(12)] + [end_det] + header
+        for _ in range(random.randint(3, 6)):
+            page += [ref, 41, end_ref, det] + [random.choice(digits) for _ in range(12)] + [end_det]
+            page += [random.randrange(1000, 100000) for _ in range(random.randint(40, 160))]
+        page += [ref, 42, end_ref, det] + [random.choice(digits) for _ in range(12)] + [end_det]
+        for _ in range(random.randint(5, 20)):
+            page += [tr] + [tok for _ in range(4) for tok in (td, random.randrange(1000, 100000), end_td)] + [end_tr]
+        pages.append(page)
+    return pages
+
+
+def bench_speculate(args):
+    from prompt_lookup import DocumentContext, PromptLookupProposer, simulate
+
+    pages = [ids for _, ids in load_recorded_outputs(args.recorded)] if args.recorded else synthetic_document(args.pages)
+    print(f"{Colors.BLUE}Prompt-lookup speculation, {args.k} draft tokens, n-grams {args.min_n}-{args.max_n}, "
+          f"{len(pages)} {'recorded' if args.recorded else 'synthetic'} pages as one document{Colors.RESET}")
+    print(f"{'page':>5}{'tokens':>8}{'own: accepted':>15}{'tokens/pass':>13}{'+ earlier pages':>17}{'tokens/pass':>13}")
+    totals = {False: [0, 0], True: [0, 0]}
+    for page_num, ids in enumerate(pages):
+        row = []
+        for use_earlier in (False, True):
+            earlier = pages[max(0, page_num - args.lookback):page_num][::-1] if use_earlier else ()
+            result = simulate(ids, args.k, earlier, args.min_n, args.max_n)
+            # greedy verification can never need more passes than tokens, nor accept more than it proposed
+            assert result.passes <= result.tokens and result.accepted <= result.proposed
+            assert result.passes + result.accepted == result.tokens
+            totals[use_earlier][0] += result.tokens
+            totals[use_earlier][1] += result.passes
+            row.append(f"{result.acceptance_rate:>14.0%}{result.tokens_per_pass:>13.2f}")
+        print(f"{page_num + 1:>5}{len(pages[page_num]):>8} {row[0]}   {row[1]}")
+    for use_earlier, (tokens, passes) in totals.items():
+        label = 'own output + earlier pages' if use_earlier else 'own output only'
+        print(f"{label}: {tokens / passes:.2f} tokens per forward pass ({passes} passes instead of {tokens})")
+
+    # proposer cost per decode step for the whole document decoded as one batch, one token per step
+    proposer = PromptLookupProposer(args.min_n, args.max_n)
+    document = DocumentContext(args.lookback)
+    step_ms = []
+    for length in range(1, max(len(ids) for ids in pages) + 1):
+        live = [page for page, ids in enumerate(pages) if length <= len(ids)]
+        start = time.perf_counter()
+        for page in live:
+            proposer.propose(page, pages[page][:length], args.k, str(page), document, page)
+        proposer.retire(set(live))
+        step_ms.append((time.perf_counter() - start) * 1000)
+    print(f"proposer: median {sorted(step_ms)[len(step_ms) // 2]:.2f} ms per step for up to {len(pages)} sequences")
+
+
+def synthetic_cascade_pages():
+    """First-pass outputs of a cheap mode: (name, token_ids, finished with EOS, cumulative logprob, ink, text_chars)"""
+    import random
+
+    random.seed(2)
+    pages = []
+    for k in range(16):
+        ids = [random.randrange(1000, 100000) for _ in range(random.randint(1200, 2400))]
+        pages.append((f'clean {k + 1}', ids, True, -0.08 * len(ids), len(ids) / 1.5 / 50000, 0))
+    small_print = [random.randrange(1000, 100000) for _ in range(1800)]
+    stutter = [random.randrange(1000, 100000) for _ in range(300)]
+    pages += [
+        ('small print, unsure', small_print, True, -0.55 * len(small_print), 0.05, 0),
+        ('stutter', stutter + stutter[:60] * 20, True, -0.1 * 1500, 0.03, 0),
+        ('missed a column', small_print[:500], True, -0.1 * 500, 0.06, 4500),
+        ('no EOS', small_print * 4, False, -0.2 * 7200, 0.06, 0),
+        ('blank', [], True, 0.0, 0.0005, 0),
+    ]
+    return pages
+
+
+def vision_tokens(mode, crops):
+    """Vision tokens of a page at a resolution mode: 16x16 patches pooled 4x4, plus `crops` tiles with crop_mode"""
+    from config import RESOLUTION_MODES
+
+    base_size, image_size, crop_mode = RESOLUTION_MODES[mode]
+    return (base_size // 64) ** 2 + (crops * (image_size // 64) ** 2 if crop_mode else 0)
+
+
+def bench_cascade(args):
+    import json
+    from config import PROMPT
+    from quality_cascade import escalation_reasons, page_signals
+
+    if args.recorded:
+        # one page per line: token_ids, plus optional finish_reason, cumulative_logprob, ink and text_chars
+        pages = []
+        with open(args.recorded, encoding='utf-8') as f:
+            for line_num, line in enumerate(f):
+                if line.strip():
+                    page = json.loads(line)
+                    pages.append((f"line {line_num + 1}", page['token_ids'], page.get('finish_reason', 'stop') == 'stop',
+                                  page.get('cumulative_logprob'), page.get('ink'), page.get('text_chars', 0)))
+    else:
+        pages = synthetic_cascade_pages()
+    print(f"{Colors.BLUE}Cascade signals for {len(pages)} {'recorded' if args.recorded else 'synthetic'} "
+          f"{args.cheap} pages, prompt {PROMPT!r}{Colors.RESET}")
+    print(f"{'page':<22}{'tokens':>8}{'eos':>5}{'logprob':>9}{'repeat':>8}{'text ratio':>12}  escalate")
+    escalated = 0
+    signal_ms = []
+    for name, ids, eos, cumulative_logprob, ink, text_chars in pages:
+        start = time.perf_counter()
+        signals = page_signals(ids, eos, cumulative_logprob, ink, text_chars, PROMPT)
+        reasons = escalation_reasons(signals)
+        signal_ms.append((time.perf_counter() - start) * 1000)
+        escalated += bool(reasons)
+        logprob = '-' if signals.mean_logprob is None else f'{signals.mean_logprob:.2f}'
+        ratio = '-' if signals.text_ratio is None else f'{signals.text_ratio:.2f}'
+        print(f"{name:<22}{signals.tokens:>8}{'yes' if eos else 'no':>5}{logprob:>9}{signals.repetition:>8.0%}{ratio:>12}  "
+              f"{', '.join(reasons) or '-'}")
+
+    cheap, expensive = vision_tokens(args.cheap, args.crops), vision_tokens(args.expensive, args.crops)
+    cascade = len(pages) * cheap + escalated * expensive
+    print(f"{escalated} of {len(pages)} pages escalated to {args.expensive}; signals: "
+          f"median {sorted(signal_ms)[len(signal_ms) // 2]:.2f} ms per page")
+    print(f"vision tokens: {cascade} with the cascade ({args.cheap} {cheap}/page + {args.expensive} {expensive}/escalated page) "
+          f"vs {len(pages) * expensive} at {args.expensive} only")
+
+
+def bench_load(args):
+    from collections import deque
+    import numpy as np
+    from load_control import load_controller
+
+    controller = load_controller()
+    levels = controller.levels
+    full = vision_tokens(levels[0].name, levels[0].crops or 0)
+    # GPU seconds per page at a level: a fixed decode share plus a share scaling with the vision tokens
+    costs = [(1 - args.vision_share + args.vision_share * vision_tokens(level.name, level.crops or 0) / full) / args.capacity
+             for level in levels]
+    print(f"{Colors.BLUE}Load control over {args.seconds}s: bulk pages at {args.base} -> {args.peak} -> {args.base} pages/s, "
+          f"{args.capacity} pages/s at full quality{Colors.RESET}")
+    print(f"{'t (s)':>6}{'arrivals/s':>12}{'queued':>8}{'p95 (s)':>9}  level")
+
+    tick = 0.1
+    waiting = deque()  # arrival time of pages not started yet, served one at a time in order
+    running = deque()  # (finish, arrival) of started pages
+    busy_until = due = 0.0
+    served = [0] * len(levels)
+    latencies = []
+    for step in range(int(args.seconds / tick)):
+        now = step * tick
+        rate = args.peak if 0.25 <= now / args.seconds < 0.6 else args.base
+        due += rate * tick
+        while due >= 1:
+            due -= 1
+            controller.admit(1, now)
+            waiting.append(now)
+        while running and running[0][0] <= now:
+            finish, arrival = running.popleft()
+            controller.finish(1, arrival, finish)
+            latencies.append(finish - arrival)
+        while waiting and busy_until <= now + tick:
+            # like the server, a page gets the level in force when it is processed
+            arrival, level = waiting.popleft(), controller.level_for(lane='bulk')
+            busy_until = max(busy_until, now) + costs[level]
+            running.append((busy_until, arrival))
+            served[level] += 1
+        if step % int(args.every / tick) == 0:
+            latency = controller.latency()
+            print(f"{now:>6.0f}{rate:>12.1f}{controller.queued:>8}{latency or 0:>9.1f}  "
+                  f"{controller.level} ({levels[controller.level].describe()})")
+
+    info = controller.info()
+    print(f"{info['level_changes']} level changes; pages started per level: "
+          + ', '.join(f"{idx}: {count}" for idx, count in enumerate(served)))
+    print(f"request latency p50 {np.percentile(latencies, 50):.1f}s, p95 {np.percentile(latencies, 95):.1f}s, "
+          f"max {max(latencies):.1f}s; {controller.queued} pages unanswered at the end")
+
+
+def reference_grounding(content, jdx=0):
+    """The page post-processing of run_dpsk_ocr_pdf.py before grounding.postprocess: one str.replace per tag"""
+    import re
+
+    matches = re.findall(r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)', content, re.DOTALL)
+    matches_images = [match[0] for match in matches if '<|ref|>image<|/ref|>' in match[0]]
+    mathes_other = [match[0] for match in matches if '<|ref|>image<|/ref|>' not in match[0]]
+    for idx, a_match_image in enumerate(matches_images):
+        content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
+    for idx, a_match_other in enumerate(mathes_other):
+        content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+    return content
+
+
+def grounding_page(blocks):
+    """A page of synthetic_page blocks, each after an image ref with its own box (the old loop replaced equal tags together)"""
+    parts = []
+    for idx in range(blocks):
+        block = synthetic_page(idx, 2000)
+        parts.append(f'<|ref|>image<|/ref|><|det|>[[100, {idx % 1000}, 900, {idx // 1000}]]<|/det|>\n'
+                     + block[:block.index('<|ref|>title', 1)])
+    return ''.join(parts)
+
+
+def bench_grounding(args):
+    from grounding import postprocess
+
+    image_link = lambda idx, det: f'![](images/0_{idx}.jpg)\n'
+    print(f"{'refs':>8}{'chars':>10}{'str.replace loop (ms)':>24}{'one pass (ms)':>16}{'speedup':>10}")
+    for blocks in args.blocks:
+        page = grounding_page(blocks)
+        assert reference_grounding(page) == postprocess(page, image_link=image_link), f"output mismatch at {blocks} blocks"
+        old_ms = timeit(lambda: reference_grounding(page), args.repeat)
+        new_ms = timeit(lambda: postprocess(page, image_link=image_link), args.repeat)
+        print(f"{page.count('<|ref|>'):>8}{len(page):>10}{old_ms:>24.2f}{new_ms:>16.2f}{old_ms / new_ms:>9.1f}x")
+
+
+def reference_det_boxes(refs, image_width, image_height):
+    """Pixel boxes the draw loops got before parse_det: eval per ref and int(x / 999 * width) per coordinate"""
+    boxes = []
+    for ref in refs:
+        try:
+            cor_list = eval(ref[2])
+        except Exception:
+            boxes.append(None)
+            continue
+        boxes.append((ref[1], [[int(x1 / 999 * image_width), int(y1 / 999 * image_height),
+                                int(x2 / 999 * image_width), int(y2 / 999 * image_height)]
+                               for x1, y1, x2, y2 in cor_list]))
+    return boxes
+
+
+def bench_det(args):
+    import random
+    from grounding import find_refs, page_boxes, parse_det
+
+    rng = random.Random(0)
+    width, height = 1224, 1584  # a letter page at 144 dpi
+    print(f"{'refs':>8}{'boxes':>8}{'eval + loops (ms)':>20}{'page_boxes (ms)':>18}{'speedup':>10}")
+    for refs in args.refs:
+        dets = [[[rng.randint(0, 999) for _ in range(4)] for _ in range(rng.randint(1, args.boxes))] for _ in range(refs)]
+        page = ''.join(f"<|ref|>text<|/ref|><|det|>{det}<|/det|>\n" for det in dets)
+        matches = find_refs(page)
+        expected = reference_det_boxes(matches, width, height)
+        parsed = page_boxes(matches, width, height)
+        assert [(label, boxes.tolist()) for label, boxes in parsed] == expected, f"box mismatch at {refs} refs"
+        eval_ms = timeit(lambda: reference_det_boxes(matches, width, height), args.repeat)
+        parse_ms = timeit(lambda: page_boxes(matches, width, height), args.repeat)
+        boxes = sum(len(b) for _, b in parsed)
+        print(f"{refs:>8}{boxes:>8}{eval_ms:>20.2f}{parse_ms:>18.2f}{eval_ms / parse_ms:>9.1f}x")
+
+    # never passed to eval; parse_det must reject each of them without running or recursing into it
+    malformed = {
+        'code': "__import__('os').system('true')",
+        'deep nesting': '[' * 100000 + ']' * 100000,
+        'unclosed list': '[[1, 2, 3, 4], ' * 1000,
+        'three numbers': '[[1, 2, 3]]',
+        'trailing text': '[[1, 2, 3, 4]]' + ' ' * 10000 + 'x',
+        'expression': '[[1, 2, 3, 4]] * 10 ** 9',
+    }
+    print(f"{'malformed payload':<20}{'chars':>8}{'rejected in (us)':>18}")
+    for name, payload in malformed.items():
+        def reject():
+            try:
+                parse_det(payload)
+            except ValueError:
+                return
+            raise AssertionError(f"{name} payload accepted")
+        print(f"{name:<20}{len(payload):>8}{timeit(reject, args.repeat) * 1000:>18.1f}")
+
+
+def synthetic_photo(width, height):
+    """A JPEG-friendly page photo: a gradient background covered in text lines"""
+    from PIL import Image, ImageDraw
+
+    image = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    draw = ImageDraw.Draw(image)
+    for y in range(0, height, 40):
+        draw.text((50, y), 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 20, fill=(0, 0, 0))
+    return image
+
+
+def bench_decode(args):
+    import tempfile
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(p for p in ['/app/DeepSeek-OCR-vllm', env.get('PYTHONPATH', '')] if p)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'photo.jpg')
+        synthetic_photo(args.width, args.height).save(path, 'JPEG', quality=90)
+        print(f"{Colors.BLUE}Decoding a {args.width}x{args.height} JPEG ({os.path.getsize(path) / 1e6:.1f} MB){Colors.RESET}")
+        print(f"{'path':<14}{'decoded size':>16}{'decode (ms)':>14}{'peak RSS +MB':>16}")
+        for mode in ('full', 'decode_image'):
+            runs = []
+            for _ in range(args.repeat):
+                out = subprocess.run([sys.executable, '-c', DECODE_SNIPPET, path, mode], env=env,
+                                     check=True, capture_output=True, text=True).stdout.split()
+                runs.append((float(out[0]), int(out[1]) / 1024, f"{out[2]}x{out[3]}"))
+            best = min(runs)
+            print(f"{mode:<14}{best[2]:>16}{best[0]:>14.1f}{min(r[1] for r in runs):>16.1f}")
+
+
+def bench_pixels(args):
+    import torch
+    from process.image_process import ImageTransform
+
+    transform = ImageTransform()
+    # Gundam page: 1024 global view plus a 3x3 grid of 640 tiles
+    global_views = [torch.randint(0, 256, (1, 3, 1024, 1024), dtype=torch.uint8) for _ in range(args.pages)]
+    tiles = [torch.randint(0, 256, (9, 3, 640, 640), dtype=torch.uint8) for _ in range(args.pages)]
+
+    cases = {
+        'float32': lambda: (transform.batch(global_views), transform.batch(tiles)),
+        'uint8': lambda: (torch.cat(global_views), torch.cat(tiles)),
+    }
+    print(f"{Colors.BLUE}{args.pages} Gundam pages (3x3 tiles){Colors.RESET}")
+    print(f"{'transport':<12}{'MB per page':>14}{'host prep (ms)':>18}")
+    for name, fn in cases.items():
+        pixel_values, images_crop = fn()
+        mb = (pixel_values.nbytes + images_crop.nbytes) / args.pages / 2 ** 20
+        print(f"{name:<12}{mb:>14.1f}{timeit(fn, args.repeat):>18.1f}")
+
+    if torch.cuda.is_available():
+        def normalize_on_device():
+            x = torch.cat(tiles).cuda().to(torch.float32).div_(255).sub_(0.5).div_(0.5).to(torch.bfloat16)
+            torch.cuda.synchronize()
+            return x
+        print(f"{'uint8 -> GPU normalize':<30}{timeit(normalize_on_device, args.repeat):>10.1f} ms")
+
+
+def build_vision_encoder(device, dtype):
+    """SAM ViT-B, CLIP-L and the linear projector of DeepSeek-OCR with random weights"""
+    import torch
+    from addict import Dict
+    from deepencoder.build_linear import MlpProjector
+    from deepencoder.clip_sdpa import build_clip_l
+    from deepencoder.sam_vary_sdpa import build_sam_vit_b
+    from vision_encoder import VisionEncoder
+
+    sam_model = build_sam_vit_b().to(device=device, dtype=dtype).eval()
+    vision_model = build_clip_l().to(device=device, dtype=dtype).eval()
+    projector = MlpProjector(Dict(projector_type="linear", input_dim=2048, n_embed=1280)).to(device=device, dtype=dtype).eval()
+    return VisionEncoder(sam_model, vision_model, projector)
+
+
+def bench_encoder(args):
+    import torch
+    from config import BASE_SIZE, IMAGE_SIZE
+
+    device = args.device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    dtype = torch.bfloat16 if device == 'cuda' else torch.float32
+    shapes = {'global': (1, 3, BASE_SIZE, BASE_SIZE), 'crops': (args.crops, 3, IMAGE_SIZE, IMAGE_SIZE)}
+
+    def run(encoder, shape):
+        views = torch.zeros(shape, device=device, dtype=dtype)
+
+        def step():
+            with torch.no_grad():
+                encoder(views)
+            if device == 'cuda':
+                torch.cuda.synchronize()
+        return timeit(step, args.repeat)
+
+    encoder = build_vision_encoder(device, dtype)
+    print(f"{Colors.BLUE}Vision encoder on {device} ({dtype}){Colors.RESET}")
+    print(f"{'mode':<18}{'views':<20}{'latency (ms)':>14}")
+    for name, shape in shapes.items():
+        print(f"{'eager':<18}{name + ' ' + str(shape[0]):<20}{run(encoder, shape):>14.1f}")
+
+    encoder.compile(args.mode)
+    start = time.perf_counter()
+    compiled = encoder.warmup(encoder.warmup_shapes([(BASE_SIZE, BASE_SIZE), (IMAGE_SIZE, IMAGE_SIZE)]),
+                              device=device, dtype=dtype)
+    print(f"warmup: {time.perf_counter() - start:.1f}s, compiled: {compiled}")
+    for name, shape in shapes.items():
+        print(f"{args.mode if compiled else 'eager (fallback)':<18}{name + ' ' + str(shape[0]):<20}{run(encoder, shape):>14.1f}")
+
+
+def load_vision_weights(encoder, directory):
+    """Copy the SAM, CLIP and projector tensors of a DeepSeek-OCR checkpoint into the encoder"""
+    import glob
+    from safetensors import safe_open
+
+    prefixes = {'model.sam_model.': encoder.sam_model, 'model.vision_model.': encoder.vision_model,
+                'model.projector.': encoder.projector}
+    states = {module: module.state_dict() for module in prefixes.values()}
+    loaded = 0
+    for shard in sorted(glob.glob(os.path.join(directory, '*.safetensors'))):
+        with safe_open(shard, framework='pt') as f:
+            for name in f.keys():
+                for prefix, module in prefixes.items():
+                    key = name[len(prefix):]
+                    if name.startswith(prefix) and key in states[module]:
+                        states[module][key].copy_(f.get_tensor(name))
+                        loaded += 1
+    return loaded
+
+
+def bench_int8(args):
+    import copy
+    import numpy as np
+    import torch
+    import torch.nn.functional as F
+    from config import BASE_SIZE
+    from vision_encoder import Int8Linear
+
+    device = args.device or 'cpu'
+    dtype = torch.bfloat16
+    reference = build_vision_encoder(device, dtype)
+    if args.checkpoint:
+        print(f"loaded {load_vision_weights(reference, args.checkpoint)} tensors from {args.checkpoint}")
+    else:
+        print(f"{Colors.YELLOW}No --checkpoint given: random weights, similarities are only indicative{Colors.RESET}")
+    quantized = copy.copy(reference)
+    quantized.sam_model, quantized.vision_model, quantized.projector = (
+        copy.deepcopy(module) for module in (reference.sam_model, reference.vision_model, reference.projector))
+    quantized.quantize_int8()
+
+    def linear_bytes(encoder, kinds):
+        return sum(buffer.nbytes for module in (encoder.sam_model, encoder.vision_model, encoder.projector)
+                   for layer in module.modules() if isinstance(layer, kinds)
+                   for buffer in list(layer.parameters()) + list(layer.buffers()))
+
+    def capture(encoder, kinds):
+        outputs, hooks = {}, []
+        for prefix, module in (('sam', encoder.sam_model), ('clip', encoder.vision_model), ('projector', encoder.projector)):
+            for name, layer in module.named_modules():
+                if isinstance(layer, kinds):
+                    hooks.append(layer.register_forward_hook(
+                        lambda _, __, output, key=f"{prefix}.{name}".rstrip('.'): outputs.__setitem__(key, output.float().flatten())))
+        return outputs, hooks
+
+    page = np.array(synthetic_photo(BASE_SIZE, BASE_SIZE))
+    views = torch.from_numpy(page).permute(2, 0, 1)[None].to(device=device, dtype=torch.float32)
+    views = ((views / 255 - 0.5) / 0.5).to(dtype)
+
+    runs = {}
+    for label, encoder, kinds in (('bf16', reference, torch.nn.Linear), ('int8', quantized, Int8Linear)):
+        outputs, hooks = capture(encoder, kinds)
+        with torch.no_grad():
+            outputs['embeddings'] = encoder(views).float().flatten()
+        for hook in hooks:
+            hook.remove()
+        runs[label] = outputs
+
+    print(f"{Colors.BLUE}int8 vs bf16 vision encoder on {device}, {BASE_SIZE}x{BASE_SIZE} page{Colors.RESET}")
+    print(f"linear weights: {linear_bytes(reference, torch.nn.Linear) / 2 ** 20:.1f} MB bf16 -> "
+          f"{linear_bytes(quantized, Int8Linear) / 2 ** 20:.1f} MB int8")
+    print(f"{'layer':<48}{'cosine':>10}")
+    worst = ('', 1.0)
+    for key, output in runs['bf16'].items():
+        cosine = F.cosine_similarity(output, runs['int8'][key], dim=0).item()
+        if key != 'embeddings' and cosine < worst[1]:
+            worst = (key, cosine)
+        color = Colors.RED if cosine < args.threshold else ''
+        print(f"{color}{key:<48}{cosine:>10.5f}{Colors.RESET if color else ''}")
+    print(f"worst layer: {worst[0]} ({worst[1]:.5f})")
+
+
+WEIGHTS_SNIPPET = """
+import glob, os, resource, sys, time, torch
+sys.path.insert(0, '/app/DeepSeek-OCR-vllm')
+from deepseek_ocr import DeepseekOCRForCausalLM
+directory, fmt, mode = sys.argv[1], sys.argv[2], sys.argv[3]
+rename = DeepseekOCRForCausalLM._rename_weights
+shards = sorted(glob.glob(os.path.join(directory, '*.' + fmt)))
+
+def checkpoint():
+    # the shard iterators vLLM uses: safetensors tensors are read lazily from an mmap,
+    # .bin shards are torch.load'ed whole and released once iterated
+    for shard in shards:
+        if fmt == 'safetensors':
+            from safetensors import safe_open
+            with safe_open(shard, framework='pt') as f:
+                for name in f.keys():
+                    yield name, f.get_tensor(name)
+        else:
+            state = torch.load(shard, map_location='cpu', weights_only=True)
+            yield from state.items()
+            del state
+
+# destination parameters exist (and are resident) before loading, as in the model
+params = {}
+for name, tensor in rename(checkpoint()):
+    params[name] = torch.ones(tensor.shape, dtype=tensor.dtype)
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+weights = list(rename(checkpoint())) if mode == 'list' else rename(checkpoint())
+for name, tensor in weights:
+    params[name].copy_(tensor)
+del weights
+elapsed = (time.perf_counter() - start) * 1000
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline)
+"""
+
+
+def bench_weights(args):
+    import tempfile
+
+    import torch
+    from safetensors.torch import save_file
+
+    num_tensors = 64
+    numel = args.mb * 2 ** 20 // 4 // num_tensors
+    with tempfile.TemporaryDirectory() as tmp:
+        names = [f"model.layers.{i}.mlp.weight" for i in range(num_tensors - 4)]
+        names += [f"model.sam_model.blocks.{i}.weight" for i in range(4)]
+        per_shard = num_tensors // args.shards
+        for shard in range(args.shards):
+            tensors = {name: torch.randn(numel) for name in names[shard * per_shard:(shard + 1) * per_shard]}
+            save_file(tensors, os.path.join(tmp, f"model-{shard:05d}.safetensors"))
+            torch.save(tensors, os.path.join(tmp, f"pytorch_model-{shard:05d}.bin"))
+            del tensors
+
+        print(f"{Colors.BLUE}Loading a {args.mb} MB synthetic checkpoint ({num_tensors} tensors, {args.shards} shards){Colors.RESET}")
+        print(f"{'format':<14}{'renaming':<26}{'load (ms)':>12}{'peak RSS +MB':>16}")
+        for fmt in ('safetensors', 'bin'):
+            for mode, label in (('list', 'materialized list (old)'), ('stream', 'generator')):
+                runs = []
+                for _ in range(args.repeat):
+                    out = subprocess.run([sys.executable, '-c', WEIGHTS_SNIPPET, tmp, fmt, mode],
+                                         check=True, capture_output=True, text=True).stdout.split()
+                    runs.append((float(out[0]), int(out[1]) / 1024))
+                print(f"{fmt:<14}{label:<26}{min(r[0] for r in runs):>12.1f}{min(r[1] for r in runs):>16.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='DeepSeek-OCR micro-benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs (best is reported)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serialization = subparsers.add_parser('serialization', help='Response body encoding and compression')
+    serialization.add_argument('--pages', type=int, default=500, help='Number of pages in the response')
+    serialization.add_argument('--chars', type=int, default=4000, help='Characters of OCR text per page')
+    serialization.set_defaults(func=bench_serialization)
+
+    config_import = subparsers.add_parser('config-import', help='Cold import time of config with and without loading the tokenizer')
+    config_import.set_defaults(func=bench_config_import)
+
+    tokens = subparsers.add_parser('tokens', help='Per-page token assembly: python lists vs cached templates')
+    tokens.set_defaults(func=bench_tokens)
+
+    decode = subparsers.add_parser('decode', help='Full decode vs decode_image for a large photo')
+    decode.add_argument('--width', type=int, default=8000, help='Width of the synthetic photo')
+    decode.add_argument('--height', type=int, default=6000, help='Height of the synthetic photo')
+    decode.set_defaults(func=bench_decode)
+
+    pixels = subparsers.add_parser('pixels', help='Host memory and prep time of float32 vs uint8 pixel transport')
+    pixels.add_argument('--pages', type=int, default=16, help='Number of pages in the batch')
+    pixels.set_defaults(func=bench_pixels)
+
+    encoder = subparsers.add_parser('encoder', help='Vision encoder latency, eager vs torch.compile')
+    encoder.add_argument('--mode', default='default', help='torch.compile mode')
+    encoder.add_argument('--crops', type=int, default=6, help='Local crops per batch')
+    encoder.add_argument('--device', default=None, help='cuda or cpu (default: cuda when available)')
+    encoder.set_defaults(func=bench_encoder)
+
+    weights = subparsers.add_parser('weights', help='Peak RSS of loading a checkpoint through a renamed list vs a generator')
+    weights.add_argument('--mb', type=int, default=1024, help='Size of the synthetic checkpoint in MB')
+    weights.add_argument('--shards', type=int, default=4, help='Number of checkpoint files')
+    weights.set_defaults(func=bench_weights)
+
+    ngram = subparsers.add_parser('ngram', help='No-repeat n-gram bans per decode step: per-sequence vs batched')
+    ngram.add_argument('--seqs', type=int, default=100, help='Sequences in the batch (MAX_CONCURRENCY)')
+    ngram.add_argument('--tokens', type=int, default=500, help='Output tokens already generated per sequence')
+    ngram.add_argument('--device', default=None, help='cuda or cpu (default: cuda when available)')
+    ngram.set_defaults(func=bench_ngram)
+
+    loops = subparsers.add_parser('loops', help='Repetition loop detection on recorded or synthetic outputs, offline and online')
+    loops.add_argument('--recorded', default=None, help='.jsonl file(s) with token_ids per line, or text outputs (.md/.mmd); a file or directory')
+    loops.add_argument('--seqs', type=int, default=100, help='Sequences in the replayed decode batch')
+    loops.set_defaults(func=bench_loops)
+
+    speculate = subparsers.add_parser('speculate', help='Prompt-lookup speculative decoding replayed on recorded or synthetic pages')
+    speculate.add_argument('--recorded', default=None, help='.jsonl file(s) with token_ids per line, or text outputs; read in name order as the pages of one document')
+    speculate.add_argument('--pages', type=int, default=20, help='Synthetic pages')
+    speculate.add_argument('--k', type=int, default=5, help='Draft tokens per forward pass')
+    speculate.add_argument('--min-n', type=int, default=2, help='Shortest n-gram looked up')
+    speculate.add_argument('--max-n', type=int, default=4, help='Longest n-gram looked up')
+    speculate.add_argument('--lookback', type=int, default=4, help='Earlier pages searched for drafts')
+    speculate.set_defaults(func=bench_speculate)
+
+    cascade = subparsers.add_parser('cascade', help='Quality cascade signals and escalations on recorded or synthetic first-pass outputs')
+    cascade.add_argument('--recorded', default=None, help='.jsonl file with token_ids and optional finish_reason, cumulative_logprob, ink, text_chars per line')
+    cascade.add_argument('--cheap', default='small', help='RESOLUTION_MODES name of the first pass')
+    cascade.add_argument('--expensive', default='gundam', help='RESOLUTION_MODES name escalated pages re-run at')
+    cascade.add_argument('--crops', type=int, default=6, help='Local tiles per page in crop modes')
+    cascade.set_defaults(func=bench_cascade)
+
+    load = subparsers.add_parser('load', help='Load-adaptive quality levels over a simulated traffic spike of bulk pages')
+    load.add_argument('--seconds', type=int, default=1200, help='Simulated seconds')
+    load.add_argument('--base', type=float, default=1.0, help='Bulk pages per second outside the spike')
+    load.add_argument('--peak', type=float, default=4.0, help='Bulk pages per second during the spike')
+    load.add_argument('--capacity', type=float, default=2.0, help='Pages per second the server sustains at full quality')
+    load.add_argument('--vision-share', type=float, default=0.6, help='Share of a full-quality page\'s cost that scales with its vision tokens')
+    load.add_argument('--every', type=int, default=30, help='Print a line every this many seconds')
+    load.set_defaults(func=bench_load)
+
+    grounding = subparsers.add_parser('grounding', help='Grounded output to markdown: str.replace per tag vs one regex pass')
+    grounding.add_argument('--blocks', type=int, nargs='+', default=[10, 100, 500], help='Blocks of four refs (one image) per page')
+    grounding.set_defaults(func=bench_grounding)
+
+    det = subparsers.add_parser('det', help='Det box payloads: eval and per-coordinate scaling vs parse_det and one NumPy scaling per page')
+    det.add_argument('--refs', type=int, nargs='+', default=[10, 100, 1000], help='Refs per page')
+    det.add_argument('--boxes', type=int, default=3, help='Most boxes per ref')
+    det.set_defaults(func=bench_det)
+
+    int8 = subparsers.add_parser('int8', help='Per-layer cosine similarity of the int8-quantized vision encoder against bf16')
+    int8.add_argument('--checkpoint', default=None, help='DeepSeek-OCR model directory (default: random weights)')
+    int8.add_argument('--threshold', type=float, default=0.99, help='Highlight layers below this cosine similarity')
+    int8.add_argument('--device', default=None, help='cpu or cuda (default: cpu)')
+    int8.set_defaults(func=bench_int8)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,6 +9,10 @@
 # Large: base_size = 1280, image_size = 1280, crop_mode = False
 # Gundam: base_size = 1024, image_size = 640, crop_mode = True
 
+import hashlib
+import os
+import threading
+
 BASE_SIZE = 1024
 IMAGE_SIZE = 640
 CROP_MODE = True
@@ -16,9 +20,64 @@ MIN_CROPS= 2
 MAX_CROPS= 6 # max:9; If your GPU memory is small, it is recommended to set it to 6.
 MAX_CONCURRENCY = 100 # If you have limited GPU memory, lower the concurrency count.
 NUM_WORKERS = 64 # image pre-process (resize/padding) workers 
+UINT8_PIXELS = True # pass raw uint8 pixels to the model and normalize them on the GPU (4x less host memory per page); False sends float32
+MAX_IMAGE_PIXELS = 100_000_000 # images with more pixels (width * height) are rejected before decoding; protects against decompression bombs
+VISION_BATCH_PIXELS = 16 * 1024 * 1024 # input pixels per vision encoder micro-batch (16 global views or 40 tiles); lower it if encoding runs out of GPU memory
+VISION_CACHE_MB = 0 # GPU memory for vision embeddings of recently seen uploads, reused when a page is sent again (e.g. with another prompt); 0 disables. start_server takes it out of gpu_memory_utilization, since vLLM's profiling does not see it
+VISION_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32) # with VISION_COMPILE_MODE, encoder micro-batches are zero-padded up to these sizes so the compiled graphs see a fixed set of shapes
+VISION_COMPILE_MODE = None # torch.compile the SAM/CLIP/projector encoder: None (eager), 'default', 'reduce-overhead' or 'max-autotune'; compiled at startup, eager on failure
+VISION_INT8 = False # opt-in: int8 weights and dynamically quantized activations for the SAM/CLIP/projector linear layers; check accuracy with `benchmark.py int8` first
 PRINT_NUM_VIS_TOKENS = False
+MAX_TOKENS = 8192 # output token ceiling per page
+ADAPTIVE_MAX_TOKENS = False # estimate max_tokens per page from ink density, PDF text layer and prompt (token_budget.py) instead of always MAX_TOKENS; pages that hit their budget are re-run with MAX_TOKENS at the same mode before any retry
+MIN_PAGE_TOKENS = 512 # smallest per-page budget when ADAPTIVE_MAX_TOKENS is on
+TOKEN_BUDGET_SAFETY = 2.0 # multiplier applied to the per-page token estimate
+LOOP_ABORT = True # stop a page as soon as its output repeats the same span of tokens (see loop_guard.py) and keep the text before the loop, marked as truncated
+LOOP_MAX_PERIOD = 512 # longest repeated span, in tokens, the loop detector looks for
+LOOP_MIN_SPAN = 512 # a loop is confirmed once the repetition covers this many tokens...
+LOOP_MIN_REPEATS = 3 # ...and the span has been emitted at least this many times
+SPECULATIVE_NGRAM = False # opt-in: speculative decoding with drafts copied from the page's own output and the document's earlier pages (prompt_lookup.py). Off because `benchmark.py speculate` measured only ~1.04-1.08 accepted tokens per forward pass; needs vLLM 0.8.5, whose n-gram worker it replaces. Loops are then cut after generation instead of by LOOP_ABORT during it
+NUM_SPECULATIVE_TOKENS = 5 # draft tokens checked per forward pass
+PROMPT_LOOKUP_MIN = 2 # shortest n-gram a draft is looked up by...
+PROMPT_LOOKUP_MAX = 4 # ...and longest; longer matches are tried first
+PROMPT_LOOKUP_PAGES = 4 # earlier pages of the same document searched for drafts
+RESOLUTION_MODES = { # name: (base_size, image_size, crop_mode), see the modes above
+    'tiny': (512, 512, False),
+    'small': (640, 640, False),
+    'base': (1024, 1024, False),
+    'large': (1280, 1280, False),
+    'gundam': (1024, 640, True),
+}
+RETRY_FALLBACKS = [ # pages that end without EOS or in a repetition loop are re-run together with each fallback in turn, until they terminate; [] disables retries
+    # mode: a RESOLUTION_MODES name (None keeps BASE_SIZE/IMAGE_SIZE/CROP_MODE), prompt: None keeps the page's prompt,
+    # ngram_size/window_size: no-repeat n-gram settings (None keeps the first attempt's), max_crops: tile budget of crop modes (None keeps MAX_CROPS)
+    {'mode': 'base', 'prompt': None, 'ngram_size': 20, 'window_size': 90},
+]
+CASCADE = False # opt-in: run every page at CASCADE_CHEAP_MODE first and re-run only the pages whose quality signals fail (quality_cascade.py) at BASE_SIZE/IMAGE_SIZE/CROP_MODE; check the thresholds with `benchmark.py cascade` first
+CASCADE_CHEAP_MODE = 'small' # RESOLUTION_MODES name of the first pass
+CASCADE_MIN_LOGPROB = -0.3 # pages whose mean token log-probability is lower are escalated...
+CASCADE_MAX_REPETITION = 0.35 # ...or whose share of repeated CASCADE_REPEAT_NGRAM-grams is higher...
+CASCADE_REPEAT_NGRAM = 8
+CASCADE_MIN_TEXT_RATIO = 0.25 # ...or whose output has fewer tokens than this share of the tokens expected from the page's ink and text layer (token_budget.py); pages without EOS always are
+LOAD_CONTROL = False # opt-in: lower the resolution mode and tile budget of bulk-lane pages as the queue or latency grows, and restore them as it falls (load_control.py)
+LOAD_LEVELS = [ # quality levels from best to cheapest, as RETRY_FALLBACKS entries (mode, max_crops); bulk pages move one level per change
+    {'mode': None, 'max_crops': MAX_CROPS},
+    {'mode': None, 'max_crops': 4},
+    {'mode': None, 'max_crops': 2},
+    {'mode': 'base'},
+    {'mode': 'small'},
+]
+LOAD_QUEUE_HIGH = 200 # pages received and not yet answered above which bulk pages step down a level...
+LOAD_QUEUE_LOW = 50 # ...and below which they step back up, if latency is also well within the SLO
+LOAD_LATENCY_SLO = 60.0 # seconds from receiving a request to answering it; a p95 above this steps down a level...
+LOAD_RESTORE_FRACTION = 0.5 # ...and a p95 below this fraction of it allows stepping back up
+LOAD_LATENCY_WINDOW = 50 # requests the p95 latency is taken over (cleared at every level change)
+LOAD_HOLD_SECONDS = 30.0 # minimum time between two level changes
+LOAD_DEFAULT_LANE = 'interactive' # lane of requests that set none: 'interactive' pages always run at the best level their key allows, 'bulk' pages follow the load
+LOAD_KEY_POLICIES = {} # per API key (Authorization: Bearer <key>): {'lane': default lane, 'ceiling': best LOAD_LEVELS index, 'floor': cheapest LOAD_LEVELS index}
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO') # start_server log level; DEBUG adds the per-request and per-page messages (batches, retries, escalations, load levels)
 SKIP_REPEAT = True
-MODEL_PATH = 'deepseek-ai/DeepSeek-OCR' # change to your model path
+MODEL_PATH = os.environ.get('MODEL_PATH', 'deepseek-ai/DeepSeek-OCR') # change to your model path
 
 # TODO: change INPUT_PATH
 # .pdf: run_dpsk_ocr_pdf.py; 
@@ -42,6 +101,106 @@ PROMPT = '<image>\n<|grounding|>Convert the document to markdown.'
 # '先天下之忧而忧'
 # .......
 
-from transformers import AutoTokenizer
+# Tokenizer: loaded lazily on first get_tokenizer() call and cached once per process.
+# The first load also saves a fast-tokenizer copy (tokenizer.json) under TOKENIZER_CACHE_DIR,
+# so later processes and workers load it from local disk without touching MODEL_PATH or the hub.
+# The copy is keyed by a fingerprint of the source tokenizer files (their resolved path, size and
+# mtime; hub snapshots resolve to per-revision blobs) and keeps the source tokenizer_config.json
+# next to it, so an updated model or tokenizer at the same path or hub id is reloaded.
+TOKENIZER_CACHE_DIR = os.environ.get('TOKENIZER_CACHE_DIR', os.path.expanduser('~/.cache/deepseek_ocr/tokenizer'))
+TOKENIZER_SOURCE_FILES = ('tokenizer.json', 'tokenizer_config.json', 'special_tokens_map.json', 'added_tokens.json', 'tokenizer.model')
+SOURCE_TOKENIZER_CONFIG = 'source_tokenizer_config.json'
+
+_TOKENIZER = None
+_TOKENIZER_LOCK = threading.Lock()
+
+
+def _tokenizer_source_dir():
+    """Directory with MODEL_PATH's tokenizer files: the model directory or its hub cache snapshot; None if not available locally"""
+    if os.path.isdir(MODEL_PATH):
+        return MODEL_PATH
+    try:
+        from huggingface_hub import try_to_load_from_cache
+        path = try_to_load_from_cache(MODEL_PATH, 'tokenizer_config.json')
+    except Exception:
+        return None
+    return os.path.dirname(path) if isinstance(path, str) else None
+
+
+def _tokenizer_fingerprint(source_dir):
+    entries = []
+    for name in TOKENIZER_SOURCE_FILES:
+        path = os.path.join(source_dir, name)
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            entries.append(f'{name}:{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha256('\n'.join(entries).encode()).hexdigest()[:16]
+
+
+def _tokenizer_artifact_dir(source_dir):
+    return os.path.join(TOKENIZER_CACHE_DIR, MODEL_PATH.strip('/').replace('/', '--'), _tokenizer_fingerprint(source_dir))
+
+
+def _read_bytes(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _artifact_is_current(artifact_dir, source_dir):
+    """The copy exists and was saved from the source's current tokenizer_config.json"""
+    if not os.path.isfile(os.path.join(artifact_dir, 'tokenizer.json')):
+        model_dir = os.path.dirname(artifact_dir)
+        if os.path.isdir(model_dir) and os.listdir(model_dir):
+            print(f'tokenizer files of {MODEL_PATH} changed since they were cached, reloading')
+        return False
+    saved = _read_bytes(os.path.join(artifact_dir, SOURCE_TOKENIZER_CONFIG))
+    if saved is None or saved != (_read_bytes(os.path.join(source_dir, 'tokenizer_config.json')) or b''):
+        print(f'tokenizer cache at {artifact_dir} does not match {MODEL_PATH}, reloading')
+        return False
+    return True
+
+
+def _load_tokenizer():
+    from transformers import AutoTokenizer
+
+    source_dir = _tokenizer_source_dir()
+    if source_dir is not None:
+        artifact_dir = _tokenizer_artifact_dir(source_dir)
+        if _artifact_is_current(artifact_dir, source_dir):
+            try:
+                return AutoTokenizer.from_pretrained(artifact_dir)
+            except Exception as e:
+                print(f'tokenizer cache at {artifact_dir} unusable, reloading: {e}')
+
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
+    # a hub id that was not cached before is now
+    source_dir = source_dir or _tokenizer_source_dir()
+    if tokenizer.is_fast and source_dir is not None:
+        artifact_dir = _tokenizer_artifact_dir(source_dir)
+        try:
+            tokenizer.save_pretrained(artifact_dir)
+            # written last: a copy without it is never used
+            with open(os.path.join(artifact_dir, SOURCE_TOKENIZER_CONFIG), 'wb') as f:
+                f.write(_read_bytes(os.path.join(source_dir, 'tokenizer_config.json')) or b'')
+        except OSError as e:
+            print(f'could not cache tokenizer at {artifact_dir}: {e}')
+    return tokenizer
+
+
+def get_tokenizer():
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        with _TOKENIZER_LOCK:
+            if _TOKENIZER is None:
+                _TOKENIZER = _load_tokenizer()
+    return _TOKENIZER
+
 
-TOKENIZER = AutoTokenizer.from_pretrained(MODEL_PATH, trust_remote_code=True)
\ No newline at end of file
+def __getattr__(name):
+    # keep `config.TOKENIZER` working without loading it at import time
+    if name == 'TOKENIZER':
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
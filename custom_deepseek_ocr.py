@@ -28,7 +28,8 @@ from vllm.transformers_utils.configs.deepseek_vl2 import (DeepseekVLV2Config,
                                                           MlpProjectorConfig,
                                                           VisionEncoderConfig)
 from process.image_process import (
-    DeepseekOCRProcessor, count_tiles)
+    DeepseekOCRProcessor, VISION_EMBEDDING_CACHE, plan_image)
+from process.ngram_norepeat import batched_logits_processors
 from vllm.transformers_utils.tokenizer import cached_tokenizer_from_config
 # from vllm.utils import is_list_of
 
@@ -42,7 +43,10 @@ from deepencoder.clip_sdpa import build_clip_l
 from deepencoder.build_linear import MlpProjector
 from addict import Dict
 # import time
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT
+from config import (IMAGE_SIZE, BASE_SIZE, CROP_MODE, PRINT_NUM_VIS_TOKENS, PROMPT,
+                    VISION_BATCH_PIXELS, VISION_BATCH_BUCKETS, VISION_COMPILE_MODE, VISION_INT8,
+                    SPECULATIVE_NGRAM)
+from vision_encoder import VisionEncoder
 # The image token id may be various
 _IMAGE_TOKEN = "<image>"
 
@@ -63,47 +67,9 @@ class DeepseekOCRProcessingInfo(BaseProcessingInfo):
                              image_width: int,
                              image_height: int,
                              cropping: bool = True) -> int:
-        hf_processor = self.get_hf_processor()
-
-
-        # image_size = hf_processor.image_size
-        # patch_size = hf_processor.patch_size
-        # downsample_ratio = hf_processor.downsample_ratio
-
-        image_size = IMAGE_SIZE
-        base_size = BASE_SIZE
-        patch_size = 16
-        downsample_ratio = 4
-
-        if CROP_MODE:
-            if image_width <= 640 and image_height <= 640:
-                crop_ratio = [1, 1]
-            else:
-                # images_crop_raw, crop_ratio = hf_processor.dynamic_preprocess(image)
-
-                # find the closest aspect ratio to the target
-                crop_ratio = count_tiles(image_width, image_height, image_size=IMAGE_SIZE)
-
-                # print('===========')
-                # print('crop_ratio ', crop_ratio)
-                # print('============')
-                
-            num_width_tiles, num_height_tiles = crop_ratio
-        else:
-            num_width_tiles = num_height_tiles = 1
-
-        h = w = math.ceil((base_size // patch_size) / downsample_ratio)
-
-        h2 = w2 = math.ceil((image_size // patch_size) / downsample_ratio)
-
-        global_views_tokens = h * (w + 1)
-        if num_width_tiles >1 or num_height_tiles>1:
-            local_views_tokens = (num_height_tiles * h2) * (num_width_tiles * w2 + 1)
-        else:
-            local_views_tokens = 0
-
-
-        return global_views_tokens + local_views_tokens + 1
+        # same planner as DeepseekOCRProcessor.preprocess_image, so the token
+        # count here can never disagree with the processed image
+        return plan_image(image_width, image_height, CROP_MODE, BASE_SIZE, IMAGE_SIZE).num_image_tokens
 
     def get_image_size_with_most_features(self) -> ImageSize:
 
@@ -186,6 +152,7 @@ class DeepseekOCRMultiModalProcessor(
             images_spatial_crop=MultiModalFieldConfig.batched("image"),
             # image_embeds=MultiModalFieldConfig.batched("image2"),
             images_crop=MultiModalFieldConfig.batched("image"),
+            image_hashes=MultiModalFieldConfig.batched("image"),
         )
 
     def _get_prompt_updates(
@@ -208,17 +175,10 @@ class DeepseekOCRMultiModalProcessor(
             if isinstance(images, ImageEmbeddingItems):
                 num_image_tokens = images.get_feature_size(item_idx)
             else:
-
-                
-                width = images[0][-1][0][0]
-                height = images[0][-1][0][1]
-
-                num_image_tokens = self.info.get_num_image_tokens(
-                    image_width=width,
-                    image_height=height,
-                    # flag = True,
-                    cropping=CROP_MODE,
-                )
+                # tokenize_with_images output: [input_ids, pixel_values, images_crop,
+                # images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes, image_hashes];
+                # reuse the token count of the tile plan the images were processed with
+                num_image_tokens = images[0][5][0]
             return [image_token_id] * num_image_tokens
 
         return [
@@ -294,9 +254,10 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         self.tile_tag = config.tile_tag
         self.global_view_pos = config.global_view_pos
     
-        # self.sam_model = torch.compile(self.sam_model, mode="reduce-overhead")
-        # self.vision_model = torch.compile(self.vision_model, mode="reduce-overhead")
-        # self.projector = torch.compile(self.projector, mode="max-autotune")
+        # SAM + CLIP + projector runner; compiled here, warmed up once the weights are loaded
+        self.vision_encoder = VisionEncoder(self.sam_model, self.vision_model, self.projector,
+                                            batch_pixels=VISION_BATCH_PIXELS, buckets=VISION_BATCH_BUCKETS)
+        self.vision_encoder.compile(VISION_COMPILE_MODE)
 
 
 
@@ -337,9 +298,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         pixel_values = kwargs.pop("pixel_values", None)
         images_spatial_crop = kwargs.pop("images_spatial_crop", None)
         images_crop = kwargs.pop("images_crop", None)
+        image_hashes = kwargs.pop("image_hashes", None)
 
 
-        if pixel_values is None or torch.sum(pixel_values).item() == 0:
+        # explicit no-image flag: the processor's placeholder has a (1, 1) images_spatial_crop instead of
+        # (num_width_tiles, num_height_tiles) rows; decided from shapes only, without reading pixels back
+        has_images = pixel_values is not None and images_spatial_crop is not None and not (
+            isinstance(images_spatial_crop, torch.Tensor) and images_spatial_crop.shape[-1] != 2)
+        if not has_images:
             return None
 
         if pixel_values is not None:
@@ -355,81 +321,102 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                 raise ValueError("Incorrect type of image crop. "
                                  f"Got type: {type(images_crop)}")
 
-            return [pixel_values, images_crop, images_spatial_crop]
+            # vLLM batches each field per request and then across requests, as (requests, images, ...) tensors
+            # or as lists where shapes differ; flatten both to one entry per image, in order. The grids and
+            # cache keys are HostTensors (see process.image_process), so reading them needs no device sync
+            grids = [tuple(grid) for request in images_spatial_crop for grid in request.tolist()]
+            keys = [key for request in image_hashes for key in request.tolist()] if image_hashes is not None else None
+            return [[image for request in pixel_values for image in request],
+                    [image for request in images_crop for image in request], grids, keys]
 
 
         raise AssertionError("This line should be unreachable.")
     
 
 
+    @staticmethod
+    def _normalize_pixels(pixels: torch.Tensor) -> torch.Tensor:
+        """bfloat16 model input; raw uint8 views are scaled to (x / 255 - 0.5) / 0.5 on their device first"""
+        if pixels.dtype == torch.uint8:
+            pixels = pixels.to(torch.float32).div_(255).sub_(0.5).div_(0.5)
+        return pixels.to(torch.bfloat16)
+
+    def _encode_views(self, views: torch.Tensor) -> torch.Tensor:
+        """SAM + CLIP + projector features of a stack of same-size views.
+
+        Runs in micro-batches of at most VISION_BATCH_PIXELS input pixels, so a
+        large step cannot exhaust encoder activation memory.
+        """
+        return self.vision_encoder.encode(views, self._normalize_pixels)
+
+    def _encode_view_stacks(self, stacks: List[torch.Tensor]) -> List[torch.Tensor]:
+        """Features of each stack of views; stacks of the same view size share one encoder pass.
+
+        A step can mix resolution modes (e.g. a retry at another mode), whose views cannot be stacked together.
+        """
+        by_size = {}
+        for idx, stack in enumerate(stacks):
+            by_size.setdefault(tuple(stack.shape[-2:]), []).append(idx)
+        features = [None] * len(stacks)
+        for indices in by_size.values():
+            encoded = self._encode_views(torch.cat([stacks[idx] for idx in indices]))
+            offset = 0
+            for idx in indices:
+                features[idx] = encoded[offset:offset + stacks[idx].shape[0]]
+                offset += stacks[idx].shape[0]
+        return features
+
     def _pixel_values_to_embedding(
         self,
-        pixel_values: torch.Tensor,
-        images_crop: torch.Tensor,
-        images_spatial_crop: torch.Tensor,
+        pixel_values: List[torch.Tensor],
+        images_crop: List[torch.Tensor],
+        images_spatial_crop: List[Tuple[int, int]],
     ) -> NestedTensors:
 
-        # Pixel_values (global view): [n_image, batch_size, 3, height, width]
-        # images_spatial_crop: [n_image, batch_size, [num_tiles_w, num_tiles_h]]
-        # images_crop (local view): [n_image, batch_size, num_pathes, 3, h, w]
-        # split the pixel and image_crop, all batch_size = 1
+        # per image: pixel_values (global view) [3, height, width]
+        # images_spatial_crop (num_tiles_w, num_tiles_h), read on the host
+        # images_crop (local views) [num_tiles_h * num_tiles_w, 3, h, w], tiles in row-major order
 
         images_in_this_batch = []
 
+        # (1, 1) means global view only and the crop is a zero placeholder
+        crop_shapes = images_spatial_crop
+        has_crops = [width_crop_num > 1 or height_crop_num > 1 for width_crop_num, height_crop_num in crop_shapes]
 
-        # print(type(images_crop))
+        with torch.no_grad():
+            # one encoder pass over all global views of the step and one over all of their local crops (per view size)
+            all_global_features = self._encode_view_stacks([pixel_values[jdx].unsqueeze(0) for jdx in range(len(crop_shapes))])
 
-        # print(pixel_values.shape)
+            local_views = [images_crop[jdx] for jdx in range(len(crop_shapes)) if has_crops[jdx]]
+            all_local_features = iter(self._encode_view_stacks(local_views))
 
+            # scatter the batched features back into each image's token layout
+            for jdx, (width_crop_num, height_crop_num) in enumerate(crop_shapes):
+                global_features = all_global_features[jdx][0]
 
-        with torch.no_grad():
-            for jdx in range(images_spatial_crop.size(0)):
-                # with torch.set_grad_enabled(False):
-                patches = images_crop[jdx][0].to(torch.bfloat16) # batch_size = 1
-                image_ori = pixel_values[jdx]
-                crop_shape = images_spatial_crop[jdx][0]
+                hw, n_dim = global_features.shape
+                h = w = int(hw ** 0.5)
 
-                if torch.sum(patches).item() != 0:  # if all values = 0, no crop
-                    # P, C, H, W = patches.shape
-                    # crop_flag = 1
-                    local_features_1 = self.sam_model(patches)
-                    #TODO del patches 
-                    # torch.compiler.cudagraph_mark_step_begin()
-                    local_features_2 = self.vision_model(patches, local_features_1)  
+                global_features = global_features.view(h, w, n_dim)
 
+                global_features = torch.cat(
+                    [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
+                )
 
-                    local_features = torch.cat((local_features_2[:, 1:], local_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    local_features = self.projector(local_features)
-
+                global_features = global_features.view(-1, n_dim)
 
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
+                if has_crops[jdx]:
+                    local_features = next(all_local_features)
 
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
-                        print('BASE: ', global_features.shape)
+                        print('BASE: ', all_global_features[jdx].shape)
                         print('PATCHES: ', local_features.shape)
                         print('=====================')
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
                     _2, hw2, n_dim2 = local_features.shape
                     h2 = w2 = int(hw2 ** 0.5)
 
-                    width_crop_num, height_crop_num = crop_shape[0], crop_shape[1]
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
-
                     local_features = local_features.view(height_crop_num, width_crop_num, h2, w2, n_dim2).permute(0, 2, 1, 3, 4).reshape(height_crop_num*h2, width_crop_num*w2, n_dim2)
                     local_features = torch.cat(
                         [local_features, self.image_newline[None, None, :].expand(height_crop_num * h2, 1, n_dim2)], dim=1
@@ -437,30 +424,14 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
                     local_features = local_features.view(-1, n_dim2)
 
                     global_local_features = torch.cat([local_features, global_features, self.view_seperator[None, :]], dim=0)
-                
-                else:
-                    global_features_1 = self.sam_model(image_ori)
-                    global_features_2 = self.vision_model(image_ori, global_features_1) 
-                    global_features = torch.cat((global_features_2[:, 1:], global_features_1.flatten(2).permute(0, 2, 1)), dim=-1) 
-                    global_features = self.projector(global_features)
 
+                else:
                     if PRINT_NUM_VIS_TOKENS:
                         print('=====================')
-                        print('BASE: ', global_features.shape)
+                        print('BASE: ', all_global_features[jdx].shape)
                         print('NO PATCHES')
                         print('=====================')
 
-                    _, hw, n_dim = global_features.shape
-                    h = w = int(hw ** 0.5)
-
-                    global_features = global_features.view(h, w, n_dim)
-
-                    global_features = torch.cat(
-                        [global_features, self.image_newline[None, None, :].expand(h, 1, n_dim)], dim=1
-                    )
-
-                    global_features = global_features.view(-1, n_dim)
-
                     global_local_features = torch.cat([global_features, self.view_seperator[None, :]], dim=0)
 
                 images_in_this_batch.append(global_local_features)
@@ -471,9 +442,9 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
             self, image_input) -> torch.Tensor:
         
 
-        # image_input: [pixel_values, images_crop, images_spatial_crop]
+        # image_input: per-image lists [pixel_values, images_crop, tile grids, cache keys]
     
-        pixel_values = image_input[0].to(torch.bfloat16)
+        pixel_values = image_input[0]
         # print(image_input[1][0].shape)
         # print(type(image_input[1]))
         # exit()
@@ -481,7 +452,7 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         # images_crop = image_input[1].to(torch.bfloat16)
         images_crop = image_input[1]
         # images_crop = image_input[1]
-        images_spatial_crop = image_input[2].to(dtype=torch.long)
+        images_spatial_crop = image_input[2]
 
         # local_start = time.time()
         vision_features = self._pixel_values_to_embedding(
@@ -501,7 +472,20 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         image_input = self._parse_and_validate_image_input(**kwargs)
         if image_input is None:
             return None
-        vision_embeddings = self._process_image_input(image_input)
+        if not VISION_EMBEDDING_CACHE.enabled or image_input[3] is None:
+            return self._process_image_input(image_input)
+
+        # read on the host in _parse_and_validate_image_input; 0 is not cacheable
+        keys = image_input[3]
+        vision_embeddings = [VISION_EMBEDDING_CACHE.get(key) if key else None for key in keys]
+
+        misses = [jdx for jdx, features in enumerate(vision_embeddings) if features is None]
+        if misses:
+            computed = self._process_image_input([[image_input[i][jdx] for jdx in misses] for i in range(3)] + [None])
+            for jdx, features in zip(misses, computed):
+                if keys[jdx]:
+                    VISION_EMBEDDING_CACHE.put(keys[jdx], features)
+                vision_embeddings[jdx] = features
         return vision_embeddings
     
 
@@ -558,23 +542,34 @@ class DeepseekOCRForCausalLM(nn.Module, SupportsMultiModal, SupportsPP):
         hidden_states: torch.Tensor,
         sampling_metadata: SamplingMetadata,
     ) -> Optional[torch.Tensor]:
-        return self.language_model.compute_logits(hidden_states,
-                                                  sampling_metadata)
+        # no-repeat n-gram bans and loop aborts run once for the whole batch instead of once per sequence;
+        # speculative scoring reuses sequence ids across steps, so the processors then rebuild their state each step
+        with batched_logits_processors(sampling_metadata, incremental=not SPECULATIVE_NGRAM) as apply_batched_processors:
+            logits = self.language_model.compute_logits(hidden_states,
+                                                        sampling_metadata)
+        return apply_batched_processors(logits)
 
 
-    def load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]) -> Set[str]:
-        processed_weights = []
-        
+    @staticmethod
+    def _rename_weights(weights: Iterable[Tuple[str, torch.Tensor]]) -> Iterable[Tuple[str, torch.Tensor]]:
+        # a generator, so checkpoint tensors flow to the loader one at a time instead of all being held at once
         for name, tensor in weights:
             if 'sam_model' in name or 'vision_model' in name or 'projector' in name or 'image_newline' in name or 'view_seperator' in name:
                 new_name = name.replace('model.', '', 1)
             else:
                 new_name = 'language.' + name
 
-            processed_weights.append((new_name, tensor))
-        
+            yield new_name, tensor
+
+    def load_weights(self, weights: Iterable[Tuple[str, torch.Tensor]]) -> Set[str]:
         loader = AutoWeightsLoader(self)
-        autoloaded_weights = loader.load_weights(processed_weights, mapper=self.hf_to_vllm_mapper)
+        autoloaded_weights = loader.load_weights(self._rename_weights(weights), mapper=self.hf_to_vllm_mapper)
+
+        if VISION_INT8:
+            self.vision_encoder.quantize_int8()
+
+        view_sizes = [(BASE_SIZE, BASE_SIZE)] + ([(IMAGE_SIZE, IMAGE_SIZE)] if CROP_MODE else [])
+        self.vision_encoder.warmup(self.vision_encoder.warmup_shapes(view_sizes), device=self.image_newline.device)
 
 
 
@@ -1,12 +1,21 @@
+import functools
+import hashlib
+import io
 import math
-from typing import List, Tuple
+import threading
+from collections import OrderedDict
+from typing import List, NamedTuple, Tuple
 
+import numpy as np
 import torch
 import torchvision.transforms as T
 from PIL import Image, ImageOps
 from transformers import AutoProcessor, BatchFeature, LlamaTokenizerFast
 from transformers.processing_utils import ProcessorMixin
-from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, PROMPT, TOKENIZER
+from config import IMAGE_SIZE, BASE_SIZE, CROP_MODE, MIN_CROPS, MAX_CROPS, MAX_IMAGE_PIXELS, PROMPT, UINT8_PIXELS, VISION_CACHE_MB, get_tokenizer
+
+# PIL's own bomb check (warning above the cap, error above twice the cap) follows the configured cap
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
 
 def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
     best_ratio_diff = float('inf')
@@ -25,65 +34,155 @@ def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_
     return best_ratio
 
 
-def count_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    aspect_ratio = orig_width / orig_height
-
-    # calculate the existing image aspect ratio
+@functools.lru_cache(maxsize=None)
+def target_ratio_table(min_num=MIN_CROPS, max_num=MAX_CROPS):
+    """candidate (num_width_tiles, num_height_tiles) grids, sorted by tile count"""
     target_ratios = set(
         (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
         i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    return tuple(sorted(target_ratios, key=lambda x: x[0] * x[1]))
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
 
-    return target_aspect_ratio
+@functools.lru_cache(maxsize=4096)
+def plan_tiles(orig_width, orig_height, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640):
+    """closest tile grid for an image size, memoized per size"""
+    return find_closest_aspect_ratio(
+        orig_width / orig_height, target_ratio_table(min_num, max_num), orig_width, orig_height, image_size)
 
 
-def dynamic_preprocess(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, use_thumbnail=False):
-    orig_width, orig_height = image.size
-    aspect_ratio = orig_width / orig_height
+def count_image_tokens(num_width_tiles, num_height_tiles, base_size=BASE_SIZE, image_size=IMAGE_SIZE,
+                       patch_size=16, downsample_ratio=4):
+    """number of <image> tokens for a global view plus a tile grid"""
+    num_queries = math.ceil((image_size // patch_size) / downsample_ratio)
+    num_queries_base = math.ceil((base_size // patch_size) / downsample_ratio)
 
-    # calculate the existing image aspect ratio
-    target_ratios = set(
-        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-        i * j <= max_num and i * j >= min_num)
-    # print(target_ratios)
-    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+    # global view: one newline per row, plus the view separator
+    num_tokens = (num_queries_base + 1) * num_queries_base + 1
+    if num_width_tiles > 1 or num_height_tiles > 1:
+        num_tokens += (num_queries * num_width_tiles + 1) * (num_queries * num_height_tiles)
+    return num_tokens
 
-    # find the closest aspect ratio to the target
-    target_aspect_ratio = find_closest_aspect_ratio(
-        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
 
-    # print(target_aspect_ratio)
+class TilePlan(NamedTuple):
+    crop_ratio: Tuple[int, int]  # (num_width_tiles, num_height_tiles)
+    num_image_tokens: int
+
+    @property
+    def has_tiles(self) -> bool:
+        return self.crop_ratio[0] > 1 or self.crop_ratio[1] > 1
+
+
+@functools.lru_cache(maxsize=4096)
+def plan_image(width, height, cropping=CROP_MODE, base_size=BASE_SIZE, image_size=IMAGE_SIZE,
+               min_num=MIN_CROPS, max_num=MAX_CROPS) -> TilePlan:
+    """Tile grid and image token count for one image.
+
+    This is the only place the grid is decided: preprocessing follows it and
+    the processor output carries its token count into prompt replacement.
+    """
+    if (width <= 640 and height <= 640) or not cropping:
+        crop_ratio = (1, 1)
+    else:
+        crop_ratio = tuple(plan_tiles(width, height, min_num, max_num, image_size))
+    return TilePlan(crop_ratio, count_image_tokens(crop_ratio[0], crop_ratio[1], base_size, image_size))
+
+
+def consumable_size(width, height, cropping=CROP_MODE, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """Smallest size, at the same aspect ratio, that still feeds every view of the tile plan.
+
+    The global view never needs more than base_size on the long side and the tiles
+    never more than (cols * image_size, rows * image_size), so decoding beyond that
+    only produces pixels the resizes throw away. Never larger than the input, and
+    falls back to the input size if the reduced size would be planned differently.
+    """
+    plan = plan_image(width, height, cropping, base_size, image_size)
+    if image_size <= 640 and not cropping:
+        scale = max(image_size / width, image_size / height)
+    else:
+        scale = base_size / max(width, height)
+    if plan.has_tiles:
+        scale = max(scale, plan.crop_ratio[0] * image_size / width, plan.crop_ratio[1] * image_size / height)
+    if scale >= 1:
+        return width, height
+
+    target = (math.ceil(width * scale), math.ceil(height * scale))
+    if plan_image(target[0], target[1], cropping, base_size, image_size) != plan:
+        return width, height
+    return target
+
+
+def decode_image(fp, cropping=CROP_MODE, max_pixels=MAX_IMAGE_PIXELS, base_size=BASE_SIZE, image_size=IMAGE_SIZE):
+    """Decode an uploaded image straight to its consumable_size, as RGB.
+
+    fp is raw bytes, a path or a file object. JPEGs are decoded with DCT scaling
+    (draft) to the smallest 1/2, 1/4 or 1/8 scale that is still large enough, and
+    the remaining reduction uses a reducing-gap resize. Raises ValueError when the
+    header reports more than max_pixels pixels, before any pixel data is decoded.
+    With the vision embedding cache enabled, raw bytes are digested into
+    image.info[CONTENT_DIGEST_KEY] so the page can be recognised when sent again.
+
+    The draft scale follows from the tile plan, which is read from the header
+    first: a crop-mode plan keeps its tiles at image_size, so the target is at
+    least 3 * 640 = 1920 px on the long side for the usual 3x2 plans. Photos up
+    to about 7680 px long therefore only decode at 1/2, which saves little on the
+    decode itself; 1/4 (and its real decode saving) starts above that. Most of the
+    gain is downstream: the tile and global-view resizes start from the target
+    instead of the full photo.
+    """
+    digest = None
+    if isinstance(fp, (bytes, bytearray)):
+        if VISION_EMBEDDING_CACHE.enabled:
+            digest = content_digest(fp)
+        fp = io.BytesIO(fp)
+    image = Image.open(fp)
+    width, height = image.size
+    if max_pixels and width * height > max_pixels:
+        raise ValueError(f"image is {width}x{height} pixels, more than the {max_pixels} pixel limit")
+
+    target = consumable_size(width, height, cropping, base_size, image_size)
+    if target != (width, height):
+        image.draft('RGB', target)
+    image = image.convert('RGB')
+    if image.size != target:
+        image = image.resize(target, Image.BICUBIC, reducing_gap=3.0)
+    if digest is not None:
+        image.info[CONTENT_DIGEST_KEY] = digest
+    return image
+
+
+def resize_for_tiles(image, min_num=MIN_CROPS, max_num=MAX_CROPS, image_size=640, target_aspect_ratio=None):
+    if target_aspect_ratio is None:
+        # find the closest aspect ratio to the target
+        target_aspect_ratio = plan_tiles(image.size[0], image.size[1], min_num, max_num, image_size)
+
     # calculate the target width and height
     target_width = image_size * target_aspect_ratio[0]
     target_height = image_size * target_aspect_ratio[1]
-    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
 
     # resize the image
     resized_img = image.resize((target_width, target_height))
-    processed_images = []
-    for i in range(blocks):
-        box = (
-            (i % (target_width // image_size)) * image_size,
-            (i // (target_width // image_size)) * image_size,
-            ((i % (target_width // image_size)) + 1) * image_size,
-            ((i // (target_width // image_size)) + 1) * image_size
-        )
-        # split the image
-        split_img = resized_img.crop(box)
-        processed_images.append(split_img)
-    assert len(processed_images) == blocks
-    if use_thumbnail and len(processed_images) != 1:
-        thumbnail_img = image.resize((image_size, image_size))
-        processed_images.append(thumbnail_img)
-    return processed_images, target_aspect_ratio
+    return resized_img, target_aspect_ratio
+
 
+def pil_to_uint8(image: Image.Image) -> torch.Tensor:
+    """(1, 3, H, W) uint8 view over a copy of the RGB pixel buffer"""
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    return torch.from_numpy(np.array(image)).permute(2, 0, 1).unsqueeze(0)
 
 
+def split_tiles(resized_img: Image.Image, num_width_tiles: int, num_height_tiles: int, image_size: int) -> torch.Tensor:
+    """Split a (cols * S, rows * S) image into (rows * cols, 3, S, S) uint8 tiles.
+
+    Tiles are views of a single pixel buffer, in row-major order (left to right,
+    then top to bottom).
+    """
+    if resized_img.mode != 'RGB':
+        resized_img = resized_img.convert('RGB')
+    pixels = torch.from_numpy(np.array(resized_img))
+    tiles = pixels.view(num_height_tiles, image_size, num_width_tiles, image_size, 3).permute(0, 2, 4, 1, 3)
+    return tiles.reshape(num_height_tiles * num_width_tiles, 3, image_size, image_size)
+
 
 class ImageTransform:
 
@@ -106,6 +205,210 @@ class ImageTransform:
         x = self.transform(pil_img)
         return x
 
+    def batch(self, views: List[torch.Tensor], device=None) -> torch.Tensor:
+        """Transform uint8 (N, 3, H, W) views of the same size in one vectorized op.
+
+        Produces the same values as calling the ToTensor/Normalize pipeline on
+        each image, on CPU or any torch device.
+        """
+        total = sum(view.shape[0] for view in views)
+        out = torch.empty((total,) + tuple(views[0].shape[1:]), dtype=torch.float32, device=device)
+        offset = 0
+        for view in views:
+            out[offset:offset + view.shape[0]].copy_(view)
+            offset += view.shape[0]
+
+        out.div_(255)
+        if self.normalize:
+            mean = torch.as_tensor(self.mean, dtype=out.dtype, device=out.device).view(1, -1, 1, 1)
+            std = torch.as_tensor(self.std, dtype=out.dtype, device=out.device).view(1, -1, 1, 1)
+            out.sub_(mean).div_(std)
+        return out
+
+
+class PromptTokenCache:
+    """Bounded LRU memo of tokenized prompt segments.
+
+    The server only ever sees a handful of distinct prompts, so the text around
+    each <image> tag is tokenized once and shared by every processor instance
+    and thread in the process.
+    """
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def encode(self, tokenizer, text: str) -> Tuple[int, ...]:
+        key = (tokenizer.name_or_path, len(tokenizer), text)
+        with self._lock:
+            tokens = self._cache.get(key)
+            if tokens is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return tokens
+            self.misses += 1
+
+        tokens = tuple(tokenizer.encode(text, add_special_tokens=False))
+
+        with self._lock:
+            self._cache[key] = tokens
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return tokens
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._cache), "maxsize": self.maxsize}
+
+
+PROMPT_TOKEN_CACHE = PromptTokenCache()
+
+
+class VisionEmbeddingCache:
+    """Bounded LRU of per-image vision embeddings, evicted by tensor bytes.
+
+    Keyed by DeepseekOCRProcessor.cache_keys(), so the same page sent again with
+    another prompt skips SAM, CLIP and the projector.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get(self, key: int):
+        with self._lock:
+            features = self._cache.get(key)
+            if features is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return features
+
+    def put(self, key: int, features: torch.Tensor):
+        nbytes = features.numel() * features.element_size()
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._cache.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.numel() * previous.element_size()
+            self._cache[key] = features
+            self.bytes += nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self.bytes -= evicted.numel() * evicted.element_size()
+
+    def info(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "size": len(self._cache), "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+
+VISION_EMBEDDING_CACHE = VisionEmbeddingCache(VISION_CACHE_MB * 1024 * 1024)
+
+
+def reserve_vision_cache(gpu_memory_utilization: float) -> float:
+    """gpu_memory_utilization less the share of GPU 0 the vision embedding cache may fill.
+
+    vLLM sizes the KV cache from the profiled peak, which does not include the cache.
+    """
+    if not VISION_EMBEDDING_CACHE.enabled or not torch.cuda.is_available():
+        return gpu_memory_utilization
+    return gpu_memory_utilization - VISION_EMBEDDING_CACHE.max_bytes / torch.cuda.get_device_properties(0).total_memory
+
+
+class HostTensor(torch.Tensor):
+    """Per-image metadata (tile grids, cache keys) that stays in host memory.
+
+    vLLM moves every multimodal kwarg to the model's device with .to() before the
+    forward pass. That is a no-op here, so the model reads these values in Python
+    without a device sync. Stacking and indexing keep the subclass.
+    """
+
+    def to(self, *args, **kwargs):
+        return self
+
+
+def host_tensor(values) -> HostTensor:
+    """int64 HostTensor of values"""
+    return torch.tensor(values, dtype=torch.long).as_subclass(HostTensor)
+
+
+# PIL Image.info key carrying the content_digest() of the encoded upload or PDF page an image was decoded from
+CONTENT_DIGEST_KEY = 'content_digest'
+
+
+def content_digest(*parts) -> bytes:
+    """8-byte blake2b digest of encoded image bytes and whatever else identifies the decoded pixels"""
+    digest = hashlib.blake2b(digest_size=8)
+    for part in parts:
+        digest.update(part if isinstance(part, (bytes, bytearray)) else repr(part).encode())
+    return digest.digest()
+
+
+@functools.lru_cache(maxsize=1024)
+def build_token_template(
+    text_segments: Tuple[Tuple[int, ...], ...],
+    image_token_counts: Tuple[int, ...],
+    image_token_id: int,
+    bos_id: int,
+    eos_id: int,
+    pad_id: int,
+    ignore_id: int,
+    bos: bool = True,
+    eos: bool = True,
+):
+    """Build input_ids, target_ids and images_seq_mask for one (prompt, tile layout, mode).
+
+    text_segments are the tokenized prompt pieces around the <image> tags and
+    image_token_counts the number of image tokens for each image, so the key
+    only changes with the prompt, the crop ratio and the resolution mode. The
+    tensors are assembled by concatenation once and cached; callers must not
+    modify them in place.
+    """
+    assert len(text_segments) == len(image_token_counts) + 1
+
+    id_pieces, mask_pieces = [], []
+    if bos:
+        id_pieces.append(torch.tensor([bos_id], dtype=torch.long))
+        mask_pieces.append(torch.zeros(1, dtype=torch.bool))
+    for idx, segment in enumerate(text_segments):
+        id_pieces.append(torch.tensor(segment, dtype=torch.long))
+        mask_pieces.append(torch.zeros(len(segment), dtype=torch.bool))
+        if idx < len(image_token_counts):
+            id_pieces.append(torch.full((image_token_counts[idx],), image_token_id, dtype=torch.long))
+            mask_pieces.append(torch.ones(image_token_counts[idx], dtype=torch.bool))
+    if eos:
+        id_pieces.append(torch.tensor([eos_id], dtype=torch.long))
+        mask_pieces.append(torch.zeros(1, dtype=torch.bool))
+
+    input_ids = torch.cat(id_pieces)
+    images_seq_mask = torch.cat(mask_pieces)
+
+    # set input_ids < 0 | input_ids == image_token_id as ignore_id
+    target_ids = input_ids.masked_fill((input_ids < 0) | (input_ids == image_token_id), ignore_id)
+    if pad_id is not None:
+        input_ids = input_ids.masked_fill(input_ids < 0, pad_id)
+
+    # inference mode: remove the ending eos token
+    assert input_ids[-1] == eos_id
+    return input_ids[:-1], target_ids[:-1], images_seq_mask[:-1]
+
 
 class DeepseekOCRProcessor(ProcessorMixin):
     tokenizer_class = ("LlamaTokenizer", "LlamaTokenizerFast")
@@ -113,7 +416,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
     def __init__(
         self,
-        tokenizer: LlamaTokenizerFast = TOKENIZER,
+        tokenizer: LlamaTokenizerFast = None,
         candidate_resolutions: Tuple[Tuple[int, int]] = [[1024, 1024]],
         patch_size: int = 16,
         downsample_ratio: int = 4,
@@ -126,12 +429,18 @@ class DeepseekOCRProcessor(ProcessorMixin):
         sft_format: str = "deepseek",
         mask_prompt: bool = True,
         ignore_id: int = -100,
+        uint8_pixels: bool = UINT8_PIXELS,
+        base_size: int = BASE_SIZE,
+        image_size: int = IMAGE_SIZE,
+        max_crops: int = MAX_CROPS,
         **kwargs,
     ):
 
         # self.candidate_resolutions = candidate_resolutions # placeholder no use
-        self.image_size = IMAGE_SIZE
-        self.base_size = BASE_SIZE
+        # another resolution mode or tile budget than config's can be chosen per processor (e.g. for retries)
+        self.image_size = image_size
+        self.base_size = base_size
+        self.max_crops = max_crops
         # self.patch_size = patch_size
         self.patch_size = 16 
         self.image_mean = image_mean
@@ -141,8 +450,12 @@ class DeepseekOCRProcessor(ProcessorMixin):
         self.downsample_ratio = 4
 
         self.image_transform = ImageTransform(mean=image_mean, std=image_std, normalize=normalize)
+        # uint8: the model normalizes on its own device, see DeepseekOCRForCausalLM._normalize_pixels
+        self.uint8_pixels = uint8_pixels
 
 
+        if tokenizer is None:
+            tokenizer = get_tokenizer()
         self.tokenizer = tokenizer
         # self.tokenizer = add_special_token(tokenizer)
         self.tokenizer.padding_side = 'left'  # must set this，padding side with make a difference in batch inference
@@ -231,6 +544,24 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         return t
 
+    def encode_prompt_segment(self, text: str) -> Tuple[int, ...]:
+        """encode without bos/eos, memoized in PROMPT_TOKEN_CACHE"""
+        return PROMPT_TOKEN_CACHE.encode(self.tokenizer, text)
+
+    def plan(self, image: Image.Image, cropping: bool = True) -> TilePlan:
+        return plan_image(image.size[0], image.size[1], cropping, self.base_size, self.image_size,
+                          min(MIN_CROPS, self.max_crops), self.max_crops)
+
+    def to_pixels(self, views: List[torch.Tensor], device=None) -> torch.Tensor:
+        """Stack uint8 views into the tensor handed to the model: raw uint8, or normalized float32"""
+        if self.uint8_pixels:
+            return torch.cat(views).to(device)
+        return self.image_transform.batch(views, device)
+
+    @property
+    def pixel_dtype(self):
+        return torch.uint8 if self.uint8_pixels else torch.float32
+
     def decode(self, t: List[int], **kwargs) -> str:
         return self.tokenizer.decode(t, **kwargs)
 
@@ -265,7 +596,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         sft_format = prompt
 
-        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _ = images[0]
+        input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, _, image_hashes = images[0]
 
 
         return {
@@ -275,6 +606,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
             "images_seq_mask": images_seq_mask,
             "images_spatial_crop": images_spatial_crop,
             "num_image_tokens": num_image_tokens,
+            "image_hashes": image_hashes,
         }
 
 
@@ -323,6 +655,28 @@ class DeepseekOCRProcessor(ProcessorMixin):
 
         return prepare
 
+    def preprocess_image(self, image: Image.Image, cropping: bool = True):
+        """Global view and local tiles of one image as uint8 tensors.
+
+        Returns:
+            global_view (1, 3, base_size, base_size), tiles (n, 3, image_size, image_size)
+            or None, and the TilePlan the views were built from
+        """
+        plan = self.plan(image, cropping)
+        tiles = None
+        if plan.has_tiles:
+            resized_img, _ = resize_for_tiles(image, image_size=self.image_size, target_aspect_ratio=plan.crop_ratio)
+            tiles = split_tiles(resized_img, plan.crop_ratio[0], plan.crop_ratio[1], self.image_size)
+
+        """process the global view"""
+        if self.image_size <= 640 and not cropping:
+            # print('directly resize')
+            image = image.resize((self.image_size, self.image_size))
+
+        global_view = ImageOps.pad(image, (self.base_size, self.base_size),
+                                   color=tuple(int(x * 255) for x in self.image_transform.mean))
+        return pil_to_uint8(global_view), tiles, plan
+
     def tokenize_with_images(
         self,
         prompt: str,  # Added prompt parameter to use custom prompts
@@ -330,6 +684,7 @@ class DeepseekOCRProcessor(ProcessorMixin):
         bos: bool = True,
         eos: bool = True,
         cropping: bool = True,
+        device=None,
     ):
         """Tokenize text with <image> tags."""
 
@@ -337,163 +692,77 @@ class DeepseekOCRProcessor(ProcessorMixin):
         # If prompt is provided and not empty, use it; otherwise fall back to global PROMPT
         conversation = prompt if prompt and prompt.strip() else PROMPT
         assert conversation.count(self.image_token) == len(images)
+
+        prepared = [self.preprocess_image(image, cropping) for image in images]
+        image_shapes = [image.size for image in images]
+
+        if len(prepared) == 0:
+            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size), dtype=self.pixel_dtype, device=device)
+            images_crop = None
+        else:
+            pixel_values = self.to_pixels([global_view for global_view, _, _ in prepared], device)
+            tiles = [page_tiles for _, page_tiles, _ in prepared if page_tiles is not None]
+            images_crop = self.to_pixels(tiles, device) if tiles else None
+
+        return self._assemble(conversation, [plan for _, _, plan in prepared], image_shapes,
+                              pixel_values, images_crop, bos, eos, device,
+                              self.cache_keys(images, [plan for _, _, plan in prepared], cropping))
+
+    def cache_keys(self, images: List[Image.Image], plans: List[TilePlan], cropping: bool) -> List[int]:
+        """VisionEmbeddingCache key of each image, a positive int64.
+
+        The key combines the content digest decode_image or the PDF renderer left in
+        image.info with the resolution mode and tile plan, so no pixels are hashed.
+        Key 0 means not cacheable: the cache is disabled or the image carries no digest.
+        """
+        keys = []
+        for image, plan in zip(images, plans):
+            digest = image.info.get(CONTENT_DIGEST_KEY) if VISION_EMBEDDING_CACHE.enabled else None
+            key = 0
+            if digest is not None:
+                key = int.from_bytes(content_digest(digest, image.size, self.base_size, self.image_size,
+                                                    cropping, plan.crop_ratio), 'little') >> 1
+            keys.append(key)
+        return keys
+
+    def _assemble(self, conversation, plans, image_shapes, pixel_values, images_crop, bos, eos, device=None,
+                  image_hashes=None):
+        """Build the processor output for already transformed views"""
         text_splits = conversation.split(self.image_token)
-        images_list, images_crop_list, images_seq_mask, images_spatial_crop = [], [], [], []
-        image_shapes = []
-        num_image_tokens = []
-        tokenized_str = []
-        # print('image: ', len(images))
-        for text_sep, image in zip(text_splits, images):
-            """encode text_sep"""
-            tokenized_sep = self.encode(text_sep, bos=False, eos=False)
-            tokenized_str += tokenized_sep
-            images_seq_mask += [False] * len(tokenized_sep)
-
-            """select best resolution for anyres"""
-            # if cropping:
-            #     best_width, best_height = self.select_best_resolution(image.size)
-            # else:
-            #     best_width, best_height = self.image_size, self.image_size
-
-            image_shapes.append(image.size)
-
-            if image.size[0] <= 640 and image.size[1] <= 640:
-                crop_ratio = [1, 1]
-            else:
-                if cropping:
-                    # print('image-size: ', image.size)
-                    # best_width, best_height = select_best_resolution(image.size, self.candidate_resolutions)
-                    # print('image ', image.size)
-                    # print('open_size:', image.size)
-                    images_crop_raw, crop_ratio = dynamic_preprocess(image, image_size=IMAGE_SIZE)
-                    # print('crop_ratio: ', crop_ratio)
-                else:
-                    # best_width, best_height = self.image_size, self.image_size
-                    crop_ratio = [1, 1]
-            # print(image.size, (best_width, best_height)) # check the select_best_resolutions func
-
-            # print(crop_ratio)
-            """process the global view"""
-
-            # if cropping
-            if self.image_size <= 640 and not cropping:
-                # print('directly resize')
-                image = image.resize((self.image_size, self.image_size))
-
-            global_view = ImageOps.pad(image, (self.base_size, self.base_size),
-                                    color=tuple(int(x * 255) for x in self.image_transform.mean))
-            images_list.append(self.image_transform(global_view))
-
-            """record height / width crop num"""
-            # width_crop_num, height_crop_num = best_width // self.image_size, best_height // self.image_size
-            num_width_tiles, num_height_tiles = crop_ratio
-            images_spatial_crop.append([num_width_tiles, num_height_tiles])
-
-
-
-
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                """process the local views"""
-                # local_view = ImageOps.pad(image, (best_width, best_height),
-                #                         color=tuple(int(x * 255) for x in self.image_transform.mean))
-                # for i in range(0, best_height, self.image_size):
-                #     for j in range(0, best_width, self.image_size):
-                #         images_crop_list.append(
-                #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
-                for i in range(len(images_crop_raw)):
-                    images_crop_list.append(self.image_transform(images_crop_raw[i]))
-
-            # """process the global view"""
-            # global_view = ImageOps.pad(image, (self.image_size, self.image_size),
-            #                            color=tuple(int(x * 255) for x in self.image_transform.mean))
-            # images_list.append(self.image_transform(global_view))
-
-            # """process the local views"""
-            # local_view = ImageOps.pad(image, (best_width, best_height),
-            #                           color=tuple(int(x * 255) for x in self.image_transform.mean))
-            # for i in range(0, best_height, self.image_size):
-            #     for j in range(0, best_width, self.image_size):
-            #         images_list.append(
-            #             self.image_transform(local_view.crop((j, i, j + self.image_size, i + self.image_size))))
-
-            # """add image tokens"""
-            """add image tokens"""
-            num_queries = math.ceil((self.image_size // self.patch_size) / self.downsample_ratio)
-            num_queries_base = math.ceil((self.base_size // self.patch_size) / self.downsample_ratio)
-
-
-            tokenized_image = ([self.image_token_id] * num_queries_base + [self.image_token_id]) * num_queries_base
-            tokenized_image += [self.image_token_id]
-            if num_width_tiles > 1 or num_height_tiles > 1:
-                tokenized_image += ([self.image_token_id] * (num_queries * num_width_tiles) + [self.image_token_id]) * (
-                            num_queries * num_height_tiles)
-            tokenized_str += tokenized_image
-            images_seq_mask += [True] * len(tokenized_image)
-            num_image_tokens.append(len(tokenized_image))
-
-        """process the last text split"""
-        tokenized_sep = self.encode(text_splits[-1], bos=False, eos=False)
-        tokenized_str += tokenized_sep
-        images_seq_mask += [False] * len(tokenized_sep)
-
-        """add the bos and eos tokens"""
-        if bos:
-            tokenized_str = [self.bos_id] + tokenized_str
-            images_seq_mask = [False] + images_seq_mask
-        if eos:
-            tokenized_str = tokenized_str + [self.eos_id]
-            images_seq_mask = images_seq_mask + [False]
-
-        assert len(tokenized_str) == len(
-            images_seq_mask), f"tokenize_with_images func: tokenized_str's length {len(tokenized_str)} is not equal to imags_seq_mask's length {len(images_seq_mask)}"
-        
-
-
-        masked_tokenized_str = []
-        for token_index in tokenized_str:
-            if token_index != self.image_token_id:
-                masked_tokenized_str.append(token_index)
-            else:
-                masked_tokenized_str.append(self.ignore_id)
-
-        assert len(tokenized_str) == len(images_seq_mask) == len(masked_tokenized_str), \
-            (f"tokenized_str's length {len(tokenized_str)}, input_ids' length {len(masked_tokenized_str)}, "
-             f"imags_seq_mask's length {len(images_seq_mask)}, are not equal")
-
-        input_ids = torch.LongTensor(tokenized_str)
-        target_ids = torch.LongTensor(masked_tokenized_str)
-        images_seq_mask = torch.tensor(images_seq_mask, dtype=torch.bool)
-
-        # set input_ids < 0 | input_ids == self.image_token_id as ignore_id
-        target_ids[(input_ids < 0) |
-                   (input_ids == self.image_token_id)] = self.ignore_id
-        input_ids[input_ids < 0] = self.pad_id
-
-        inference_mode = True
-
-        if inference_mode:
-            # Remove the ending eos token
-            assert input_ids[-1] == self.eos_id
-            input_ids = input_ids[:-1]
-            target_ids = target_ids[:-1]
-            images_seq_mask = images_seq_mask[:-1]
-
-        if len(images_list) == 0:
-            pixel_values = torch.zeros((1, 3, self.base_size, self.base_size))
-            images_spatial_crop = torch.zeros((1, 1), dtype=torch.long)
-            images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+
+        """add image tokens"""
+        num_image_tokens = [plan.num_image_tokens for plan in plans]
+
+        """assemble the token sequence from the cached (prompt, tile layout, mode) template"""
+        text_segments = tuple(self.encode_prompt_segment(text_sep) for text_sep in text_splits)
+        input_ids, _target_ids, images_seq_mask = build_token_template(
+            text_segments, tuple(num_image_tokens), self.image_token_id,
+            self.bos_id, self.eos_id, self.pad_id, self.ignore_id, bos, eos)
+        input_ids = input_ids.clone()
+        images_seq_mask = images_seq_mask.clone()
+
+        """record height / width crop num"""
+        # kept on the host, so the model reads the tile grids without a device sync
+        if len(plans) == 0:
+            # no-image marker: (1, 1) instead of one (num_width_tiles, num_height_tiles) row per image
+            images_spatial_crop = host_tensor([[0]])
         else:
-            pixel_values = torch.stack(images_list, dim=0)
-            images_spatial_crop = torch.tensor(images_spatial_crop, dtype=torch.long)
-            if images_crop_list:
-                images_crop = torch.stack(images_crop_list, dim=0).unsqueeze(0)
-            else:
-                images_crop = torch.zeros((1, 3, self.image_size, self.image_size)).unsqueeze(0)
+            images_spatial_crop = host_tensor([plan.crop_ratio for plan in plans])
+
+        # one (n_tiles, 3, S, S) stack per image, tiles in row-major order; images without local views
+        # (and the no-image placeholder) get a single zero tile
+        placeholder = torch.zeros((1, 3, self.image_size, self.image_size), dtype=self.pixel_dtype, device=device)
+        tile_counts = [plan.crop_ratio[0] * plan.crop_ratio[1] if plan.has_tiles else 0 for plan in plans]
+        stacks = iter(torch.split(images_crop, [count for count in tile_counts if count]) if images_crop is not None else ())
+        images_crop = [next(stacks) if count else placeholder for count in tile_counts] or [placeholder]
 
         input_ids = input_ids.unsqueeze(0)
 
-        
-        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes]]
+        # (n_images,) cache keys, kept on the host so the model reads them without a device sync
+        image_hashes = host_tensor(list(image_hashes) if image_hashes else [0])
+
+        return [[input_ids, pixel_values, images_crop, images_seq_mask, images_spatial_crop, num_image_tokens, image_shapes,
+                 image_hashes]]
 
 
 AutoProcessor.register("DeepseekVLV2Processor", DeepseekOCRProcessor)
\ No newline at end of file
@@ -0,0 +1,234 @@
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+
+
+class SequenceSlots:
+    """Row assignment for per-sequence state kept in preallocated tensors.
+
+    Each sequence id gets a row and a count of the tokens its row has seen.
+    Rows of sequences missing from a step are recycled once no row is free;
+    otherwise grow(capacity) is called so the owner can enlarge its tensors.
+    """
+
+    def __init__(self, grow: Callable[[int], None]):
+        self._grow = grow
+        self.capacity = 0
+        self._slots: Dict[int, int] = {}
+        self._seen: Dict[int, int] = {}
+        self._free: List[int] = []
+
+    def lookup(self, seq_id: int, length: int, active: Set[int]) -> Tuple[int, int]:
+        """(row, tokens already seen) for a sequence of this length; 0 seen for a new or reset row"""
+        if seq_id in self._slots and self._seen[seq_id] <= length:
+            return self._slots[seq_id], self._seen[seq_id]
+        if seq_id in self._slots:
+            self._free.append(self._slots.pop(seq_id))
+        if not self._free:
+            # sequences missing from this step have finished (or are preempted and get refilled on return)
+            for stale in [s for s in self._slots if s not in active]:
+                self._free.append(self._slots.pop(stale))
+                del self._seen[stale]
+        if not self._free:
+            capacity = self.capacity
+            self.capacity = max(2 * capacity, 64)
+            self._grow(self.capacity)
+            self._free.extend(range(self.capacity - 1, capacity - 1, -1))
+        self._slots[seq_id] = self._free.pop()
+        self._seen[seq_id] = 0
+        return self._slots[seq_id], 0
+
+    def seen(self, seq_id: int, length: int):
+        self._seen[seq_id] = length
+
+    def clear(self):
+        """Forget every sequence; all rows become free"""
+        self._slots.clear()
+        self._seen.clear()
+        self._free = list(range(self.capacity - 1, -1, -1))
+
+
+class BatchedLogitsProcessor:
+    """A logits processor DeepseekOCRForCausalLM.compute_logits applies to the whole batch at once.
+
+    Subclasses keep the per-sequence __call__(output_ids, logits) of a regular
+    vLLM logits processor, used wherever the batched hook is not in place.
+    """
+
+    def apply_batch(self, logits: torch.Tensor, row_indices: Sequence[int], seq_ids: Sequence[int],
+                    output_token_ids: Sequence[Sequence[int]]) -> torch.Tensor:
+        raise NotImplementedError
+
+    def reset(self):
+        """Forget per-sequence state, so the next apply_batch rebuilds it from the sequences' tokens"""
+        raise NotImplementedError
+
+
+def grow_rows(tensor: Optional[torch.Tensor], capacity: int, shape: Tuple[int, ...], dtype, device) -> torch.Tensor:
+    """tensor with capacity rows of the given shape, keeping its existing rows"""
+    grown = torch.zeros((capacity,) + tuple(shape), dtype=dtype, device=device)
+    if tensor is not None:
+        grown[:tensor.shape[0]] = tensor
+    return grown
+
+
+class NoRepeatNGramLogitsProcessor(BatchedLogitsProcessor):
+    """Ban any token that would repeat an n-gram already seen in the last window_size output tokens.
+
+    Tokens in whitelist_token_ids (e.g. <td>, </td>) are never banned. Called
+    per sequence it behaves like a regular vLLM logits processor. Inside
+    DeepseekOCRForCausalLM.compute_logits it is taken out of vLLM's per-row loop
+    and applied to the whole batch at once (see batched_logits_processors), with
+    the last window_size tokens of each sequence kept in a preallocated ring
+    buffer that only receives the newly generated tokens each step.
+    """
+
+    def __init__(self, ngram_size: int, window_size: int = 100, whitelist_token_ids: Optional[Set[int]] = None):
+        self.ngram_size = ngram_size
+        self.window_size = window_size
+        self.whitelist_token_ids = set(whitelist_token_ids or ())
+        self._whitelist = {}
+
+        # rolling state of the batched path: one ring buffer row per sequence
+        self._buffer = None
+        self._device = None
+        self._slots = SequenceSlots(self._grow)
+
+    def __call__(self, input_ids: List[int], scores: torch.FloatTensor) -> torch.FloatTensor:
+        if len(input_ids) < self.ngram_size:
+            return scores
+        history = torch.tensor([list(input_ids[-self.window_size:])], dtype=torch.long, device=scores.device)
+        lengths = torch.tensor([len(input_ids)], device=scores.device)
+        _, tokens = self.banned_tokens(history, lengths)
+        if tokens.numel():
+            scores = scores.clone()
+            scores[tokens] = -float("inf")
+        return scores
+
+    def banned_tokens(self, history: torch.Tensor, lengths: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """(row, token) pairs to ban, for the last window_size tokens of each row and each row's full length.
+
+        history is (rows, window_size) with the newest token last; positions
+        before the start of a shorter sequence may hold anything.
+        """
+        n, window = self.ngram_size, history.shape[1]
+        num_starts = window - n + 1
+        if num_starts <= 0:
+            empty = history.new_zeros(0)
+            return empty, empty
+
+        prefix = history[:, num_starts:]
+        ngrams = history.unfold(1, n - 1, 1)[:, :num_starts] if n > 1 else history[:, :num_starts, None][..., :0]
+        match = (ngrams == prefix[:, None]).all(dim=-1)
+        # an n-gram may only start inside the sequence, and nothing is banned before n tokens exist
+        starts = torch.arange(num_starts, device=history.device)
+        match &= (starts[None] >= (window - lengths)[:, None]) & (lengths >= n)[:, None]
+
+        rows, cols = match.nonzero(as_tuple=True)
+        tokens = history[rows, cols + n - 1]
+        if self.whitelist_token_ids:
+            keep = ~torch.isin(tokens, self._whitelist_tensor(tokens.device))
+            rows, tokens = rows[keep], tokens[keep]
+        return rows, tokens
+
+    def apply_batch(self, logits: torch.Tensor, row_indices: Sequence[int], seq_ids: Sequence[int],
+                    output_token_ids: Sequence[Sequence[int]]) -> torch.Tensor:
+        """Ban repeated n-grams for every listed logits row in one pass"""
+        if not row_indices:
+            return logits
+        history, lengths = self._update_history(seq_ids, output_token_ids, logits.device)
+        rows, tokens = self.banned_tokens(history, lengths)
+        if tokens.numel():
+            row_indices = torch.tensor(row_indices, device=logits.device)
+            logits[row_indices[rows], tokens] = -float("inf")
+        return logits
+
+    def reset(self):
+        self._slots.clear()
+
+    def _whitelist_tensor(self, device) -> torch.Tensor:
+        if device not in self._whitelist:
+            self._whitelist[device] = torch.tensor(sorted(self.whitelist_token_ids), dtype=torch.long, device=device)
+        return self._whitelist[device]
+
+    def _grow(self, capacity: int):
+        self._buffer = grow_rows(self._buffer, capacity, (self.window_size,), torch.long, self._device)
+
+    def _update_history(self, seq_ids: Sequence[int], output_token_ids: Sequence[Sequence[int]], device):
+        """Write each sequence's new tokens into its ring buffer row; returns (history, lengths) in row order"""
+        window = self.window_size
+        self._device = device
+        active = set(seq_ids)
+        row_slots, slots, positions, tokens, lengths = [], [], [], [], []
+        for seq_id, ids in zip(seq_ids, output_token_ids):
+            length = len(ids)
+            slot, seen = self._slots.lookup(seq_id, length, active)
+            for position in range(max(seen, length - window), length):
+                slots.append(slot)
+                positions.append(position % window)
+                tokens.append(ids[position])
+            self._slots.seen(seq_id, length)
+            row_slots.append(slot)
+            lengths.append(length)
+
+        if tokens:
+            self._buffer[torch.tensor(slots, device=device), torch.tensor(positions, device=device)] = \
+                torch.tensor(tokens, dtype=torch.long, device=device)
+
+        slot_index = torch.tensor(row_slots, device=device)
+        lengths = torch.tensor(lengths, device=device)
+        # oldest-to-newest view of each ring: position (length - window + k) mod window
+        order = (lengths[:, None] - window + torch.arange(window, device=device)[None]) % window
+        return self._buffer[slot_index[:, None], order], lengths
+
+
+def output_tokens(seq_data) -> Sequence[int]:
+    """A sequence's output token ids without copying them (vLLM's output_token_ids property builds a tuple)"""
+    return getattr(seq_data, 'output_token_ids_array', None) or seq_data.output_token_ids
+
+
+@contextmanager
+def batched_logits_processors(sampling_metadata, incremental: bool = True):
+    """Take BatchedLogitsProcessors out of vLLM's per-row processor loop for one step.
+
+    Yields a function that applies them to the computed logits, one batched
+    pass per processor instance, in the order they appear in the requests'
+    lists. The requests' processor lists are restored on exit. With
+    incremental=False the processors are reset first, for batches whose
+    sequence ids do not identify the same sequence from step to step.
+    """
+    rows: Dict[BatchedLogitsProcessor, Tuple[List[int], List[int], List[Sequence[int]]]] = {}
+    # requests may share one SamplingParams, so every list is read before any is replaced
+    original = {}
+    seq_groups = sampling_metadata.seq_groups if sampling_metadata is not None else None
+    for seq_group in seq_groups or ():
+        params = seq_group.sampling_params
+        processors = original.setdefault(id(params), (params, params.logits_processors or []))[1]
+        batched = [p for p in processors if isinstance(p, BatchedLogitsProcessor)]
+        for processor in batched:
+            row_indices, seq_ids, output_token_ids = rows.setdefault(processor, ([], [], []))
+            for seq_id, row_index in zip(seq_group.seq_ids, seq_group.sample_indices):
+                row_indices.append(row_index)
+                seq_ids.append(seq_id)
+                output_token_ids.append(output_tokens(seq_group.seq_data[seq_id]))
+
+    restore = [(params, processors) for params, processors in original.values()
+               if any(isinstance(p, BatchedLogitsProcessor) for p in processors)]
+    for params, processors in restore:
+        params.logits_processors = [p for p in processors if not isinstance(p, BatchedLogitsProcessor)]
+
+    def apply(logits: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        if logits is None:
+            return logits
+        for processor, (row_indices, seq_ids, output_token_ids) in rows.items():
+            if not incremental:
+                processor.reset()
+            logits = processor.apply_batch(logits, row_indices, seq_ids, output_token_ids)
+        return logits
+
+    try:
+        yield apply
+    finally:
+        for params, processors in restore:
+            params.logits_processors = processors
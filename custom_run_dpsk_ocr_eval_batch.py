@@ -18,7 +18,8 @@ from vllm.model_executor.models.registry import ModelRegistry
 
 from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import DeepseekOCRProcessor, decode_image
+from grounding import postprocess
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
 
@@ -51,34 +52,6 @@ class Colors:
     BLUE = '\033[34m'
     RESET = '\033[0m' 
 
-def clean_formula(text):
-
-    formula_pattern = r'\\\[(.*?)\\\]'
-    
-    def process_formula(match):
-        formula = match.group(1)
-
-        formula = re.sub(r'\\quad\s*\([^)]*\)', '', formula)
-        
-        formula = formula.strip()
-        
-        return r'\[' + formula + r'\]'
-
-    cleaned_text = re.sub(formula_pattern, process_formula, text)
-    
-    return cleaned_text
-
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    # mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        mathes_other.append(a_match[0])
-    return matches, mathes_other
-
 def process_single_image(image, prompt):
     """single image"""
     prompt_in = prompt
@@ -90,6 +63,8 @@ def process_single_image(image, prompt):
 
 
 def main():
+    global INPUT_PATH, OUTPUT_PATH
+
     parser = argparse.ArgumentParser(description='Process batch of images with DeepSeek OCR using custom prompt')
     parser.add_argument('--prompt', type=str, help='Custom prompt to use for OCR (overrides default from config)')
     parser.add_argument('--input', type=str, default=INPUT_PATH, help='Input directory path containing images')
@@ -104,10 +79,8 @@ def main():
     
     # Set paths from arguments if provided
     if args.input:
-        global INPUT_PATH
         INPUT_PATH = args.input
     if args.output:
-        global OUTPUT_PATH
         OUTPUT_PATH = args.output
 
     # INPUT_PATH = OmniDocBench images path
@@ -123,7 +96,7 @@ def main():
     images = []
 
     for image_path in images_path:
-        image = Image.open(image_path).convert('RGB')
+        image = decode_image(image_path, cropping=CROP_MODE)
         images.append(image)
 
     # batch_inputs = []
@@ -168,10 +141,8 @@ def main():
         with open(mmd_det_path, 'w', encoding = 'utf-8') as afile:
             afile.write(content)
 
-        content = clean_formula(content)
-        matches_ref, mathes_other = re_match(content)
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            content = content.replace(a_match_other, '').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n').replace('<center>', '').replace('</center>', '')
+        # formula tags, refs, <center> tags and blank lines, in one pass
+        content = postprocess(content, formulas=True, colon_eqq=False, strip_center=True)
         
         mmd_path = output_path + image.split('/')[-1].replace('.jpg', '.md')
 
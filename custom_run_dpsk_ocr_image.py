@@ -20,6 +20,7 @@ import numpy as np
 from tqdm import tqdm
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
+from grounding import find_refs, page_boxes, postprocess
 from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE
 
 
@@ -43,34 +44,6 @@ def load_image(image_path):
             return None
 
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
-
-
 def draw_bounding_boxes(image, refs):
 
     image_width, image_height = image.size
@@ -85,24 +58,18 @@ def draw_bounding_boxes(image, refs):
 
     img_idx = 0
     
-    for i, ref in enumerate(refs):
+    # pixel boxes of every ref, read without eval and scaled in one operation; None for malformed ones
+    for result in page_boxes(refs, image_width, image_height):
         try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
             if result:
                 label_type, points_list = result
                 
                 color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
 
                 color_a = color + (20, )
-                for points in points_list:
+                for points in points_list.tolist():
                     x1, y1, x2, y2 = points
 
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
                     if label_type == 'image':
                         try:
                             cropped = image.crop((x1, y1, x2, y2))
@@ -203,6 +170,8 @@ async def stream_generate(image=None, prompt=''):
 
 
 def main():
+    global INPUT_PATH, OUTPUT_PATH
+
     parser = argparse.ArgumentParser(description='Process image with DeepSeek OCR using custom prompt')
     parser.add_argument('--prompt', type=str, help='Custom prompt to use for OCR (overrides default from config)')
     parser.add_argument('--input', type=str, default=INPUT_PATH, help='Input image file path')
@@ -217,10 +186,8 @@ def main():
     
     # Set paths from arguments if provided
     if args.input:
-        global INPUT_PATH
         INPUT_PATH = args.input
     if args.output:
-        global OUTPUT_PATH
         OUTPUT_PATH = args.output
 
     os.makedirs(OUTPUT_PATH, exist_ok=True)
@@ -250,16 +217,13 @@ def main():
         with open(f'{OUTPUT_PATH}/result_ori.mmd', 'w', encoding = 'utf-8') as afile:
             afile.write(outputs)
 
-        matches_ref, matches_images, mathes_other = re_match(outputs)
+        matches_ref = find_refs(outputs)
         # print(matches_ref)
         result = process_image_with_refs(image_draw, matches_ref)
 
 
-        for idx, a_match_image in enumerate(tqdm(matches_images, desc="image")):
-            outputs = outputs.replace(a_match_image, f'![](images/' + str(idx) + '.jpg)\n')
-
-        for idx, a_match_other in enumerate(tqdm(mathes_other, desc="other")):
-            outputs = outputs.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:')
+        # image refs to links, other refs dropped and := fixes, in one pass
+        outputs = postprocess(outputs, image_link=lambda idx, det: f'![](images/{idx}.jpg)\n', collapse_newlines=False)
 
         # if 'structural formula' in conversation[0]['content']:
         #     outputs = '<smiles>' + outputs + '</smiles>'
@@ -4,6 +4,7 @@ import img2pdf
 import io
 import re
 import argparse
+import json
 from tqdm import tqdm
 import torch
 from concurrent.futures import ThreadPoolExecutor
@@ -15,7 +16,7 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 
-from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE
+from config import MODEL_PATH, INPUT_PATH, OUTPUT_PATH, PROMPT, SKIP_REPEAT, MAX_CONCURRENCY, NUM_WORKERS, CROP_MODE, MAX_IMAGE_PIXELS, MAX_TOKENS, ADAPTIVE_MAX_TOKENS, LOOP_ABORT, SPECULATIVE_NGRAM, CASCADE
 
 from PIL import Image, ImageDraw, ImageFont
 import numpy as np
@@ -26,6 +27,12 @@ from vllm.model_executor.models.registry import ModelRegistry
 from vllm import LLM, SamplingParams
 from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
 from process.image_process import DeepseekOCRProcessor
+from token_budget import TEXT_CHARS_KEY, page_token_budget
+from loop_guard import LoopAbortLogitsProcessor, loop_at_end, strip_eos
+from prompt_lookup import DocumentContext, speculative_config, with_document
+from grounding import find_refs, page_boxes, postprocess
+from page_retry import Fallback, fallback_request, fallback_sampling_params, retry_fallbacks
+from quality_cascade import cheap_pass, completion_signals, escalation_reasons
 
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
@@ -41,19 +48,29 @@ llm = LLM(
     max_num_seqs=MAX_CONCURRENCY,
     tensor_parallel_size=1,
     gpu_memory_utilization=0.9,
-    disable_mm_preprocessor_cache=True
+    disable_mm_preprocessor_cache=True,
+    speculative_config=speculative_config()
 )
 
 logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids= {128821, 128822})] #window for fast；whitelist_token_ids: <td>,</td>
+tokenizer = llm.get_tokenizer()
+if LOOP_ABORT and not SPECULATIVE_NGRAM:
+    logits_processors.append(LoopAbortLogitsProcessor(eos_token_id=tokenizer.eos_token_id))
 
 sampling_params = SamplingParams(
     temperature=0.0,
-    max_tokens=8192,
+    max_tokens=MAX_TOKENS,
+    logprobs=0 if CASCADE else None, # the sampled token's log-probability, for the cascade's mean logprob
     logits_processors=logits_processors,
     skip_special_tokens=False,
     include_stop_str_in_output=True,
 )
 
+# second, third, ... attempt for pages that end without EOS
+fallbacks = retry_fallbacks()
+# first pass of every page with CASCADE; the others only re-run at the configured mode if it falls short
+first_pass = cheap_pass() if CASCADE else Fallback()
+
 
 class Colors:
     RED = '\033[31m'
@@ -77,7 +94,8 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
         page = pdf_document[page_num]
 
         pixmap = page.get_pixmap(matrix=matrix, alpha=False)
-        Image.MAX_IMAGE_PIXELS = None
+        Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+        text_chars = len(page.get_text().strip())
 
         if image_format.upper() == "PNG":
             img_data = pixmap.tobytes("png")
@@ -90,6 +108,7 @@ def pdf_to_images_high_quality(pdf_path, dpi=144, image_format="PNG"):
                 background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
                 img = background
         
+        img.info[TEXT_CHARS_KEY] = text_chars
         images.append(img)
     
     pdf_document.close()
@@ -121,34 +140,6 @@ def pil_to_pdf_img2pdf(pil_images, output_path):
 
 
 
-def re_match(text):
-    pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-    matches = re.findall(pattern, text, re.DOTALL)
-
-
-    mathes_image = []
-    mathes_other = []
-    for a_match in matches:
-        if '<|ref|>image<|/ref|>' in a_match[0]:
-            mathes_image.append(a_match[0])
-        else:
-            mathes_other.append(a_match[0])
-    return matches, mathes_image, mathes_other
-
-
-def extract_coordinates_and_label(ref_text, image_width, image_height):
-
-
-    try:
-        label_type = ref_text[1]
-        cor_list = eval(ref_text[2])
-    except Exception as e:
-        print(e)
-        return None
-
-    return (label_type, cor_list)
-
-
 def draw_bounding_boxes(image, refs, jdx):
 
     image_width, image_height = image.size
@@ -163,24 +154,18 @@ def draw_bounding_boxes(image, refs, jdx):
 
     img_idx = 0
     
-    for i, ref in enumerate(refs):
+    # pixel boxes of every ref, read without eval and scaled in one operation; None for malformed ones
+    for result in page_boxes(refs, image_width, image_height):
         try:
-            result = extract_coordinates_and_label(ref, image_width, image_height)
             if result:
                 label_type, points_list = result
                 
                 color = (np.random.randint(0, 200), np.random.randint(0, 200), np.random.randint(0, 255))
 
                 color_a = color + (20, )
-                for points in points_list:
+                for points in points_list.tolist():
                     x1, y1, x2, y2 = points
 
-                    x1 = int(x1 / 999 * image_width)
-                    y1 = int(y1 / 999 * image_height)
-
-                    x2 = int(x2 / 999 * image_width)
-                    y2 = int(y2 / 999 * image_height)
-
                     if label_type == 'image':
                         try:
                             cropped = image.crop((x1, y1, x2, y2))
@@ -221,6 +206,49 @@ def process_image_with_refs(image, ref_texts, jdx):
     return result_image
 
 
+def page_content(output, page_idx, document=None, max_tokens=MAX_TOKENS):
+    """(content, status) of a page's output run with max_tokens.
+
+    status is 'eos', 'loop' (content is the text before the loop), 'budget'
+    (no EOS within its ADAPTIVE_MAX_TOKENS estimate, re-run with MAX_TOKENS)
+    or 'length' (no EOS within MAX_TOKENS).
+    """
+    content = output.outputs[0].text
+    status = 'eos' if '<｜end▁of▁sentence｜>' in content else 'budget' if max_tokens < MAX_TOKENS else 'length'
+
+    if output.outputs[0].finish_reason == 'length':
+        print(f'{Colors.YELLOW}page {page_idx + 1}: reached its max_tokens ({max_tokens}) without EOS{Colors.RESET}')
+
+    speculation = document.speculation(output) if document is not None else None
+    if speculation is not None:
+        print(f'page {page_idx + 1}: {speculation.acceptance_rate:.0%} of {speculation.proposed} draft tokens accepted, '
+              f'{speculation.tokens_per_pass:.2f} tokens/pass, {speculation.tokens_per_second or 0:.1f} tokens/s')
+
+    if LOOP_ABORT:
+        token_ids = output.outputs[0].token_ids
+        loop = loop_at_end(strip_eos(token_ids, tokenizer.eos_token_id))
+        if loop is not None:
+            # keep the page up to its repetition loop instead of the loop itself (or nothing, with SKIP_REPEAT)
+            print(f'{Colors.YELLOW}page {page_idx + 1}: repetition loop, kept {loop.salvaged} of {len(token_ids)} tokens{Colors.RESET}')
+            content = tokenizer.decode(token_ids[:loop.salvaged])
+            status = 'loop'
+
+    return content, status
+
+
+def rerun_budget_pages(page_indices, pages, outputs, inputs, document=None):
+    """Re-run the listed pages that ran out of their estimated budget with MAX_TOKENS, all together, from the same inputs (mode)"""
+    rerun = [page_idx for page_idx in page_indices if pages[page_idx][1] == 'budget']
+    if not rerun:
+        return
+    print(f'{Colors.BLUE}re-running {len(rerun)} pages that used up their token budget with max_tokens={MAX_TOKENS}{Colors.RESET}')
+    params = [with_document(sampling_params, document, page_idx) if document is not None else sampling_params
+              for page_idx in rerun]
+    for page_idx, output in zip(rerun, llm.generate([inputs[page_idx] for page_idx in rerun], sampling_params=params)):
+        outputs[page_idx] = output
+        pages[page_idx] = page_content(output, page_idx, document)
+
+
 def process_single_image(image, prompt):
     """single image"""
     prompt_in = prompt
@@ -232,6 +260,8 @@ def process_single_image(image, prompt):
 
 
 def main():
+    global INPUT_PATH, OUTPUT_PATH
+
     parser = argparse.ArgumentParser(description='Process PDF with DeepSeek OCR using custom prompt')
     parser.add_argument('--prompt', type=str, help='Custom prompt to use for OCR (overrides default from config)')
     parser.add_argument('--input', type=str, default=INPUT_PATH, help='Input PDF file path')
@@ -246,10 +276,8 @@ def main():
     
     # Set paths from arguments if provided
     if args.input:
-        global INPUT_PATH
         INPUT_PATH = args.input
     if args.output:
-        global OUTPUT_PATH
         OUTPUT_PATH = args.output
 
     os.makedirs(OUTPUT_PATH, exist_ok=True)
@@ -263,7 +291,7 @@ def main():
 
     with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:  
         batch_inputs = list(tqdm(
-            executor.map(lambda img: process_single_image(img, prompt), images),
+            executor.map(lambda img: fallback_request(img, prompt, first_pass) if CASCADE else process_single_image(img, prompt), images),
             total=len(images),
             desc="Pre-processed images"
         ))
@@ -281,10 +309,79 @@ def main():
     #     batch_inputs.extend(cache_list)
 
 
+    # per-page max_tokens: every page keeps its own budget instead of MAX_TOKENS for all
+    page_sampling_params = sampling_params
+    if ADAPTIVE_MAX_TOKENS:
+        page_sampling_params = []
+        for img in images:
+            params = sampling_params.clone()
+            params.max_tokens = page_token_budget(img, prompt)
+            page_sampling_params.append(params)
+
+    # speculative drafts for a page may come from the pages before it
+    document = None
+    if SPECULATIVE_NGRAM:
+        document = DocumentContext()
+        if not isinstance(page_sampling_params, list):
+            page_sampling_params = [page_sampling_params] * len(images)
+        page_sampling_params = [with_document(params, document, page_idx)
+                                for page_idx, params in enumerate(page_sampling_params)]
+
     outputs_list = llm.generate(
         batch_inputs,
-        sampling_params=sampling_params
+        sampling_params=page_sampling_params
     )
+    budgets = [params.max_tokens for params in page_sampling_params] if isinstance(page_sampling_params, list) \
+        else [page_sampling_params.max_tokens] * len(images)
+    pages = [page_content(output, page_idx, document, budgets[page_idx]) for page_idx, output in enumerate(outputs_list)]
+    attempts = [1] * len(pages)
+    modes = [first_pass.name] * len(pages)
+    # a page short of its estimated budget gets MAX_TOKENS at the same mode before any escalation or fallback
+    rerun_budget_pages(range(len(pages)), pages, outputs_list, batch_inputs, document)
+
+    # cascade: re-run the pages whose cheap first pass falls short at the configured mode, all together
+    if CASCADE:
+        escalate = []
+        for page_idx, (output, (_, status)) in enumerate(zip(outputs_list, pages)):
+            signals = completion_signals(output.outputs[0], status == 'eos', tokenizer.eos_token_id, images[page_idx], prompt)
+            reasons = escalation_reasons(signals)
+            if reasons:
+                print(f'{Colors.YELLOW}page {page_idx + 1}: escalated from {first_pass.name}: {", ".join(reasons)}{Colors.RESET}')
+                escalate.append(page_idx)
+        print(f'{Colors.BLUE}cascade: {len(pages) - len(escalate)} of {len(pages)} pages kept at {first_pass.name}{Colors.RESET}')
+        if escalate:
+            expensive = Fallback()
+            with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+                escalate_inputs = list(executor.map(lambda page_idx: process_single_image(images[page_idx], prompt), escalate))
+            escalate_params = [page_sampling_params[page_idx] if isinstance(page_sampling_params, list) else page_sampling_params
+                               for page_idx in escalate]
+            escalated_outputs = dict(zip(escalate, llm.generate(escalate_inputs, sampling_params=escalate_params)))
+            escalated = {page_idx: page_content(output, page_idx, document, budgets[page_idx])
+                         for page_idx, output in escalated_outputs.items()}
+            rerun_budget_pages(escalate, escalated, escalated_outputs, dict(zip(escalate, escalate_inputs)), document)
+            for page_idx, (content, status) in escalated.items():
+                # the expensive mode is the reference, unless it runs on where the cheap pass terminated
+                if status == 'eos' or pages[page_idx][1] != 'eos':
+                    pages[page_idx] = (content, status)
+                    modes[page_idx] = expensive.name
+
+    # re-run only the pages that did not terminate, all together, with each fallback in turn
+    for attempt, fallback in enumerate(fallbacks, start=2):
+        retry = [page_idx for page_idx, (_, status) in enumerate(pages) if status != 'eos']
+        if not retry:
+            break
+        print(f'{Colors.BLUE}attempt {attempt}: re-running {len(retry)} pages ({fallback.describe()}){Colors.RESET}')
+        with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+            retry_inputs = list(executor.map(lambda page_idx: fallback_request(images[page_idx], prompt, fallback), retry))
+        params = fallback_sampling_params(sampling_params, fallback)
+        retry_params = [with_document(params, document, page_idx) if document is not None else params for page_idx in retry]
+        for page_idx, output in zip(retry, llm.generate(retry_inputs, sampling_params=retry_params)):
+            content, status = page_content(output, page_idx, document)
+            if status == 'eos':
+                pages[page_idx] = (content, status)
+                attempts[page_idx] = attempt
+                modes[page_idx] = fallback.name
+        print(f'{Colors.BLUE}attempt {attempt}: {sum(attempts[page_idx] == attempt for page_idx in retry)} of {len(retry)} pages terminated{Colors.RESET}')
 
 
     output_path = OUTPUT_PATH
@@ -295,14 +392,13 @@ def main():
     mmd_det_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_det.mmd')
     mmd_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('pdf', 'mmd')
     pdf_out_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_layouts.pdf')
+    pages_path = output_path + '/' + INPUT_PATH.split('/')[-1].replace('.pdf', '_pages.json')
     contents_det = ''
     contents = ''
     draw_images = []
     jdx = 0
-    for output, img in zip(outputs_list, images):
-        content = output.outputs[0].text
-
-        if '<｜end▁of▁sentence｜>' in content: # repeat no eos
+    for page_idx, ((content, status), img) in enumerate(zip(pages, images)):
+        if status != 'length': # repeat no eos
             content = content.replace('<｜end▁of▁sentence｜>', '')
         else:
             if SKIP_REPEAT:
@@ -315,7 +411,7 @@ def main():
 
         image_draw = img.copy()
 
-        matches_ref, matches_images, mathes_other = re_match(content)
+        matches_ref = find_refs(content)
         # print(matches_ref)
         result_image = process_image_with_refs(image_draw, matches_ref, jdx)
 
@@ -323,11 +419,8 @@ def main():
         draw_images.append(result_image)
 
 
-        for idx, a_match_image in enumerate(matches_images):
-            content = content.replace(a_match_image, f'![](images/' + str(jdx) + '_' + str(idx) + '.jpg)\n')
-
-        for idx, a_match_other in enumerate(mathes_other):
-            content = content.replace(a_match_other, '').replace('\\coloneqq', ':=').replace('\\eqqcolon', '=:').replace('\n\n\n\n', '\n\n').replace('\n\n\n', '\n\n')
+        # image refs to links, other refs dropped, := fixes and blank lines, in one pass
+        content = postprocess(content, image_link=lambda idx, det: f'![](images/{jdx}_{idx}.jpg)\n')
 
 
         contents += content + f'\n{page_num}\n'
@@ -341,6 +434,12 @@ def main():
     with open(mmd_path, 'w', encoding='utf-8') as afile:
         afile.write(contents)
 
+    # which attempt and resolution mode produced each page (1: first run, n: RETRY_FALLBACKS[n - 2]) and how it ended
+    with open(pages_path, 'w', encoding='utf-8') as afile:
+        json.dump([{'page': page_idx + 1, 'attempt': attempts[page_idx], 'mode': modes[page_idx], 'status': status,
+                    'skipped': status == 'length' and SKIP_REPEAT}
+                   for page_idx, (_, status) in enumerate(pages)], afile, indent=2)
+
 
     pil_to_pdf_img2pdf(draw_images, pdf_out_path)
 
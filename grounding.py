@@ -0,0 +1,149 @@
+"""
+Single-pass post-processing of grounded OCR output
+
+Grounded output wraps every block in <|ref|>label<|/ref|><|det|>[[x1, y1, x2,
+y2], ...]<|/det|> tags. Turning it into markdown used to take one
+str.replace over the whole page per tag, plus chained replaces for LaTeX
+fixes and blank lines, which is quadratic in tags x page length.
+postprocess() does all of it with one compiled regex and one re.sub
+callback: image refs become markdown links, other refs are dropped,
+\\coloneqq/\\eqqcolon and \\[...\\] formulas are fixed, <center> tags are
+stripped and runs of three or more newlines, including the ones that only
+form once a tag between them is dropped, collapse to a blank line.
+
+The det payloads ([[x1, y1, x2, y2], ...] in 0-999 page coordinates) were
+read with eval(), which is slow and runs whatever the model wrote.
+parse_det() checks a payload against a strict pattern and reads it straight
+into a NumPy array, and page_boxes() scales the boxes of every ref of a page
+to pixels in one operation.
+
+Standard library and NumPy only, so the host-side pdf_to_* clients can use it too.
+"""
+
+import functools
+import re
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+REF_PATTERN = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
+REF_RE = re.compile(REF_PATTERN, re.DOTALL)
+
+COLONS = {'\\coloneqq': ':=', '\\eqqcolon': '=:'}
+QUAD_TAG_RE = re.compile(r'\\quad\s*\([^)]*\)')
+
+# det payloads: a list of boxes of four numbers; the pattern has one way to match, so it runs in linear time
+MAX_DET_CHARS = 16384  # longer payloads are rejected before matching
+_NUMBER = r'\s*-?\d+(?:\.\d*)?\s*'
+_BOX = r'\[' + _NUMBER + r'(?:,' + _NUMBER + r'){3}\]'
+DET_RE = re.compile(r'\s*\[\s*(?:' + _BOX + r'\s*(?:,\s*' + _BOX + r'\s*)*)?\]\s*')
+_BRACKETS = str.maketrans('', '', '[]')
+COORDINATE_SCALE = 999  # det coordinates run from 0 to 999 over the page
+
+
+def find_refs(text: str) -> List[Tuple[str, str, str]]:
+    """(tag, label, det payload) of every grounding ref, in order"""
+    return REF_RE.findall(text)
+
+
+@functools.lru_cache(maxsize=None)
+def _pattern(formulas: bool, colon_eqq: bool, collapse_newlines: bool, strip_center: bool):
+    parts = [r'(?P<ref><\|ref\|>(?P<label>(?s:.*?))<\|/ref\|><\|det\|>(?P<det>(?s:.*?))<\|/det\|>)']
+    if formulas:
+        parts.append(r'(?P<formula>\\\[(?P<body>.*?)\\\])')
+    if colon_eqq:
+        parts.append(r'(?P<colon>\\coloneqq|\\eqqcolon)')
+    if strip_center:
+        parts.append(r'(?P<center></?center>)')
+    if collapse_newlines:
+        # every run, so runs joined by a dropped tag are collapsed too
+        parts.append(r'(?P<newlines>\n+)')
+    return re.compile('|'.join(parts))
+
+
+def clean_formula(body: str) -> str:
+    """A \\[...\\] formula without its \\quad (n) equation tags"""
+    return QUAD_TAG_RE.sub('', body).strip()
+
+
+def postprocess(text: str, image_link: Optional[Callable[[int, str], str]] = None, formulas: bool = False,
+                colon_eqq: bool = True, collapse_newlines: bool = True, strip_center: bool = False) -> str:
+    """Markdown of a grounded OCR output, in one scan.
+
+    image_link(index, det) gives the replacement of the index-th image ref
+    (e.g. a markdown link, or '' when its crop failed); without it image refs
+    are dropped like the others. formulas strips \\quad (n) tags from \\[...\\]
+    blocks; colon_eqq writes \\coloneqq/\\eqqcolon as :=/=:; strip_center
+    removes <center> tags; collapse_newlines turns every run of three or more
+    newlines in the result into two.
+    """
+    pattern = _pattern(formulas, colon_eqq, collapse_newlines, strip_center)
+    images = 0
+    last_end = 0
+    trailing = 0  # newlines at the end of the output so far
+
+    def replace(match):
+        nonlocal images, last_end, trailing
+        if match.start() > last_end:
+            # unmatched text between two matches never holds a newline when they are collapsed
+            trailing = 0
+        last_end = match.end()
+        kind = match.lastgroup
+        if kind == 'newlines':
+            run = trailing + len(match.group())
+            emitted = max(0, (run if run < 3 else 2) - trailing)
+            trailing += emitted
+            return '\n' * emitted
+        if kind == 'ref':
+            if match.group('label') != 'image':
+                return ''
+            index = images
+            images += 1
+            replacement = image_link(index, match.group('det')) if image_link is not None else ''
+        elif kind == 'formula':
+            # a formula runs to the end of its line at most; tags inside it are processed like anywhere else
+            body = postprocess(clean_formula(match.group('body')), None, False, colon_eqq, False, strip_center)
+            replacement = '\\[' + body + '\\]'
+        elif kind == 'colon':
+            replacement = COLONS[match.group()]
+        else:
+            return ''
+        if replacement:
+            stripped = replacement.rstrip('\n')
+            trailing = len(replacement) - len(stripped) if stripped else trailing + len(replacement)
+        return replacement
+
+    return pattern.sub(replace, text)
+
+
+def parse_det(payload: str) -> np.ndarray:
+    """The boxes of a det payload as an (n, 4) float array of 0-999 coordinates; ValueError if it is not [[x1, y1, x2, y2], ...]"""
+    if len(payload) > MAX_DET_CHARS or DET_RE.fullmatch(payload) is None:
+        preview = payload if len(payload) <= 40 else payload[:40] + '...'
+        raise ValueError(f"malformed det payload {preview!r}")
+    numbers = payload.translate(_BRACKETS)
+    if not numbers.strip():
+        return np.empty((0, 4))
+    return np.array(numbers.split(','), dtype=np.float64).reshape(-1, 4)
+
+
+def scale_boxes(boxes: np.ndarray, width: int, height: int) -> np.ndarray:
+    """(n, 4) 0-999 boxes as integer pixel boxes of a width x height page, truncated like int()"""
+    return (boxes / COORDINATE_SCALE * np.array([width, height, width, height])).astype(np.int64)
+
+
+def page_boxes(refs: Sequence[Tuple[str, str, str]], width: int,
+               height: int) -> List[Optional[Tuple[str, np.ndarray]]]:
+    """(label, pixel boxes) of every find_refs() ref of a page, scaled in one operation; None for malformed payloads"""
+    parsed = []
+    for ref in refs:
+        try:
+            parsed.append(parse_det(ref[2]))
+        except ValueError:
+            parsed.append(None)
+    valid = [boxes for boxes in parsed if boxes is not None]
+    if not valid:
+        return [None] * len(refs)
+    scaled = np.split(scale_boxes(np.concatenate(valid), width, height), np.cumsum([len(b) for b in valid])[:-1])
+    scaled = iter(scaled)
+    return [None if boxes is None else (ref[1], next(scaled)) for ref, boxes in zip(refs, parsed)]
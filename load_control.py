@@ -0,0 +1,236 @@
+"""
+Load-adaptive quality for bulk pages
+
+Under peak load every page still gets the full resolution mode and MAX_CROPS
+tiles, so the queue grows until requests time out. LoadController watches the
+pages waiting for an answer and the p95 latency of recent requests, and moves
+bulk-lane pages down the LOAD_LEVELS ladder (fewer tiles, then cheaper modes)
+while either exceeds its limit, and back up once both are well within them:
+
+- step down when the queue exceeds LOAD_QUEUE_HIGH pages or the p95 latency
+  exceeds LOAD_LATENCY_SLO;
+- step up when the queue is below LOAD_QUEUE_LOW pages and the p95 latency is
+  below LOAD_RESTORE_FRACTION of the SLO;
+- at most one step per LOAD_HOLD_SECONDS, with the latency window cleared at
+  each step so the next decision only sees requests served at the new level.
+
+Interactive-lane pages are never degraded. LOAD_KEY_POLICIES sets, per API
+key, the default lane and the best (ceiling) and cheapest (floor) levels its
+pages may get.
+
+EngineWorker runs the server's requests off the event loop and feeds the
+generations they ask for into one engine loop on a thread of its own: new
+sequences join the running batch at the next engine step, so the pages of
+concurrent requests are decoded together, and every request is counted as
+queued from the moment it arrives.
+"""
+
+import asyncio
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+LANES = ('interactive', 'bulk')
+
+logger = logging.getLogger(__name__)
+
+
+class KeyPolicy(NamedTuple):
+    lane: Optional[str] = None  # lane of the key's requests that set none; None for the controller's default lane
+    ceiling: int = 0  # best LOAD_LEVELS index the key's pages get
+    floor: Optional[int] = None  # cheapest LOAD_LEVELS index the key's bulk pages may drop to; None for the last
+
+
+def key_policies(policies: dict, levels: int) -> dict:
+    """LOAD_KEY_POLICIES as KeyPolicies, checked at startup"""
+    parsed = {key: KeyPolicy(**policy) for key, policy in policies.items()}
+    for policy in parsed.values():
+        floor = levels - 1 if policy.floor is None else policy.floor
+        if policy.lane not in LANES + (None,) or not 0 <= policy.ceiling <= floor < levels:
+            raise ValueError(f"invalid LOAD_KEY_POLICIES entry {policy}: lane must be one of {LANES} "
+                             f"and 0 <= ceiling <= floor < {levels}")
+    return parsed
+
+
+class LoadController:
+    """Quality level of bulk pages, stepped with the queue depth and the p95 request latency.
+
+    levels are page_retry.Fallback entries (anything with describe()) and
+    policies a LOAD_KEY_POLICIES dict; load_controller() builds one from config.
+    """
+
+    def __init__(self, levels: Sequence, *, queue_high: int, queue_low: int, latency_slo: float,
+                 restore_fraction: float, window: int, hold_seconds: float, default_lane: str,
+                 policies: Optional[dict] = None):
+        if default_lane not in LANES:
+            raise ValueError(f"invalid LOAD_DEFAULT_LANE {default_lane!r}, expected one of {LANES}")
+        self.levels = levels
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.latency_slo = latency_slo
+        self.restore_fraction = restore_fraction
+        self.hold_seconds = hold_seconds
+        self.default_lane = default_lane
+        self.policies = key_policies(policies or {}, len(levels))
+
+        self.level = 0
+        self.queued = 0  # pages received and not yet answered
+        self._latencies = deque(maxlen=window)
+        self._changed = float('-inf')
+        self._steps = 0
+        self._lock = threading.Lock()
+
+    def latency(self) -> Optional[float]:
+        """p95 latency of the requests answered since the last level change"""
+        return float(np.percentile(self._latencies, 95)) if self._latencies else None
+
+    def admit(self, pages: int, now: Optional[float] = None) -> float:
+        """Count a request's pages as queued; returns its arrival time for finish()"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.queued += pages
+            self._update(now)
+        return now
+
+    def finish(self, pages: int, arrival: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self.queued -= pages
+            self._latencies.append(now - arrival)
+            self._update(now)
+
+    def _update(self, now: float):
+        if now - self._changed < self.hold_seconds:
+            return
+        latency = self.latency()
+        overloaded = self.queued > self.queue_high or (latency is not None and latency > self.latency_slo)
+        relaxed = self.queued < self.queue_low and (latency is None or latency < self.latency_slo * self.restore_fraction)
+        if overloaded and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif relaxed and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        logger.debug(f"Load control: {self.queued} pages queued, p95 latency {latency or 0:.1f}s, "
+              f"bulk pages now at level {self.level} ({self.levels[self.level].describe()})")
+        self._changed = now
+        self._steps += 1
+        self._latencies.clear()
+
+    def level_for(self, api_key: Optional[str] = None, lane: Optional[str] = None) -> int:
+        """LOAD_LEVELS index for a request's pages, within its key's ceiling and floor"""
+        policy = self.policies.get(api_key, KeyPolicy())
+        lane = lane or policy.lane or self.default_lane
+        if lane not in LANES:
+            raise ValueError(f"unknown lane {lane!r}, expected one of {LANES}")
+        floor = len(self.levels) - 1 if policy.floor is None else policy.floor
+        level = self.level if lane == 'bulk' else 0
+        return min(max(level, policy.ceiling), floor)
+
+    def quality_for(self, api_key: Optional[str] = None, lane: Optional[str] = None):
+        return self.levels[self.level_for(api_key, lane)]
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"level": self.level, "settings": self.levels[self.level].describe(), "queued_pages": self.queued,
+                    "p95_latency": self.latency(), "level_changes": self._steps}
+
+
+class EngineWorker:
+    """The server's requests, run on a pool of request threads and fed into one engine loop.
+
+    A request's call (page preparation, post-processing, retry passes) runs
+    on a request thread, off the event loop. Whenever it needs generations it
+    hands them to generate(), which queues them for the engine thread. That
+    thread is the only one touching the engine, which is not thread-safe: it
+    adds every queued request to the engine as soon as it arrives and steps
+    the engine while any is unfinished, so the pages of concurrent requests
+    share the running batch instead of waiting for each other's engine calls.
+    With a LoadController, a request's pages are admitted on arrival and
+    finished once its call returns, so the queue depth and the latency include
+    the wait.
+    """
+
+    def __init__(self, controller: Optional[LoadController] = None, workers: int = 8):
+        self.controller = controller
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='request')
+        self._submitted = queue.SimpleQueue()
+        self._request_ids = itertools.count()
+        self._engine = None
+
+    def start(self, engine):
+        """Run the engine loop over engine (vLLM's LLMEngine: add_request, step, abort_request)"""
+        self._engine = engine
+        threading.Thread(target=self._loop, name='engine', daemon=True).start()
+
+    async def run(self, pages: int, call: Callable[[], Any], received: Optional[float] = None) -> Any:
+        """Result of call() on a request thread; received is the request's arrival time, for its latency"""
+        loop = asyncio.get_running_loop()
+        if self.controller is None:
+            return await loop.run_in_executor(self._executor, call)
+        arrival = self.controller.admit(pages, received)
+        try:
+            return await loop.run_in_executor(self._executor, call)
+        finally:
+            self.controller.finish(pages, arrival)
+
+    def generate(self, requests: Sequence[Any], params: Sequence[Any]) -> List[Any]:
+        """Final RequestOutputs of the requests, in order, like LLM.generate; blocks the calling request thread"""
+        if self._engine is None:
+            raise RuntimeError("the engine loop has not been started")
+        futures = [Future() for _ in requests]
+        self._submitted.put(list(zip(requests, params, futures)))
+        return [future.result() for future in futures]
+
+    def _loop(self):
+        waiting: Dict[str, Future] = {}
+        while True:
+            # wait for work only while the engine is idle; otherwise take what arrived since the last step
+            submitted = [] if waiting else [self._submitted.get()]
+            while True:
+                try:
+                    submitted.append(self._submitted.get_nowait())
+                except queue.Empty:
+                    break
+            for request, params, future in itertools.chain.from_iterable(submitted):
+                request_id = str(next(self._request_ids))
+                try:
+                    self._engine.add_request(request_id, request, params)
+                except Exception as e:
+                    future.set_exception(e)
+                else:
+                    waiting[request_id] = future
+            if not waiting:
+                continue
+            try:
+                outputs = self._engine.step()
+            except Exception as e:
+                logger.error(f"Engine step failed, failing {len(waiting)} requests: {str(e)}")
+                for request_id, future in waiting.items():
+                    self._engine.abort_request(request_id)
+                    future.set_exception(e)
+                waiting.clear()
+                continue
+            for output in outputs:
+                if output.finished:
+                    waiting.pop(output.request_id).set_result(output)
+
+
+def load_controller() -> LoadController:
+    """LoadController over the LOAD_* settings, checked at startup"""
+    # imported here so that the controller itself does not need the model's configuration
+    from config import (LOAD_DEFAULT_LANE, LOAD_HOLD_SECONDS, LOAD_KEY_POLICIES, LOAD_LATENCY_SLO, LOAD_LATENCY_WINDOW,
+                        LOAD_LEVELS, LOAD_QUEUE_HIGH, LOAD_QUEUE_LOW, LOAD_RESTORE_FRACTION)
+    from page_retry import retry_fallbacks
+
+    return LoadController(retry_fallbacks(LOAD_LEVELS, 'LOAD_LEVELS'), queue_high=LOAD_QUEUE_HIGH,
+                          queue_low=LOAD_QUEUE_LOW, latency_slo=LOAD_LATENCY_SLO,
+                          restore_fraction=LOAD_RESTORE_FRACTION, window=LOAD_LATENCY_WINDOW,
+                          hold_seconds=LOAD_HOLD_SECONDS, default_lane=LOAD_DEFAULT_LANE, policies=LOAD_KEY_POLICIES)
@@ -0,0 +1,179 @@
+"""
+Repetition loop detection for OCR decoding
+
+A page loops when the model emits the same span of tokens over and over
+(repeated table rows, runs of <td></td>, the same paragraph) until max_tokens.
+For every period p up to max_period the detector counts how many consecutive
+positions t had token[t] == token[t - p]; a loop of period p is confirmed once
+that run reaches max(min_span, p * (min_repeats - 1)) tokens, i.e. the last
+copies of a p-token span repeat exactly over at least min_span tokens.
+
+LoopAbortLogitsProcessor runs the detector online and forces EOS as soon as a
+loop is confirmed. find_loop and loop_at_end apply the same test offline to
+recorded token ids, so the detector can be checked without a GPU.
+"""
+
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+import torch
+
+from config import LOOP_MAX_PERIOD, LOOP_MIN_REPEATS, LOOP_MIN_SPAN
+from process.ngram_norepeat import BatchedLogitsProcessor, SequenceSlots
+
+
+class Loop(NamedTuple):
+    start: int  # first token of the first copy of the repeated span
+    period: int
+    end: int  # token at which the loop was confirmed (or the last token)
+
+    @property
+    def salvaged(self) -> int:
+        """Number of tokens worth keeping: everything before the loop plus one copy of the repeated span"""
+        return self.start + self.period
+
+
+def loop_thresholds(max_period: int = LOOP_MAX_PERIOD, min_span: int = LOOP_MIN_SPAN,
+                    min_repeats: int = LOOP_MIN_REPEATS) -> np.ndarray:
+    """Run length that confirms a loop, for periods 1..max_period"""
+    periods = np.arange(1, max_period + 1)
+    return np.maximum(min_span, periods * (min_repeats - 1))
+
+
+def find_loop(token_ids: Sequence[int], max_period: int = LOOP_MAX_PERIOD, min_span: int = LOOP_MIN_SPAN,
+              min_repeats: int = LOOP_MIN_REPEATS) -> Optional[Loop]:
+    """The first loop the online detector confirms while token_ids are generated, if any"""
+    ids = np.asarray(token_ids, dtype=np.int64)
+    thresholds = loop_thresholds(max_period, min_span, min_repeats)
+    found = None
+    for period in range(1, min(max_period, len(ids) - 1) + 1):
+        threshold = int(thresholds[period - 1])
+        same = ids[period:] == ids[:-period]
+        if len(same) < threshold:
+            break
+        # windows of `threshold` consecutive matches; window k ends at token k + threshold - 1 + period
+        counts = np.concatenate(([0], np.cumsum(same)))
+        hits = np.flatnonzero(counts[threshold:] - counts[:-threshold] == threshold)
+        if hits.size:
+            end = int(hits[0]) + threshold - 1 + period
+            # strictly earlier only, so the smallest period wins a tie like it does online
+            if found is None or end < found.end:
+                found = Loop(end - threshold - period + 1, period, end)
+    return found
+
+
+def trailing_run(ids: np.ndarray, period: int) -> int:
+    """How many of the last tokens t satisfy ids[t] == ids[t - period]"""
+    mismatches = np.flatnonzero(ids[period:] != ids[:-period])
+    return len(ids) - period - (int(mismatches[-1]) + 1 if mismatches.size else 0)
+
+
+def trailing_runs(ids: np.ndarray, max_period: int) -> np.ndarray:
+    """trailing_run for periods 1..max_period"""
+    runs = np.zeros(max_period, dtype=np.int64)
+    for period in range(1, min(max_period, len(ids) - 1) + 1):
+        runs[period - 1] = trailing_run(ids, period)
+    return runs
+
+
+def loop_at_end(token_ids: Sequence[int], max_period: int = LOOP_MAX_PERIOD, min_span: int = LOOP_MIN_SPAN,
+                min_repeats: int = LOOP_MIN_REPEATS) -> Optional[Loop]:
+    """The loop token_ids end in, if the detector confirms one there, with its full extent"""
+    ids = np.asarray(token_ids, dtype=np.int64)
+    thresholds = loop_thresholds(max_period, min_span, min_repeats)
+    # the confirming runs fit in the last max(threshold) + max_period tokens, so test those first
+    tail = ids[-(int(thresholds[-1]) + max_period + 1):]
+    periods = np.flatnonzero(trailing_runs(tail, max_period) >= thresholds)
+    if not periods.size:
+        return None
+    period = int(periods[0]) + 1
+    run = trailing_run(ids, period)
+    return Loop(len(ids) - run - period, period, len(ids) - 1)
+
+
+def strip_eos(token_ids: Sequence[int], eos_token_id: int) -> Sequence[int]:
+    if len(token_ids) and token_ids[-1] == eos_token_id:
+        return token_ids[:-1]
+    return token_ids
+
+
+class LoopAbortLogitsProcessor(BatchedLogitsProcessor):
+    """Force EOS on a sequence as soon as its output is confirmed to loop.
+
+    In the batched path the per-period run counters and the last max_period
+    tokens of each sequence live in preallocated host arrays, so a step is a
+    few vectorized numpy operations over the batch and touches the logits only
+    for sequences being aborted.
+    """
+
+    def __init__(self, eos_token_id: int, max_period: int = LOOP_MAX_PERIOD, min_span: int = LOOP_MIN_SPAN,
+                 min_repeats: int = LOOP_MIN_REPEATS):
+        self.eos_token_id = eos_token_id
+        self.max_period = max_period
+        self.min_span = min_span
+        self.min_repeats = min_repeats
+        self.thresholds = loop_thresholds(max_period, min_span, min_repeats)
+        self._offsets = np.arange(1, max_period + 1)
+
+        self._runs = np.zeros((0, max_period), dtype=np.int64)
+        self._recent = np.zeros((0, max_period), dtype=np.int64)
+        self._slots = SequenceSlots(self._grow)
+
+    def __call__(self, output_ids: List[int], logits: torch.Tensor) -> torch.Tensor:
+        if loop_at_end(output_ids, self.max_period, self.min_span, self.min_repeats) is None:
+            return logits
+        logits = torch.full_like(logits, -float("inf"))
+        logits[self.eos_token_id] = 0
+        return logits
+
+    def reset(self):
+        self._slots.clear()
+
+    def _grow(self, capacity: int):
+        for name in ('_runs', '_recent'):
+            old = getattr(self, name)
+            grown = np.zeros((capacity, self.max_period), dtype=np.int64)
+            grown[:len(old)] = old
+            setattr(self, name, grown)
+
+    def _refill(self, slot: int, ids: Sequence[int]):
+        """Rebuild a sequence's state from its tokens (new sequence, or back after preemption)"""
+        tail = np.asarray(ids[-(int(self.thresholds[-1]) + self.max_period + 1):], dtype=np.int64)
+        self._runs[slot] = trailing_runs(tail, self.max_period)
+        positions = np.arange(len(ids) - len(tail), len(ids))[-self.max_period:]
+        self._recent[slot, positions % self.max_period] = tail[-self.max_period:]
+
+    def apply_batch(self, logits: torch.Tensor, row_indices: Sequence[int], seq_ids: Sequence[int],
+                    output_token_ids: Sequence[Sequence[int]]) -> torch.Tensor:
+        if not row_indices:
+            return logits
+        active = set(seq_ids)
+        row_slots, step_slots, step_tokens, step_positions = [], [], [], []
+        for seq_id, ids in zip(seq_ids, output_token_ids):
+            length = len(ids)
+            slot, seen = self._slots.lookup(seq_id, length, active)
+            if seen and length == seen + 1:
+                step_slots.append(slot)
+                step_tokens.append(ids[-1])
+                step_positions.append(length - 1)
+            elif not seen or length != seen:
+                self._refill(slot, ids)
+            self._slots.seen(seq_id, length)
+            row_slots.append(slot)
+
+        if step_slots:
+            slots = np.asarray(step_slots)
+            tokens = np.asarray(step_tokens, dtype=np.int64)
+            positions = np.asarray(step_positions)
+            # the token p steps back sits at (position - p) mod max_period, read before it is overwritten
+            back = positions[:, None] - self._offsets[None]
+            same = (self._recent[slots[:, None], back % self.max_period] == tokens[:, None]) & (back >= 0)
+            self._runs[slots] = np.where(same, self._runs[slots] + 1, 0)
+            self._recent[slots, positions % self.max_period] = tokens
+
+        confirmed = np.flatnonzero((self._runs[row_slots] >= self.thresholds[None]).any(axis=1))
+        if confirmed.size:
+            rows = torch.tensor([row_indices[idx] for idx in confirmed], device=logits.device)
+            logits[rows] = -float("inf")
+            logits[rows, self.eos_token_id] = 0
+        return logits
@@ -0,0 +1,109 @@
+"""
+Fallback attempts for pages that did not terminate
+
+A page that ends without EOS (it ran into max_tokens, or was cut at a
+repetition loop) is re-run with the next entry of RETRY_FALLBACKS: another
+resolution mode, other no-repeat n-gram settings and/or another prompt. All
+pages that need the same fallback are submitted in one engine call, and each
+page records the attempt that produced its text (1 is the first run).
+"""
+
+from typing import Dict, List, NamedTuple, Optional
+
+from config import BASE_SIZE, CROP_MODE, IMAGE_SIZE, MAX_CROPS, MAX_TOKENS, RESOLUTION_MODES, RETRY_FALLBACKS
+from process.image_process import DeepseekOCRProcessor
+from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
+
+
+class Fallback(NamedTuple):
+    mode: Optional[str] = None  # RESOLUTION_MODES name; None keeps BASE_SIZE/IMAGE_SIZE/CROP_MODE
+    prompt: Optional[str] = None  # None keeps the page's prompt
+    ngram_size: Optional[int] = None  # no-repeat n-gram settings; None keeps the first attempt's
+    window_size: Optional[int] = None
+    max_crops: Optional[int] = None  # local tile budget of crop modes; None keeps MAX_CROPS
+
+    @property
+    def resolution(self):
+        """(base_size, image_size, crop_mode) of this attempt"""
+        if self.mode is None:
+            return BASE_SIZE, IMAGE_SIZE, CROP_MODE
+        return RESOLUTION_MODES[self.mode]
+
+    @property
+    def name(self) -> str:
+        """The resolution mode this attempt runs at, as recorded per page"""
+        return self.mode or resolution_name(self.resolution)
+
+    @property
+    def crops(self) -> Optional[int]:
+        """Local tile budget this attempt runs with, None for modes without tiles"""
+        return (self.max_crops or MAX_CROPS) if self.resolution[2] else None
+
+    def describe(self) -> str:
+        changes = [f"mode={self.mode}"] if self.mode else []
+        if self.max_crops:
+            changes.append(f"max_crops={self.max_crops}")
+        if self.prompt:
+            changes.append(f"prompt={self.prompt!r}")
+        if self.ngram_size or self.window_size:
+            changes.append(f"no-repeat ngram={self.ngram_size}/window={self.window_size}")
+        return ', '.join(changes) or 'unchanged settings'
+
+
+def resolution_name(resolution: tuple) -> str:
+    """RESOLUTION_MODES name of (base_size, image_size, crop_mode), or e.g. '1024/640+crop' for other settings"""
+    for name, mode in RESOLUTION_MODES.items():
+        if tuple(mode) == tuple(resolution):
+            return name
+    base_size, image_size, crop_mode = resolution
+    return f"{base_size}/{image_size}{'+crop' if crop_mode else ''}"
+
+
+def retry_fallbacks(fallbacks: List[dict] = RETRY_FALLBACKS, setting: str = 'RETRY_FALLBACKS') -> List[Fallback]:
+    """RETRY_FALLBACKS (or another list of such dicts) as Fallbacks, checked so a typo fails at startup instead of on the first bad page"""
+    parsed = [Fallback(**fallback) for fallback in fallbacks]
+    for fallback in parsed:
+        if fallback.mode is not None and fallback.mode not in RESOLUTION_MODES:
+            raise ValueError(f"unknown resolution mode {fallback.mode!r} in {setting}, "
+                             f"expected one of {sorted(RESOLUTION_MODES)}")
+        if fallback.max_crops is not None and fallback.max_crops < 1:
+            raise ValueError(f"max_crops must be at least 1 in {setting}, got {fallback.max_crops}")
+    return parsed
+
+
+_processors: Dict[tuple, DeepseekOCRProcessor] = {}
+
+
+def fallback_request(image, prompt: str, fallback: Fallback) -> dict:
+    """The vLLM request for one page under a fallback's resolution mode, tile budget and prompt"""
+    base_size, image_size, crop_mode = fallback.resolution
+    key = (base_size, image_size, fallback.max_crops or MAX_CROPS)
+    if key not in _processors:
+        _processors[key] = DeepseekOCRProcessor(base_size=base_size, image_size=image_size, max_crops=key[2])
+    prompt = fallback.prompt or prompt
+    return {
+        "prompt": prompt,
+        "multi_modal_data": {
+            "image": _processors[key].tokenize_with_images(
+                prompt=prompt, images=[image], bos=True, eos=True, cropping=crop_mode)
+        },
+    }
+
+
+def fallback_sampling_params(params, fallback: Fallback, max_tokens: int = MAX_TOKENS):
+    """A copy of the first attempt's SamplingParams with the fallback's no-repeat settings and the full max_tokens.
+
+    A page that hit a per-page budget gets the whole ceiling on its retry.
+    """
+    params = params.clone()
+    params.max_tokens = max_tokens
+    if fallback.ngram_size or fallback.window_size:
+        processors = []
+        for processor in params.logits_processors or []:
+            if isinstance(processor, NoRepeatNGramLogitsProcessor):
+                processor = NoRepeatNGramLogitsProcessor(ngram_size=fallback.ngram_size or processor.ngram_size,
+                                                         window_size=fallback.window_size or processor.window_size,
+                                                         whitelist_token_ids=processor.whitelist_token_ids)
+            processors.append(processor)
+        params.logits_processors = processors
+    return params
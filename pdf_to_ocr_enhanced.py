@@ -25,11 +25,13 @@ import io
 import tempfile
 import urllib.parse
 from pathlib import Path
-from typing import List, Optional, Dict, Any, Tuple
+from typing import Callable, List, Optional, Dict, Any, Tuple
 from PIL import Image, ImageDraw
 import numpy as np
 import fitz  # PyMuPDF
 
+from grounding import parse_det, postprocess, scale_boxes
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -150,30 +152,6 @@ class PDFToOCRProcessor:
         
         return images
     
-    def _re_match(self, text: str) -> Tuple[List, List, List]:
-        """
-        Match reference patterns in the text
-        
-        Args:
-            text: The text to search for patterns
-            
-        Returns:
-            Tuple of (all_matches, image_matches, other_matches)
-        """
-        pattern = r'(<\|ref\|>(.*?)<\|/ref\|><\|det\|>(.*?)<\|/det\|>)'
-        matches = re.findall(pattern, text, re.DOTALL)
-        
-        matches_image = []
-        matches_other = []
-        
-        for a_match in matches:
-            if '<|ref|>image<|/ref|>' in a_match[0]:
-                matches_image.append(a_match[0])
-            else:
-                matches_other.append(a_match[0])
-        
-        return matches, matches_image, matches_other
-    
     def _extract_coordinates_and_label(self, ref_text: Tuple) -> Optional[Tuple[str, List]]:
         """
         Extract coordinates and label from reference text
@@ -182,94 +160,74 @@ class PDFToOCRProcessor:
             ref_text: Reference text tuple from regex match
             
         Returns:
-            Tuple of (label_type, coordinates_list) or None if extraction fails
+            Tuple of (label_type, coordinates array of shape (n, 4)) or None if extraction fails
         """
         try:
             label_type = ref_text[1]
-            cor_list = eval(ref_text[2])
+            cor_list = parse_det(ref_text[2])
             return (label_type, cor_list)
         except Exception as e:
             logger.error(f"Error extracting coordinates: {str(e)}")
             return None
     
-    def _extract_and_save_images(self, pdf_path: str, content: str, page_idx: int) -> Tuple[str, int]:
+    def _image_link(self, pdf_path: str, page_idx: int, saved: List[str]) -> Optional[Callable[[int, str], str]]:
         """
-        Extract images from content and save them to the images folder
+        Build the image_link callback of postprocess() for a page
         
         Args:
             pdf_path: Path to the original PDF file
-            content: The OCR content with reference tags
             page_idx: Index of the page being processed
+            saved: List the filenames of the saved images are appended to
             
         Returns:
-            Tuple of (processed_content, number_of_images_extracted)
+            Callback that crops an image reference out of the page, saves it to the images
+            folder and returns its markdown link ('' if it fails), or None if images are not
+            extracted (image references are then removed like the others)
         """
         if not self.extract_images or not self.images_folder:
-            return content, 0
+            return None
         
         # Get PDF images for this page
         pdf_images = self._pdf_to_images(pdf_path)
         if page_idx >= len(pdf_images):
-            return content, 0
+            return None
         
         page_image = pdf_images[page_idx]
         image_width, image_height = page_image.size
         
-        # Find all image references
-        _, matches_images, _ = self._re_match(content)
-        img_idx = 0
-        
-        for idx, a_match_image in enumerate(matches_images):
+        def image_link(idx: int, det_content: str) -> str:
             try:
-                # Extract the reference text
-                pattern = r'<\|ref\|>image<\|/ref\|><\|det\|>(.*?)<\|/det\|>'
-                det_match = re.search(pattern, a_match_image)
+                # Parse the coordinates without eval and scale them to actual image size
+                coordinates = scale_boxes(parse_det(det_content), image_width, image_height)
                 
-                if det_match:
-                    det_content = det_match.group(1)
-                    try:
-                        coordinates = eval(det_content)
-                        
-                        # Extract and save the image
-                        for points in coordinates:
-                            x1, y1, x2, y2 = points
-                            
-                            # Scale coordinates to actual image size
-                            x1 = int(x1 / 999 * image_width)
-                            y1 = int(y1 / 999 * image_height)
-                            x2 = int(x2 / 999 * image_width)
-                            y2 = int(y2 / 999 * image_height)
-                            
-                            # Crop and save the image
-                            cropped = page_image.crop((x1, y1, x2, y2))
-                            image_filename = f"{Path(pdf_path).stem}_page{page_idx}_{img_idx}.jpg"
-                            image_path = self.images_folder / image_filename
-                            cropped.save(image_path)
-                            
-                            # Replace reference with markdown link with URL-encoded filename
-                            # The images folder is relative to the markdown file location
-                            encoded_filename = urllib.parse.quote(image_filename)
-                            markdown_link = f"![](images/{encoded_filename})\n"
-                            content = content.replace(a_match_image, markdown_link, 1)
-                            
-                            img_idx += 1
-                            break
-                    except Exception as e:
-                        logger.error(f"Error processing image coordinates: {str(e)}")
-                        # If we can't process the coordinates, just remove the tag
-                        content = content.replace(a_match_image, "", 1)
+                # Extract and save the first box of the reference
+                x1, y1, x2, y2 = coordinates[0].tolist()
+                
+                # Crop and save the image
+                cropped = page_image.crop((x1, y1, x2, y2))
+                image_filename = f"{Path(pdf_path).stem}_page{page_idx}_{len(saved)}.jpg"
+                image_path = self.images_folder / image_filename
+                cropped.save(image_path)
+                saved.append(image_filename)
+                
+                # Replace reference with markdown link with URL-encoded filename
+                # The images folder is relative to the markdown file location
+                encoded_filename = urllib.parse.quote(image_filename)
+                return f"![](images/{encoded_filename})\n"
             except Exception as e:
-                logger.error(f"Error extracting image: {str(e)}")
-                content = content.replace(a_match_image, "", 1)
+                logger.error(f"Error processing image coordinates: {str(e)}")
+                # If we can't process the coordinates, just remove the tag
+                return ""
         
-        return content, img_idx
+        return image_link
     
-    def _clean_content(self, content: str) -> str:
+    def _clean_content(self, content: str, image_link: Optional[Callable[[int, str], str]] = None) -> str:
         """
         Clean up the OCR content
         
         Args:
             content: Raw OCR content
+            image_link: Replacement of each image reference, see _image_link()
             
         Returns:
             Cleaned content
@@ -278,20 +236,9 @@ class PDFToOCRProcessor:
         if '<｜end▁of▁sentence｜>' in content:
             content = content.replace('<｜end▁of▁sentence｜>', '')
         
-        # Get all non-image references
-        _, _, matches_other = self._re_match(content)
-        
-        # Remove other reference tags and clean up
-        for idx, a_match_other in enumerate(matches_other):
-            content = content.replace(a_match_other, '')
-        
-        # Replace special LaTeX-like symbols
-        content = content.replace('\\coloneqq', ':=')
-        content = content.replace('\\eqqcolon', '=:')
-        
-        # Clean up excessive newlines
-        content = content.replace('\n\n\n\n', '\n\n')
-        content = content.replace('\n\n\n', '\n\n')
+        # Replace image references with links, remove the other reference tags, replace
+        # special LaTeX-like symbols and clean up excessive newlines, in one pass
+        content = postprocess(content, image_link=image_link)
         
         return content.strip()
     
@@ -307,11 +254,10 @@ class PDFToOCRProcessor:
         Returns:
             Processed content
         """
-        # Step 1: Extract and save images
-        content, num_images = self._extract_and_save_images(pdf_path, content, page_idx)
-        
-        # Step 2: Clean up the content
-        content = self._clean_content(content)
+        # Step 1: Extract and save images and clean up the content
+        saved_images = []
+        content = self._clean_content(content, self._image_link(pdf_path, page_idx, saved_images))
+        num_images = len(saved_images)
         
         # Step 3: Add page separator
         page_separator = '\n\n<--- Page Split --->\n\n'
@@ -0,0 +1,298 @@
+"""
+Prompt-lookup (n-gram) speculative decoding for OCR output
+
+OCR output repeats itself: table markup, <|ref|>/<|det|> grounding tags,
+running headers and LaTeX boilerplate. The draft for the next tokens is
+copied from the latest earlier occurrence of the sequence's last n tokens
+(n from PROMPT_LOOKUP_MAX down to PROMPT_LOOKUP_MIN), looked up in the page's
+own output first and then in the output of the document's earlier pages. The
+target model checks the whole draft in one forward pass; with greedy decoding
+the accepted tokens are exactly the ones it would have generated one by one.
+
+NGramIndex, propose, accepted_length and simulate work on plain token id
+lists, so proposals and acceptance can be checked on recorded outputs on CPU
+(see `benchmark.py speculate`). DocumentNGramWorker plugs the same proposer
+into vLLM's n-gram speculative decoding.
+"""
+
+from typing import Dict, List, NamedTuple, Optional, Sequence, Set
+
+from config import (CASCADE, NUM_SPECULATIVE_TOKENS, PROMPT_LOOKUP_MAX, PROMPT_LOOKUP_MIN, PROMPT_LOOKUP_PAGES,
+                    SPECULATIVE_NGRAM)
+from process.ngram_norepeat import output_tokens
+
+try:
+    from vllm.spec_decode.ngram_worker import NGramWorker
+except ImportError:  # offline use (benchmark.py, recorded outputs) needs no vLLM
+    NGramWorker = object
+
+# the vLLM release (the Docker base image) whose v0 spec_decode_worker.NGramWorker DocumentNGramWorker replaces
+VLLM_VERSION = '0.8.5'
+
+# SamplingParams.extra_args keys carrying a request's document and page number
+DOCUMENT_KEY = 'document'
+PAGE_KEY = 'page'
+
+
+class NGramIndex:
+    """Latest occurrence of every n-gram, min_n <= n <= max_n, of a growing token list.
+
+    An n-gram is indexed once the token after it exists, so find() never
+    returns the sequence's own last n tokens.
+    """
+
+    def __init__(self, min_n: int = PROMPT_LOOKUP_MIN, max_n: int = PROMPT_LOOKUP_MAX):
+        self.min_n = min_n
+        self.max_n = max_n
+        self.tokens: List[int] = []
+        self._next: Dict[tuple, int] = {}
+
+    @classmethod
+    def of(cls, token_ids: Sequence[int], min_n: int = PROMPT_LOOKUP_MIN, max_n: int = PROMPT_LOOKUP_MAX) -> 'NGramIndex':
+        index = cls(min_n, max_n)
+        index.extend(token_ids)
+        return index
+
+    def extend(self, token_ids: Sequence[int]):
+        tokens = self.tokens
+        for token in token_ids:
+            position = len(tokens)
+            for n in range(self.min_n, min(self.max_n, position) + 1):
+                self._next[tuple(tokens[position - n:position])] = position
+            tokens.append(int(token))
+
+    def find(self, ngram: tuple) -> Optional[int]:
+        """Position of the token that followed the latest occurrence of ngram"""
+        return self._next.get(ngram)
+
+
+def propose(own: NGramIndex, length: int, earlier: Sequence[NGramIndex] = ()) -> List[int]:
+    """Draft of up to `length` tokens continuing own.tokens, or [] when no n-gram matches.
+
+    Longer n-grams win; at equal length the sequence's own output wins over
+    earlier pages, which are searched in the given order.
+    """
+    tokens = own.tokens
+    for n in range(min(own.max_n, len(tokens)), own.min_n - 1, -1):
+        ngram = tuple(tokens[-n:])
+        position = own.find(ngram)
+        if position is not None:
+            # the copy may run on into the draft itself, which continues a periodic pattern (table rows) past the end
+            draft = []
+            for offset in range(length):
+                source = position + offset
+                draft.append(tokens[source] if source < len(tokens) else draft[source - len(tokens)])
+            return draft
+        for index in earlier:
+            position = index.find(ngram)
+            if position is not None:
+                return index.tokens[position:position + length]
+    return []
+
+
+def accepted_length(draft: Sequence[int], target: Sequence[int]) -> int:
+    """How many leading draft tokens greedy verification accepts, given the tokens the target model generates"""
+    accepted = 0
+    for proposed, generated in zip(draft, target):
+        if proposed != generated:
+            break
+        accepted += 1
+    return accepted
+
+
+class Speculation(NamedTuple):
+    tokens: int  # output tokens of the page
+    passes: int  # target model forward passes, the prefill included
+    proposed: int  # draft tokens proposed
+    accepted: int  # draft tokens accepted
+    seconds: Optional[float] = None  # from the first to the last output token
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed else 0.0
+
+    @property
+    def tokens_per_pass(self) -> float:
+        return self.tokens / self.passes if self.passes else 0.0
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if not self.seconds:
+            return None
+        # the first token comes from the prefill
+        return (self.tokens - 1) / self.seconds
+
+
+def simulate(token_ids: Sequence[int], num_speculative_tokens: int = NUM_SPECULATIVE_TOKENS,
+             earlier_pages: Sequence[Sequence[int]] = (), min_n: int = PROMPT_LOOKUP_MIN,
+             max_n: int = PROMPT_LOOKUP_MAX) -> Speculation:
+    """Replay a recorded greedy output under speculative decoding.
+
+    Each pass proposes a draft from the tokens so far, accepts its prefix that
+    matches the recorded tokens and adds the target model's next token. Earlier
+    pages are given complete, nearest first, as if the document were decoded
+    page by page; in a batch they may still be generating.
+    """
+    own = NGramIndex(min_n, max_n)
+    earlier = [NGramIndex.of(page, min_n, max_n) for page in earlier_pages]
+    position = passes = proposed = accepted = 0
+    while position < len(token_ids):
+        draft = propose(own, num_speculative_tokens, earlier)
+        # the last recorded token is counted as the target model's own, as generation stops there
+        hits = accepted_length(draft, token_ids[position:min(position + len(draft), len(token_ids) - 1)])
+        step = hits + 1
+        own.extend(token_ids[position:position + step])
+        position += step
+        passes += 1
+        proposed += len(draft)
+        accepted += hits
+    return Speculation(len(token_ids), passes, proposed, accepted)
+
+
+class DocumentContext:
+    """Outputs of a document's pages, shared by the requests of its pages through SamplingParams.extra_args.
+
+    Only the indexes a page can still look up are kept: those within
+    lookback_pages before a page that is decoding or yet to start.
+    """
+
+    def __init__(self, lookback_pages: int = PROMPT_LOOKUP_PAGES):
+        self.lookback_pages = lookback_pages
+        self.pages: Dict[int, NGramIndex] = {}
+        self.decoding: Set[int] = set()  # pages whose sequence is in the decode batch
+        self.proposed: Dict[str, int] = {}  # draft tokens proposed per request id
+
+    def __deepcopy__(self, memo):
+        # SamplingParams.clone() deep-copies extra_args; every page has to see the same document
+        return self
+
+    def earlier(self, page: int) -> List[NGramIndex]:
+        pages = range(page - 1, page - 1 - self.lookback_pages, -1)
+        return [self.pages[p] for p in pages if p in self.pages]
+
+    def start(self, page: int, index: NGramIndex):
+        """Register the index of a page entering the decode batch"""
+        self.pages[page] = index
+        self.decoding.add(page)
+
+    def finish(self, page: int):
+        """A page left the decode batch; drop the indexes no decoding or later page can reach"""
+        self.decoding.discard(page)
+        # pages start in order, so the ones not started yet begin after the newest registered page
+        readers = self.decoding | {max(self.pages, default=page) + 1}
+        for p in [p for p in self.pages if not any(0 <= reader - p <= self.lookback_pages for reader in readers)]:
+            del self.pages[p]
+
+    def speculation(self, request_output) -> Optional[Speculation]:
+        """Speculation of a finished request, from vLLM's per-request acceptance counts"""
+        counts = getattr(request_output.metrics, 'spec_token_acceptance_counts', None)
+        if not counts:
+            return None
+        metrics = request_output.metrics
+        seconds = metrics.last_token_time - metrics.first_token_time if metrics.first_token_time else None
+        return Speculation(len(request_output.outputs[0].token_ids), counts[0],
+                           self.proposed.pop(request_output.request_id, 0), sum(counts[1:]), seconds)
+
+
+def with_document(params, document: DocumentContext, page: int):
+    """A copy of SamplingParams that lets the proposer look up earlier pages of document"""
+    params = params.clone()
+    params.extra_args = {**(params.extra_args or {}), DOCUMENT_KEY: document, PAGE_KEY: page}
+    return params
+
+
+class PromptLookupProposer:
+    """Drafts for the sequences of a decode batch, from an NGramIndex per sequence updated with its new tokens"""
+
+    def __init__(self, min_n: int = PROMPT_LOOKUP_MIN, max_n: int = PROMPT_LOOKUP_MAX):
+        self.min_n = min_n
+        self.max_n = max_n
+        self._indexes: Dict[int, NGramIndex] = {}
+        self._documents: Dict[int, tuple] = {}  # seq_id -> (DocumentContext, page)
+
+    def propose(self, seq_id: int, output_token_ids: Sequence[int], length: int, request_id: Optional[str] = None,
+                document: Optional[DocumentContext] = None, page: Optional[int] = None) -> List[int]:
+        index = self._indexes.get(seq_id)
+        if index is None or len(index.tokens) > len(output_token_ids):
+            index = self._indexes[seq_id] = NGramIndex(self.min_n, self.max_n)
+            if document is not None:
+                document.start(page, index)
+                self._documents[seq_id] = (document, page)
+        index.extend(output_token_ids[len(index.tokens):])
+
+        draft = propose(index, length, document.earlier(page) if document is not None else ())
+        if document is not None and draft:
+            document.proposed[request_id] = document.proposed.get(request_id, 0) + len(draft)
+        return draft
+
+    def retire(self, active: Set[int]):
+        """Drop the indexes of sequences no longer in the batch (finished; rebuilt if they come back)"""
+        for seq_id in [s for s in self._indexes if s not in active]:
+            del self._indexes[seq_id]
+            document, page = self._documents.pop(seq_id, (None, None))
+            if document is not None:
+                document.finish(page)
+
+
+class DocumentNGramWorker(NGramWorker):
+    """vLLM's n-gram proposer worker with drafts from PromptLookupProposer"""
+
+    def sampler_output(self, execute_model_req, sample_len: int, seq_ids_with_bonus_token_in_last_step: Set[int]):
+        import torch
+        from vllm.model_executor.layers.sampler import SamplerOutput
+
+        self._raise_if_unsupported(execute_model_req)
+        if not hasattr(self, '_lookup'):
+            self._lookup = PromptLookupProposer(self.ngram_prompt_lookup_min, self.ngram_prompt_lookup_max)
+
+        outputs = []
+        active = set()
+        for seq_group_metadata in execute_model_req.seq_group_metadata_list:
+            seq_id, seq_data = next(iter(seq_group_metadata.seq_data.items()))
+            active.add(seq_id)
+            extra_args = seq_group_metadata.sampling_params.extra_args or {}
+            draft = self._lookup.propose(seq_id, output_tokens(seq_data), sample_len, seq_group_metadata.request_id,
+                                         extra_args.get(DOCUMENT_KEY), extra_args.get(PAGE_KEY))
+            if not draft:
+                outputs.append(None)
+                continue
+            # vLLM scores exactly sample_len tokens; a short draft from an earlier page is padded like vLLM pads its own
+            draft = draft + [draft[-1]] * (sample_len - len(draft))
+            token_ids = torch.tensor(draft, dtype=torch.long, device=self.device)
+            outputs.append(SamplerOutput(
+                outputs=None,
+                sampled_token_probs=torch.nn.functional.one_hot(token_ids, num_classes=self.vocab_size).to(torch.float32),
+                logprobs=torch.zeros((sample_len, self.vocab_size), dtype=torch.float32, device=self.device),
+                sampled_token_ids=token_ids,
+            ))
+        self._lookup.retire(active)
+
+        if all(output is None for output in outputs):
+            return None, False
+        return outputs, False
+
+
+def speculative_config() -> Optional[dict]:
+    """LLM(speculative_config=...) for SPECULATIVE_NGRAM, or None when it is off"""
+    if not SPECULATIVE_NGRAM:
+        return None
+    # vLLM builds its n-gram proposer from this module global; the worker runs in-process (tensor_parallel_size=1).
+    # Other releases move or rename it, and patching a missing global would silently speculate without the document
+    import vllm
+    from vllm.spec_decode import spec_decode_worker
+    installed = getattr(spec_decode_worker, 'NGramWorker', None)
+    if vllm.__version__ != VLLM_VERSION or installed not in (NGramWorker, DocumentNGramWorker):
+        raise RuntimeError(f"SPECULATIVE_NGRAM replaces vllm.spec_decode.spec_decode_worker.NGramWorker of vLLM "
+                           f"{VLLM_VERSION}; found vLLM {vllm.__version__}{' without it' if installed is None else ''}. "
+                           f"Set SPECULATIVE_NGRAM = False")
+    spec_decode_worker.NGramWorker = DocumentNGramWorker
+    return {
+        "method": "ngram",
+        "num_speculative_tokens": NUM_SPECULATIVE_TOKENS,
+        "prompt_lookup_min": PROMPT_LOOKUP_MIN,
+        "prompt_lookup_max": PROMPT_LOOKUP_MAX,
+        # score each draft position as its own sequence, so per-sequence logits processors see the right history
+        "disable_mqa_scorer": True,
+        # the cascade's mean logprob signal needs the sampled tokens' log-probabilities
+        "disable_logprobs": not CASCADE,
+    }
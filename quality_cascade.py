@@ -0,0 +1,100 @@
+"""
+Two-stage quality cascade
+
+Most pages read fine at a cheap resolution mode, and only a minority need the
+expensive one. With CASCADE every page first runs at CASCADE_CHEAP_MODE; its
+output is scored with a few quality signals and only the pages that fail one
+of them are re-run, together, at BASE_SIZE/IMAGE_SIZE/CROP_MODE:
+
+- EOS: a page that ran into max_tokens or a repetition loop did not finish.
+- Mean token log-probability: the model was unsure of what it read.
+- Repetition: the share of n-grams the page already emitted earlier, which
+  rises when the model stutters on text it cannot resolve.
+- Text ratio: output tokens against the tokens expected from the page's ink
+  and text layer (token_budget.py); a low ratio means text was missed.
+
+page_signals and escalation_reasons work on plain token ids and numbers, so
+the thresholds can be checked on recorded outputs on CPU (see
+`benchmark.py cascade`).
+"""
+
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+from config import (CASCADE_CHEAP_MODE, CASCADE_MAX_REPETITION, CASCADE_MIN_LOGPROB, CASCADE_MIN_TEXT_RATIO,
+                    CASCADE_REPEAT_NGRAM, PROMPT)
+from page_retry import Fallback, retry_fallbacks
+from token_budget import FIXED_BUDGETS, TEXT_CHARS_KEY, estimate_tokens, ink_density, prompt_kind
+
+# pages expected to hold fewer tokens than this are (nearly) blank, their text ratio says nothing
+MIN_EXPECTED_TOKENS = 64
+
+
+class PageSignals(NamedTuple):
+    tokens: int  # output tokens, EOS excluded
+    eos: bool  # the page terminated on its own
+    mean_logprob: Optional[float] = None  # None when the completion carries no log-probabilities
+    repetition: float = 0.0  # share of n-grams already emitted earlier on the page
+    text_ratio: Optional[float] = None  # None when the prompt or a blank page gives no expectation
+
+
+def cheap_pass() -> Fallback:
+    """The cascade's first pass, checked like a RETRY_FALLBACKS entry"""
+    return retry_fallbacks([{'mode': CASCADE_CHEAP_MODE}])[0]
+
+
+def repetition_score(token_ids: Sequence[int], n: int = CASCADE_REPEAT_NGRAM) -> float:
+    """Share of the n-grams of token_ids that occur earlier in token_ids"""
+    ids = np.asarray(token_ids, dtype=np.int64)
+    if len(ids) <= n:
+        return 0.0
+    windows = np.lib.stride_tricks.sliding_window_view(ids, n)
+    distinct = len(np.unique(windows, axis=0))
+    return 1.0 - distinct / len(windows)
+
+
+def expected_tokens(ink: float, text_chars: int, prompt: str) -> Optional[int]:
+    """Tokens the page should produce, for prompts whose output follows the text on the page"""
+    kind = prompt_kind(prompt)
+    if kind is None or kind in FIXED_BUDGETS:
+        return None
+    return estimate_tokens(ink, text_chars, prompt)
+
+
+def page_signals(token_ids: Sequence[int], eos: bool, cumulative_logprob: Optional[float] = None,
+                 ink: Optional[float] = None, text_chars: int = 0, prompt: str = PROMPT) -> PageSignals:
+    """Quality signals of one page output; token_ids without the EOS token"""
+    tokens = len(token_ids)
+    mean_logprob = cumulative_logprob / tokens if cumulative_logprob is not None and tokens else None
+    ratio = None
+    if ink is not None:
+        expected = expected_tokens(ink, text_chars, prompt)
+        if expected is not None and expected >= MIN_EXPECTED_TOKENS:
+            ratio = tokens / expected
+    return PageSignals(tokens, eos, mean_logprob, repetition_score(token_ids), ratio)
+
+
+def escalation_reasons(signals: PageSignals, min_logprob: float = CASCADE_MIN_LOGPROB,
+                       max_repetition: float = CASCADE_MAX_REPETITION,
+                       min_text_ratio: float = CASCADE_MIN_TEXT_RATIO) -> List[str]:
+    """Why a page should be re-run at the expensive mode; [] keeps the cheap result"""
+    reasons = []
+    if not signals.eos:
+        reasons.append('no EOS')
+    if signals.mean_logprob is not None and signals.mean_logprob < min_logprob:
+        reasons.append(f'mean logprob {signals.mean_logprob:.2f}')
+    if signals.repetition > max_repetition:
+        reasons.append(f'repetition {signals.repetition:.0%}')
+    if signals.text_ratio is not None and signals.text_ratio < min_text_ratio:
+        reasons.append(f'text ratio {signals.text_ratio:.2f}')
+    return reasons
+
+
+def completion_signals(completion, eos: bool, eos_token_id: int, image, prompt: str = PROMPT) -> PageSignals:
+    """page_signals of a vLLM CompletionOutput; the sampling parameters need logprobs=0 for mean_logprob"""
+    token_ids = list(completion.token_ids)
+    if token_ids and token_ids[-1] == eos_token_id:
+        token_ids = token_ids[:-1]
+    ink = ink_density(image) if expected_tokens(0.0, 0, prompt) is not None else None
+    return page_signals(token_ids, eos, completion.cumulative_logprob, ink, image.info.get(TEXT_CHARS_KEY, 0), prompt)
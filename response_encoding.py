@@ -0,0 +1,150 @@
+"""
+Response encoding for the DeepSeek-OCR API
+
+Large OCR results (hundreds of pages) are expensive to serialize and to send
+over slow links. This module picks the body format (stdlib JSON, orjson or
+msgpack) and the content encoding (zstd or gzip) for a response, based on the
+request's ``format`` parameter and its ``Accept`` / ``Accept-Encoding`` headers.
+
+orjson, msgpack and zstandard are optional: formats and encodings whose
+package is not installed are simply not offered.
+"""
+
+import gzip
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# Bodies smaller than this are sent uncompressed
+MINIMUM_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 5
+ZSTD_LEVEL = 3
+
+# Preferred first when the client accepts several encodings with the same weight
+_ENCODING_PREFERENCE = ("zstd", "gzip")
+
+
+def available_formats() -> List[str]:
+    """Body formats supported by the installed packages"""
+    formats = ["json"]
+    if orjson is not None:
+        formats.append("orjson")
+    if msgpack is not None:
+        formats.append("msgpack")
+    return formats
+
+
+def available_encodings() -> List[str]:
+    """Content encodings supported by the installed packages"""
+    return [enc for enc in _ENCODING_PREFERENCE if enc != "zstd" or zstandard is not None]
+
+
+def parse_accept_encoding(header: Optional[str]) -> Dict[str, float]:
+    """Parse an Accept-Encoding header into {coding: q-value}"""
+    codings = {}
+    if not header:
+        return codings
+    for part in header.split(","):
+        fields = part.strip().split(";")
+        coding = fields[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def select_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Pick the best supported content encoding, or None for identity"""
+    codings = parse_accept_encoding(accept_encoding)
+    wildcard = codings.get("*", 0.0)
+    best, best_q = None, 0.0
+    for coding in available_encodings():
+        q = codings.get(coding, wildcard)
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def select_format(requested: Optional[str] = None, accept: Optional[str] = None) -> str:
+    """
+    Pick the body format for a response
+
+    An explicit ``requested`` format wins; otherwise an ``Accept`` header naming
+    a msgpack media type selects msgpack, and everything else gets JSON.
+
+    Raises:
+        ValueError: if the requested format is unknown or its package is missing
+    """
+    if requested:
+        fmt = requested.strip().lower()
+        if fmt not in available_formats():
+            raise ValueError(f"Unsupported response format '{requested}', "
+                             f"available: {', '.join(available_formats())}")
+        return fmt
+    if accept and msgpack is not None:
+        if any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES):
+            return "msgpack"
+    return "json"
+
+
+def serialize(content: Any, fmt: str = "json") -> Tuple[bytes, str]:
+    """Serialize JSON-compatible content, returning (body, media type)"""
+    if fmt == "orjson":
+        return orjson.dumps(content), JSON_MEDIA_TYPE
+    if fmt == "msgpack":
+        return msgpack.packb(content, use_bin_type=True), MSGPACK_MEDIA_TYPES[0]
+    # Same output as fastapi.responses.JSONResponse
+    body = json.dumps(content, ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(",", ":")).encode("utf-8")
+    return body, JSON_MEDIA_TYPE
+
+
+def compress(body: bytes, encoding: Optional[str]) -> bytes:
+    """Compress a body with the given content encoding"""
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+    return body
+
+
+def encode_body(content: Any, fmt: str = "json", encoding: Optional[str] = None,
+                minimum_size: int = MINIMUM_COMPRESS_SIZE) -> Tuple[bytes, str, Dict[str, str]]:
+    """
+    Serialize and optionally compress content
+
+    Returns:
+        (body, media type, extra response headers)
+    """
+    body, media_type = serialize(content, fmt)
+    headers = {"Vary": "Accept, Accept-Encoding"}
+    if encoding and len(body) >= minimum_size:
+        body = compress(body, encoding)
+        headers["Content-Encoding"] = encoding
+    return body, media_type, headers
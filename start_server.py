@@ -8,14 +8,18 @@ import os
 import sys
 import asyncio
 import io
+import logging
 import tempfile
-from typing import List, Optional
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
 from pathlib import Path
 
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Form
+from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Form, Depends, Query, Request
 from typing import Optional
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import torch
@@ -23,6 +27,8 @@ import fitz  # PyMuPDF
 from PIL import Image
 from tqdm import tqdm
 
+from response_encoding import encode_body, select_encoding, select_format
+
 # Add current directory to Python path
 sys.path.insert(0, '/app/DeepSeek-OCR-vllm')
 
@@ -33,13 +39,26 @@ os.environ['VLLM_USE_V1'] = '0'
 os.environ["CUDA_VISIBLE_DEVICES"] = '0'
 
 # Import DeepSeek-OCR components
-from config import INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, MAX_CONCURRENCY, NUM_WORKERS
+from config import INPUT_PATH, OUTPUT_PATH, PROMPT, CROP_MODE, MAX_CONCURRENCY, NUM_WORKERS, MAX_TOKENS, ADAPTIVE_MAX_TOKENS, LOOP_ABORT, SPECULATIVE_NGRAM, CASCADE, LOAD_CONTROL, LOG_LEVEL
 MODEL_PATH = os.environ.get('MODEL_PATH', 'deepseek-ai/DeepSeek-OCR')
 from deepseek_ocr import DeepseekOCRForCausalLM
-from process.image_process import DeepseekOCRProcessor
+from process.image_process import (CONTENT_DIGEST_KEY, DeepseekOCRProcessor, PROMPT_TOKEN_CACHE, VISION_EMBEDDING_CACHE,
+                                   content_digest, decode_image, reserve_vision_cache)
+from vision_encoder import VISION_ENCODER_STATS
+from token_budget import TEXT_CHARS_KEY, page_token_budget
+from loop_guard import LoopAbortLogitsProcessor, loop_at_end, strip_eos
+from prompt_lookup import DocumentContext, speculative_config, with_document
+from page_retry import Fallback, fallback_request, fallback_sampling_params, retry_fallbacks
+from quality_cascade import PageSignals, cheap_pass, completion_signals, escalation_reasons
+from load_control import EngineWorker, load_controller
 from vllm import LLM, SamplingParams
+from vllm.sampling_params import RequestOutputKind
 from vllm.model_executor.models.registry import ModelRegistry
 
+# Per-request and per-page messages are logged at DEBUG, so they stay off the hot path unless LOG_LEVEL asks for them
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
 # Register the custom model
 ModelRegistry.register_model("DeepseekOCRForCausalLM", DeepseekOCRForCausalLM)
 
@@ -61,13 +80,43 @@ app.add_middleware(
 
 # Global variables for the model
 llm = None
+tokenizer = None
 sampling_params = None
+# sampling parameters per max_tokens budget, derived from sampling_params
+budget_sampling_params: Dict[int, SamplingParams] = {}
+# second, third, ... attempt for pages that end without EOS
+fallbacks = retry_fallbacks()
+# first pass of every page with CASCADE; the others only re-run at the configured mode if it falls short
+first_pass = cheap_pass() if CASCADE else Fallback()
+# resolution mode and tile budget of bulk pages under load
+load = load_controller() if LOAD_CONTROL else None
+# request threads off the event loop, and the engine loop their pages are batched in (at most MAX_CONCURRENCY run at once)
+engine = EngineWorker(load, workers=MAX_CONCURRENCY)
 
 class OCRResponse(BaseModel):
     success: bool
     result: Optional[str] = None
     error: Optional[str] = None
     page_count: Optional[int] = None
+    truncated: Optional[bool] = None
+    max_tokens: Optional[int] = None
+    draft_acceptance: Optional[float] = None
+    tokens_per_second: Optional[float] = None
+    attempt: Optional[int] = None
+    mode: Optional[str] = None
+    max_crops: Optional[int] = None
+
+class PageResult(NamedTuple):
+    text: str
+    truncated: bool  # the page used its whole max_tokens budget without reaching EOS, or was cut at a repetition loop
+    max_tokens: int
+    draft_acceptance: Optional[float] = None  # share of speculative draft tokens accepted, with SPECULATIVE_NGRAM
+    tokens_per_second: Optional[float] = None  # decoding speed of the page, with SPECULATIVE_NGRAM
+    attempt: int = 1  # 1 for the first run, n for the (n - 1)th RETRY_FALLBACKS entry
+    mode: Optional[str] = None  # resolution mode the text was read at
+    max_crops: Optional[int] = None  # local tile budget it was read with, None for modes without tiles
+    signals: Optional[PageSignals] = None  # quality signals of a CASCADE first pass
+    status: str = 'eos'  # 'eos', 'loop', 'budget' (no EOS within its ADAPTIVE_MAX_TOKENS estimate) or 'length' (none within MAX_TOKENS)
 
 class BatchOCRResponse(BaseModel):
     success: bool
@@ -77,7 +126,7 @@ class BatchOCRResponse(BaseModel):
 
 def initialize_model():
     """Initialize the vLLM model"""
-    global llm, sampling_params
+    global llm, tokenizer, sampling_params
     
     if llm is None:
         print("Initializing DeepSeek-OCR model...")
@@ -93,21 +142,28 @@ def initialize_model():
             swap_space=0,
             max_num_seqs=MAX_CONCURRENCY,
             tensor_parallel_size=1,
-            gpu_memory_utilization=0.9,
-            disable_mm_preprocessor_cache=True
+            gpu_memory_utilization=reserve_vision_cache(0.9),
+            disable_mm_preprocessor_cache=True,
+            speculative_config=speculative_config()
         )
         
         # Set up sampling parameters
         from process.ngram_norepeat import NoRepeatNGramLogitsProcessor
         logits_processors = [NoRepeatNGramLogitsProcessor(ngram_size=20, window_size=50, whitelist_token_ids={128821, 128822})]
+        tokenizer = llm.get_tokenizer()
+        if LOOP_ABORT and not SPECULATIVE_NGRAM:
+            logits_processors.append(LoopAbortLogitsProcessor(eos_token_id=tokenizer.eos_token_id))
         
         sampling_params = SamplingParams(
             temperature=0.0,
-            max_tokens=8192,
+            max_tokens=MAX_TOKENS,
+            logprobs=0 if CASCADE else None,  # the sampled token's log-probability, for the cascade's mean logprob
             logits_processors=logits_processors,
             skip_special_tokens=False,
             include_stop_str_in_output=True,
+            output_kind=RequestOutputKind.FINAL_ONLY,  # the engine loop only hands back finished outputs
         )
+        engine.start(llm.llm_engine)
         
         print("Model initialization complete!")
 
@@ -124,6 +180,7 @@ def pdf_to_images_high_quality(pdf_data: bytes, dpi: int = 144) -> List[Image.Im
         pdf_document = fitz.open(temp_pdf_path)
         zoom = dpi / 72.0
         matrix = fitz.Matrix(zoom, zoom)
+        document_digest = content_digest(pdf_data) if VISION_EMBEDDING_CACHE.enabled else None
         
         for page_num in range(pdf_document.page_count):
             page = pdf_document[page_num]
@@ -132,6 +189,9 @@ def pdf_to_images_high_quality(pdf_data: bytes, dpi: int = 144) -> List[Image.Im
             # Convert to PIL Image
             img_data = pixmap.tobytes("png")
             img = Image.open(io.BytesIO(img_data))
+            img.info[TEXT_CHARS_KEY] = len(page.get_text().strip())
+            if document_digest is not None:
+                img.info[CONTENT_DIGEST_KEY] = content_digest(document_digest, page_num, dpi)
             images.append(img)
         
         pdf_document.close()
@@ -141,14 +201,9 @@ def pdf_to_images_high_quality(pdf_data: bytes, dpi: int = 144) -> List[Image.Im
     
     return images
 
-def process_single_image(image: Image.Image, prompt: str = PROMPT) -> str:
-    """Process a single image with DeepSeek-OCR using the specified prompt"""
-    print(f"[DEBUG] process_single_image called with prompt: {repr(prompt)}")
-    print(f"[DEBUG] Prompt length: {len(prompt)} characters")
-    print(f"[DEBUG] Prompt starts with <image>: {prompt.startswith('<image>')}")
-    
-    # Create request format for vLLM
-    request_item = {
+def build_request_item(image: Image.Image, prompt: str = PROMPT) -> dict:
+    """Build the vLLM request for one page image"""
+    return {
         "prompt": prompt,
         "multi_modal_data": {
             "image": DeepseekOCRProcessor().tokenize_with_images(
@@ -160,26 +215,273 @@ def process_single_image(image: Image.Image, prompt: str = PROMPT) -> str:
             )
         }
     }
-    
-    print(f"[DEBUG] Request item prompt: {repr(request_item['prompt'])}")
-    print(f"[DEBUG] Request item keys: {list(request_item.keys())}")
-    print(f"[DEBUG] Multi-modal data type: {type(request_item['multi_modal_data'])}")
-    
-    # Generate with vLLM
-    print(f"[DEBUG] Sending request to vLLM...")
-    outputs = llm.generate([request_item], sampling_params=sampling_params)
-    result = outputs[0].outputs[0].text
-    
-    print(f"[DEBUG] Model output (first 100 chars): {repr(result[:100])}")
-    print(f"[DEBUG] Model output length: {len(result)} characters")
-    
-    # Clean up result
+
+def page_request(image: Image.Image, prompt: str, quality: Fallback) -> dict:
+    """build_request_item, or the request under another resolution mode or tile budget"""
+    if quality == Fallback():
+        return build_request_item(image, prompt)
+    return fallback_request(image, prompt, quality)
+
+def request_quality(request: Request, lane: Optional[str] = None) -> Fallback:
+    """Resolution mode and tile budget of a request's pages: the configured ones, or LOAD_CONTROL's for its API key and lane
+
+    Called on the request thread, so pages get the level in force when they are served rather than when they arrived.
+    """
+    if load is None:
+        return Fallback()
+    authorization = request.headers.get("authorization") or ""
+    api_key = authorization[len("Bearer "):] if authorization.startswith("Bearer ") else None
+    return load.quality_for(api_key, lane)
+
+def clean_result(result: str) -> str:
+    """Strip the end-of-sentence marker from a model output"""
     if '<｜end▁of▁sentence｜>' in result:
         result = result.replace('<｜end▁of▁sentence｜>', '')
-        print(f"[DEBUG] Removed end-of-sentence tokens")
-    
     return result
 
+def sampling_params_for(max_tokens: int) -> SamplingParams:
+    """The server's sampling parameters with a per-page max_tokens budget"""
+    if max_tokens == sampling_params.max_tokens:
+        return sampling_params
+    if max_tokens not in budget_sampling_params:
+        params = sampling_params.clone()
+        params.max_tokens = max_tokens
+        budget_sampling_params[max_tokens] = params
+    return budget_sampling_params[max_tokens]
+
+def page_documents(num_pages: int, spans: Optional[List[Tuple[int, int]]] = None) -> List[DocumentContext]:
+    """A DocumentContext per page, shared by the pages of each (start, count) file span; one for all pages without spans"""
+    documents = [None] * num_pages
+    for start, count in spans or [(0, num_pages)]:
+        document = DocumentContext()
+        documents[start:start + count] = [document] * count
+    return documents
+
+def process_pages(images: List[Image.Image], prompt: str = PROMPT, quality: Fallback = Fallback(),
+                  spans: Optional[List[Tuple[int, int]]] = None) -> List[Union[PageResult, Exception]]:
+    """
+    Process page images with a single engine call, plus one per retry pass
+
+    All pages are pre-processed in parallel and submitted to vLLM together, so
+    the engine schedules them as one batch instead of one generation per page.
+    With ADAPTIVE_MAX_TOKENS each page gets its own max_tokens budget, and
+    the pages that run out of it are re-run with MAX_TOKENS at the same mode
+    before anything else. With SPECULATIVE_NGRAM the pages of a document
+    share a DocumentContext, so drafts for a page can also come from the
+    output of the pages before it; ``spans`` lists the (start, count) of each
+    file's pages when ``images`` holds several documents. Pages run at
+    ``quality`` (the configured mode unless LOAD_CONTROL lowered it). With
+    CASCADE the first pass runs at CASCADE_CHEAP_MODE and the pages whose
+    quality signals fail are re-run together at ``quality``. Pages that end
+    without EOS are then re-run together with each RETRY_FALLBACKS entry in
+    turn; a retry replaces a page's result only if it terminates.
+    The returned list is aligned with ``images``: each entry is the PageResult
+    of the page, or the exception raised while preparing that page.
+    """
+    logger.debug(f"process_pages called with {len(images)} pages, prompt: {repr(prompt)}")
+    cascade = CASCADE and quality.name != first_pass.name
+    first = first_pass if cascade else quality
+
+    def prepare(image):
+        try:
+            budget = page_token_budget(image, prompt) if ADAPTIVE_MAX_TOKENS else MAX_TOKENS
+            request = page_request(image, prompt, first)
+            return request, budget
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        prepared = list(executor.map(prepare, images))
+
+    results: List[Union[PageResult, Exception, None]] = [item if isinstance(item, Exception) else None for item in prepared]
+    pending = [idx for idx, item in enumerate(prepared) if not isinstance(item, Exception)]
+    if not pending:
+        return results
+
+    documents = page_documents(len(images), spans) if SPECULATIVE_NGRAM else None
+    logger.debug(f"Sending {len(pending)} pages to vLLM in one batch, mode {first.name}, max_crops {first.crops}...")
+    page_results = generate_pages(pending, [prepared[idx][0] for idx in pending],
+                                  [sampling_params_for(prepared[idx][1]) for idx in pending],
+                                  [prepared[idx][1] for idx in pending], first, documents,
+                                  images if cascade else None, prompt)
+    for idx, result in zip(pending, page_results):
+        results[idx] = result
+
+    if cascade:
+        escalate_pages(images, prompt, results, {idx: prepared[idx][1] for idx in pending}, quality, documents)
+
+    for attempt, fallback in enumerate(fallbacks, start=2):
+        retry = [idx for idx in pending if results[idx].truncated]
+        if not retry:
+            break
+        logger.debug(f"Retrying {len(retry)} pages without EOS in one batch, attempt {attempt}: {fallback.describe()}")
+
+        def prepare_retry(idx):
+            try:
+                return fallback_request(images[idx], prompt, fallback)
+            except Exception as e:
+                logger.error(f"Page {idx + 1} could not be prepared for attempt {attempt}: {str(e)}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+            requests = list(executor.map(prepare_retry, retry))
+        retry = [idx for idx, request in zip(retry, requests) if request is not None]
+        if not retry:
+            continue
+        params = fallback_sampling_params(sampling_params, fallback)
+        retried = generate_pages(retry, [request for request in requests if request is not None],
+                                 [params] * len(retry), [params.max_tokens] * len(retry), fallback, documents)
+        for idx, result in zip(retry, retried):
+            if not result.truncated:
+                results[idx] = result._replace(attempt=attempt)
+        logger.debug(f"Attempt {attempt}: {sum(not result.truncated for result in retried)} of {len(retry)} pages terminated")
+
+    return results
+
+def escalate_pages(images: List[Image.Image], prompt: str, results: List[Union[PageResult, Exception]],
+                   budgets: Dict[int, int], expensive: Fallback, documents: Optional[List[DocumentContext]] = None):
+    """Re-run, in one engine call at ``expensive``, the CASCADE first-pass pages whose quality signals fail"""
+    escalated = []
+    for idx in budgets:
+        reasons = escalation_reasons(results[idx].signals)
+        if reasons:
+            logger.debug(f"Page {idx + 1} escalated from {first_pass.name}: {', '.join(reasons)}")
+            escalated.append(idx)
+    logger.debug(f"{len(budgets) - len(escalated)} of {len(budgets)} pages kept at {first_pass.name}")
+    if not escalated:
+        return
+
+    def prepare(idx):
+        try:
+            return page_request(images[idx], prompt, expensive)
+        except Exception as e:
+            logger.error(f"Page {idx + 1} could not be prepared at {expensive.name}: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor:
+        requests = list(executor.map(prepare, escalated))
+    escalated = [idx for idx, request in zip(escalated, requests) if request is not None]
+    if not escalated:
+        return
+    logger.debug(f"Re-running {len(escalated)} pages at {expensive.name} in one batch...")
+    rerun = generate_pages(escalated, [request for request in requests if request is not None],
+                           [sampling_params_for(budgets[idx]) for idx in escalated],
+                           [budgets[idx] for idx in escalated], expensive, documents)
+    for idx, result in zip(escalated, rerun):
+        # the expensive mode is the reference, unless it runs on where the cheap pass terminated
+        if not result.truncated or results[idx].truncated:
+            results[idx] = result
+
+def generate_pages(page_indices: List[int], requests: List[dict], page_params: List[SamplingParams],
+                   max_tokens: List[int], settings: Fallback, documents: Optional[List[DocumentContext]] = None,
+                   images: Optional[List[Image.Image]] = None, prompt: str = PROMPT) -> List[PageResult]:
+    """Generations for the requests of the given pages, in the shared engine loop; PageResults in the same order
+
+    With ``images`` (indexed like the pages) the results carry the pages' quality signals; ``documents``
+    (indexed likewise) are the pages' DocumentContexts with SPECULATIVE_NGRAM.
+    """
+    if documents is not None:
+        page_params = [with_document(params, documents[idx], idx) for idx, params in zip(page_indices, page_params)]
+    outputs = engine.generate(requests, page_params)
+
+    results = []
+    for idx, budget, output in zip(page_indices, max_tokens, outputs):
+        result = page_result(output.outputs[0], budget, idx + 1)._replace(mode=settings.name, max_crops=settings.crops)
+        if images is not None:
+            result = result._replace(signals=completion_signals(output.outputs[0], not result.truncated,
+                                                                tokenizer.eos_token_id, images[idx], prompt))
+        speculation = documents[idx].speculation(output) if documents is not None else None
+        if speculation is not None:
+            logger.debug(f"Page {idx + 1}: {speculation.accepted}/{speculation.proposed} draft tokens accepted, "
+                  f"{speculation.tokens_per_pass:.2f} tokens per forward pass, "
+                  f"{speculation.tokens_per_second or 0:.1f} tokens/s")
+            result = result._replace(draft_acceptance=speculation.acceptance_rate,
+                                     tokens_per_second=speculation.tokens_per_second)
+        results.append(result)
+
+    # pages that ran out of their estimated budget get MAX_TOKENS at the same mode, before any escalation or fallback
+    short = [pos for pos, result in enumerate(results) if result.status == 'budget']
+    if short:
+        logger.debug(f"Re-running {len(short)} pages that used up their token budget with max_tokens={MAX_TOKENS}")
+        rerun = generate_pages([page_indices[pos] for pos in short], [requests[pos] for pos in short],
+                               [sampling_params_for(MAX_TOKENS)] * len(short), [MAX_TOKENS] * len(short),
+                               settings, documents, images, prompt)
+        for pos, result in zip(short, rerun):
+            results[pos] = result
+    return results
+
+def page_result(completion, max_tokens: int, page_num: int) -> PageResult:
+    """PageResult of a finished completion; a page that looped keeps only its text before the loop"""
+    text = clean_result(completion.text)
+    truncated = completion.finish_reason == 'length'
+    status = 'eos'
+    if truncated:
+        logger.debug(f"Page {page_num} used its {max_tokens}-token budget without EOS")
+        status = 'budget' if max_tokens < MAX_TOKENS else 'length'
+    if LOOP_ABORT:
+        loop = loop_at_end(strip_eos(completion.token_ids, tokenizer.eos_token_id))
+        if loop is not None:
+            logger.debug(f"Page {page_num} looped on a {loop.period}-token span from token {loop.start}, "
+                  f"keeping {loop.salvaged} of {len(completion.token_ids)} tokens")
+            text = clean_result(tokenizer.decode(completion.token_ids[:loop.salvaged]))
+            truncated = True
+            status = 'loop'
+    return PageResult(text, truncated, max_tokens, status=status)
+
+def page_responses(page_results: List[Union[PageResult, Exception]]) -> List[OCRResponse]:
+    """Convert per-page outputs of process_pages into OCRResponse objects"""
+    responses = []
+    for page_num, page_result in enumerate(page_results):
+        if isinstance(page_result, Exception):
+            logger.error(f"Page {page_num + 1} failed: {str(page_result)}")
+            responses.append(OCRResponse(
+                success=False,
+                error=f"Page {page_num + 1} error: {str(page_result)}",
+                page_count=page_num + 1
+            ))
+        else:
+            responses.append(OCRResponse(
+                success=True,
+                result=page_result.text,
+                page_count=page_num + 1,
+                truncated=page_result.truncated,
+                max_tokens=page_result.max_tokens,
+                draft_acceptance=page_result.draft_acceptance,
+                tokens_per_second=page_result.tokens_per_second,
+                attempt=page_result.attempt,
+                mode=page_result.mode,
+                max_crops=page_result.max_crops
+            ))
+    return responses
+
+def process_single_image(image: Image.Image, prompt: str = PROMPT, quality: Fallback = Fallback()) -> PageResult:
+    """Process a single image with DeepSeek-OCR using the specified prompt"""
+    logger.debug(f"process_single_image called with prompt: {repr(prompt)}")
+    logger.debug(f"Prompt length: {len(prompt)} characters")
+    logger.debug(f"Prompt starts with <image>: {prompt.startswith('<image>')}")
+
+    result = process_pages([image], prompt, quality)[0]
+    if isinstance(result, Exception):
+        raise result
+
+    logger.debug(f"Model output (first 100 chars): {repr(result.text[:100])}")
+    logger.debug(f"Model output length: {len(result.text)} characters")
+
+    return result
+
+def negotiate_format(request: Request, format: Optional[str] = Query(None)) -> str:
+    """Resolve the response body format from the format parameter and Accept header"""
+    try:
+        return select_format(format, request.headers.get("accept"))
+    except ValueError as e:
+        raise HTTPException(status_code=406, detail=str(e))
+
+def render_response(request: Request, payload, response_format: str = "json") -> Response:
+    """Serialize a response in the negotiated format, compressed per Accept-Encoding"""
+    encoding = select_encoding(request.headers.get("accept-encoding"))
+    body, media_type, headers = encode_body(jsonable_encoder(payload), response_format, encoding)
+    return Response(content=body, media_type=media_type, headers=headers)
+
 @app.on_event("startup")
 async def startup_event():
     """Initialize the model on startup"""
@@ -201,131 +503,189 @@ async def health_check():
         "cuda_device_count": torch.cuda.device_count() if torch.cuda.is_available() else 0
     }
 
+@app.get("/metrics")
+async def metrics():
+    """Pre-processing, vision embedding cache and vision encoder statistics"""
+    return {
+        "prompt_token_cache": PROMPT_TOKEN_CACHE.info(),
+        "vision_embedding_cache": VISION_EMBEDDING_CACHE.info(),
+        "vision_encoder": VISION_ENCODER_STATS.info(),
+        "load_control": load.info() if load is not None else None,
+    }
+
 @app.post("/ocr/image", response_model=OCRResponse)
-async def process_image_endpoint(file: UploadFile = File(...), prompt: Optional[str] = Form(None)):
+async def process_image_endpoint(request: Request, file: UploadFile = File(...), prompt: Optional[str] = Form(None),
+                                 lane: Optional[str] = Form(None), response_format: str = Depends(negotiate_format)):
     """Process a single image file with optional custom prompt"""
+    received = time.monotonic()
     try:
-        print(f"[DEBUG] Image endpoint called for file: {file.filename}")
+        logger.debug(f"Image endpoint called for file: {file.filename}")
         
         # Read image data
         image_data = await file.read()
-        print(f"[DEBUG] Read {len(image_data)} bytes of image data")
+        logger.debug(f"Read {len(image_data)} bytes of image data")
         
-        # Convert to PIL Image
-        image = Image.open(io.BytesIO(image_data)).convert('RGB')
-        print(f"[DEBUG] Converted to PIL Image, size: {image.size}")
+        # Decode to PIL Image, directly at the resolution the tile plan uses
+        image = await asyncio.to_thread(decode_image, image_data, cropping=CROP_MODE)
+        logger.debug(f"Converted to PIL Image, size: {image.size}")
         
-        # Debug logging
-        print(f"[DEBUG] Received prompt parameter: {repr(prompt)}")
-        print(f"[DEBUG] Default PROMPT from config: {repr(PROMPT)}")
+        logger.debug(f"Received prompt parameter: {repr(prompt)}")
+        logger.debug(f"Default PROMPT from config: {repr(PROMPT)}")
         
         # Use provided prompt or default
         use_prompt = prompt if prompt else PROMPT
-        print(f"[DEBUG] Image endpoint selected prompt: {repr(use_prompt)}")
-        print(f"[DEBUG] Using custom prompt: {prompt is not None}")
+        logger.debug(f"Image endpoint selected prompt: {repr(use_prompt)}")
+        logger.debug(f"Using custom prompt: {prompt is not None}")
         
         # Process with DeepSeek-OCR
-        print(f"[DEBUG] Sending image to DeepSeek-OCR...")
-        result = process_single_image(image, use_prompt)
-        print(f"[DEBUG] OCR complete, output length: {len(result)}")
+        logger.debug("Sending image to DeepSeek-OCR...")
+        result = await engine.run(1, lambda: process_single_image(image, use_prompt, request_quality(request, lane)), received)
+        logger.debug(f"OCR complete, output length: {len(result.text)}")
         
-        return OCRResponse(
+        return render_response(request, OCRResponse(
             success=True,
-            result=result,
-            page_count=1
-        )
+            result=result.text,
+            page_count=1,
+            truncated=result.truncated,
+            max_tokens=result.max_tokens,
+            draft_acceptance=result.draft_acceptance,
+            tokens_per_second=result.tokens_per_second,
+            attempt=result.attempt,
+            mode=result.mode,
+            max_crops=result.max_crops
+        ), response_format)
         
     except Exception as e:
-        print(f"[ERROR] Image endpoint failed: {str(e)}")
-        return OCRResponse(
+        logger.error(f"Image endpoint failed: {str(e)}")
+        return render_response(request, OCRResponse(
             success=False,
             error=str(e)
-        )
+        ), response_format)
 
 @app.post("/ocr/pdf", response_model=BatchOCRResponse)
-async def process_pdf_endpoint(file: UploadFile = File(...), prompt: Optional[str] = Form(None)):
+async def process_pdf_endpoint(request: Request, file: UploadFile = File(...), prompt: Optional[str] = Form(None),
+                               lane: Optional[str] = Form(None), response_format: str = Depends(negotiate_format)):
     """Process a PDF file with optional custom prompt"""
+    received = time.monotonic()
     try:
-        print(f"[DEBUG] PDF endpoint called for file: {file.filename}")
-        print(f"[DEBUG] Received prompt parameter: {repr(prompt)}")
-        print(f"[DEBUG] Default PROMPT from config: {repr(PROMPT)}")
+        logger.debug(f"PDF endpoint called for file: {file.filename}")
+        logger.debug(f"Received prompt parameter: {repr(prompt)}")
+        logger.debug(f"Default PROMPT from config: {repr(PROMPT)}")
         
         # Read PDF data
         pdf_data = await file.read()
-        print(f"[DEBUG] Read {len(pdf_data)} bytes of PDF data")
+        logger.debug(f"Read {len(pdf_data)} bytes of PDF data")
         
         # Convert PDF to images
-        images = pdf_to_images_high_quality(pdf_data, dpi=144)
-        print(f"[DEBUG] Converted PDF to {len(images)} images")
+        images = await asyncio.to_thread(pdf_to_images_high_quality, pdf_data, dpi=144)
+        logger.debug(f"Converted PDF to {len(images)} images")
         
         if not images:
-            print(f"[DEBUG] No images extracted from PDF")
-            return BatchOCRResponse(
+            logger.debug("No images extracted from PDF")
+            return render_response(request, BatchOCRResponse(
                 success=False,
                 results=[],
                 total_pages=0,
                 filename=file.filename
-            )
+            ), response_format)
         
         # Use provided prompt or default
         use_prompt = prompt if prompt else PROMPT
-        print(f"[DEBUG] PDF endpoint selected prompt: {repr(use_prompt)}")
-        print(f"[DEBUG] Using custom prompt: {prompt is not None}")
+        logger.debug(f"PDF endpoint selected prompt: {repr(use_prompt)}")
+        logger.debug(f"Using custom prompt: {prompt is not None}")
         
-        # Process each page
-        results = []
-        for page_num, image in enumerate(tqdm(images, desc="Processing pages")):
-            try:
-                print(f"[DEBUG] Processing page {page_num + 1}/{len(images)}")
-                result = process_single_image(image, use_prompt)
-                results.append(OCRResponse(
-                    success=True,
-                    result=result,
-                    page_count=page_num + 1
-                ))
-                print(f"[DEBUG] Page {page_num + 1} processed successfully, output length: {len(result)}")
-            except Exception as e:
-                print(f"[ERROR] Page {page_num + 1} failed: {str(e)}")
-                results.append(OCRResponse(
-                    success=False,
-                    error=f"Page {page_num + 1} error: {str(e)}",
-                    page_count=page_num + 1
-                ))
+        # Process all pages in one batch
+        results = page_responses(await engine.run(
+            len(images), lambda: process_pages(images, use_prompt, request_quality(request, lane)), received))
         
-        print(f"[DEBUG] PDF processing complete: {len(results)} pages processed")
-        return BatchOCRResponse(
+        logger.debug(f"PDF processing complete: {len(results)} pages processed")
+        return render_response(request, BatchOCRResponse(
             success=True,
             results=results,
             total_pages=len(images),
             filename=file.filename
-        )
+        ), response_format)
         
     except Exception as e:
-        print(f"[ERROR] PDF endpoint failed: {str(e)}")
-        return BatchOCRResponse(
+        logger.error(f"PDF endpoint failed: {str(e)}")
+        return render_response(request, BatchOCRResponse(
             success=False,
             results=[OCRResponse(success=False, error=str(e))],
             total_pages=0,
             filename=file.filename
-        )
+        ), response_format)
 
 @app.post("/ocr/batch")
-async def process_batch_endpoint(files: List[UploadFile] = File(...), prompt: Optional[str] = Form(None)):
-    """Process multiple files (images and PDFs) with optional custom prompt"""
-    results = []
-    
+async def process_batch_endpoint(request: Request, files: List[UploadFile] = File(...), prompt: Optional[str] = Form(None),
+                                 lane: Optional[str] = Form(None), response_format: str = Depends(negotiate_format)):
+    """Process multiple files (images and PDFs) with optional custom prompt
+
+    Every file is expanded into pages and all pages are submitted to the engine
+    together. Results are reassembled per file in upload order, and a file that
+    fails to decode only fails its own entry.
+    """
+    received = time.monotonic()
+    use_prompt = prompt if prompt else PROMPT
+    logger.debug(f"Batch endpoint called for {len(files)} files, prompt: {repr(use_prompt)}")
+
+    # Expand every file into pages, remembering which slice belongs to which file
+    pages = []
+    spans = []
     for file in files:
-        if file.filename.lower().endswith('.pdf'):
-            result = await process_pdf_endpoint(file, prompt)
+        is_pdf = file.filename.lower().endswith('.pdf')
+        try:
+            data = await file.read()
+            if is_pdf:
+                file_pages = await asyncio.to_thread(pdf_to_images_high_quality, data, dpi=144)
+            else:
+                file_pages = [await asyncio.to_thread(decode_image, data, cropping=CROP_MODE)]
+            spans.append((file, is_pdf, len(pages), len(file_pages), None))
+            pages.extend(file_pages)
+        except Exception as e:
+            logger.error(f"Failed to read {file.filename}: {str(e)}")
+            spans.append((file, is_pdf, len(pages), 0, e))
+
+    logger.debug(f"Batch expanded to {len(pages)} pages")
+    try:
+        page_results = await engine.run(
+            len(pages), lambda: process_pages(pages, use_prompt, request_quality(request, lane),
+                                              [(start, count) for _, _, start, count, _ in spans]), received)
+    except Exception as e:
+        logger.error(f"Batch generation failed: {str(e)}")
+        page_results = [e] * len(pages)
+
+    results = []
+    for file, is_pdf, start, count, error in spans:
+        file_results = page_responses(page_results[start:start + count])
+        if is_pdf:
+            if error is not None:
+                result = BatchOCRResponse(
+                    success=False,
+                    results=[OCRResponse(success=False, error=str(error))],
+                    total_pages=0,
+                    filename=file.filename
+                )
+            else:
+                result = BatchOCRResponse(
+                    success=count > 0,
+                    results=file_results,
+                    total_pages=count,
+                    filename=file.filename
+                )
         else:
-            result = await process_image_endpoint(file, prompt)
-        
+            if error is None and isinstance(page_results[start], Exception):
+                error = page_results[start]
+            if error is not None:
+                result = OCRResponse(success=False, error=str(error))
+            else:
+                result = file_results[0]
+
         results.append({
             "filename": file.filename,
             "result": result
         })
     
-    return {"success": True, "results": results}
+    return render_response(request, {"success": True, "results": results}, response_format)
 
 if __name__ == "__main__":
     print("Starting DeepSeek-OCR API server...")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# inside the Docker image the modules live (renamed) in /app/DeepSeek-OCR-vllm; the torch-only
+# helpers (vision_encoder, load_control) also import straight from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, '/app/DeepSeek-OCR-vllm')
@@ -0,0 +1,212 @@
+"""The model's image input path must not copy device values back to the host.
+
+Runs on CPU with small stand-ins for SAM, CLIP and the projector that keep the
+real token grid (16 x 16 per global view, 10 x 10 per tile), so only the
+parsing, batching and scatter logic of DeepseekOCRForCausalLM is exercised.
+"""
+
+import io
+from collections import OrderedDict
+
+import pytest
+import torch
+from PIL import Image
+from torch import nn
+from torch.nn import functional as F
+
+pytest.importorskip('vllm')
+
+from deepseek_ocr import DeepseekOCRForCausalLM  # noqa: E402
+from process.image_process import (VISION_EMBEDDING_CACHE, DeepseekOCRProcessor, HostTensor,  # noqa: E402
+                                   count_image_tokens, decode_image, host_tensor)
+from vision_encoder import EncoderStats, VisionEncoder  # noqa: E402
+
+N_EMBED = 8
+
+
+class StandInSam(nn.Module):
+    """(B, 4, H / 64, W / 64) features, the token grid of the real SAM neck"""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, kernel_size=64, stride=64)
+
+    def forward(self, views):
+        return self.conv(views)
+
+
+class StandInClip(nn.Module):
+    """class token plus one 4-dim feature per SAM position"""
+
+    def forward(self, views, sam_features):
+        tokens = sam_features.flatten(2).permute(0, 2, 1)
+        return torch.cat([tokens.new_zeros(tokens.shape[0], 1, tokens.shape[2]), tokens * 2], dim=1)
+
+
+class MeanSam(nn.Module):
+    """Like StandInSam, but every position carries the mean of its 64 x 64 patch, so features identify views"""
+
+    def forward(self, views):
+        return F.avg_pool2d(views, 64)[:, :1].expand(-1, 4, -1, -1)
+
+
+def make_model(sam=None):
+    model = DeepseekOCRForCausalLM.__new__(DeepseekOCRForCausalLM)
+    nn.Module.__init__(model)
+    model.sam_model = (sam or StandInSam()).to(torch.bfloat16)
+    model.vision_model = StandInClip()
+    model.projector = nn.Linear(8, N_EMBED).to(torch.bfloat16)
+    model.vision_encoder = VisionEncoder(model.sam_model, model.vision_model, model.projector, stats=EncoderStats())
+    model.image_newline = nn.Parameter(torch.zeros(N_EMBED, dtype=torch.bfloat16))
+    model.view_seperator = nn.Parameter(torch.ones(N_EMBED, dtype=torch.bfloat16))
+    return model
+
+
+def image_kwargs(grids, keys):
+    """Batched multimodal kwargs of one single-image request per (num_width_tiles, num_height_tiles) grid"""
+    return dict(
+        pixel_values=torch.zeros((len(grids), 1, 3, 1024, 1024), dtype=torch.uint8),
+        # tile stacks of different sizes cannot be stacked, so vLLM passes a list of (1, n_tiles, 3, S, S)
+        images_crop=[torch.zeros((1, cols * rows, 3, 640, 640), dtype=torch.uint8) for cols, rows in grids],
+        images_spatial_crop=host_tensor([[grid] for grid in grids]),
+        image_hashes=host_tensor([[key] for key in keys]),
+    )
+
+
+@pytest.fixture
+def no_host_sync(monkeypatch):
+    """Reading any tensor value in Python fails, except the host-side metadata"""
+    def guard(name):
+        original = getattr(torch.Tensor, name)
+
+        def read(self, *args, **kwargs):
+            if isinstance(self, HostTensor):
+                return original(self, *args, **kwargs)
+            raise AssertionError(f'device value synced to the host through Tensor.{name}')
+        return read
+
+    for name in ('item', 'tolist', '__bool__'):
+        monkeypatch.setattr(torch.Tensor, name, guard(name))
+
+
+@pytest.fixture
+def vision_cache(monkeypatch):
+    monkeypatch.setattr(VISION_EMBEDDING_CACHE, 'max_bytes', 1 << 24)
+    monkeypatch.setattr(VISION_EMBEDDING_CACHE, '_cache', OrderedDict())
+    for counter in ('bytes', 'hits', 'misses'):
+        monkeypatch.setattr(VISION_EMBEDDING_CACHE, counter, 0)
+    return VISION_EMBEDDING_CACHE
+
+
+GRIDS = [(3, 2), (1, 1), (2, 3)]
+
+
+def test_parse_reads_shapes_only(no_host_sync):
+    model = make_model()
+    image_input = model._parse_and_validate_image_input(**image_kwargs(GRIDS, [0, 0, 0]))
+    assert len(image_input) == 4
+    assert model._parse_and_validate_image_input(
+        pixel_values=torch.zeros((1, 1, 3, 1024, 1024), dtype=torch.uint8),
+        images_crop=torch.zeros((1, 1, 1, 1, 3, 640, 640), dtype=torch.uint8),
+        images_spatial_crop=host_tensor([[[0]]]),
+        image_hashes=host_tensor([[0]])) is None
+
+
+def test_embeddings_without_host_sync(no_host_sync, monkeypatch):
+    monkeypatch.setattr(VISION_EMBEDDING_CACHE, 'max_bytes', 0)
+    embeddings = make_model().get_multimodal_embeddings(**image_kwargs(GRIDS, [0, 0, 0]))
+    assert [tuple(features.shape) for features in embeddings] == [
+        (count_image_tokens(cols, rows, 1024, 640), N_EMBED) for cols, rows in GRIDS]
+
+
+def test_cached_embeddings_without_host_sync(no_host_sync, vision_cache):
+    model = make_model()
+    first = model.get_multimodal_embeddings(**image_kwargs(GRIDS, [11, 0, 13]))
+    again = model.get_multimodal_embeddings(**image_kwargs(GRIDS, [11, 0, 13]))
+    assert [tuple(features.shape) for features in again] == [tuple(features.shape) for features in first]
+    assert again[0] is first[0] and again[2] is first[2]
+    assert again[1] is not first[1]  # key 0 is never cached
+
+
+def jpeg(width, height, color=0):
+    buffer = io.BytesIO()
+    Image.linear_gradient('L').resize((width, height)).convert('RGB').point(lambda v: (v + color) % 256).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def make_processor(base_size=1024, image_size=640, max_crops=6):
+    """Just the resolution settings cache_keys and plan read, without a tokenizer"""
+    processor = DeepseekOCRProcessor.__new__(DeepseekOCRProcessor)
+    processor.base_size, processor.image_size, processor.max_crops = base_size, image_size, max_crops
+    return processor
+
+
+def request_of(processor, data, cropping=True):
+    """(grid, cache key) of one upload under processor's mode and tile budget"""
+    image = decode_image(data, cropping=cropping, base_size=processor.base_size, image_size=processor.image_size)
+    plan = processor.plan(image, cropping)
+    return plan.crop_ratio, processor.cache_keys([image], [plan], cropping)[0]
+
+
+def test_repeated_image_hits_the_cache_and_another_mode_or_plan_misses(vision_cache):
+    page = jpeg(1600, 1000)
+    gundam = request_of(make_processor(), page)
+    requests = [
+        gundam,
+        request_of(make_processor(), page),  # the same upload again, e.g. with another prompt
+        request_of(make_processor(max_crops=2), page),  # another tile plan
+        request_of(make_processor(1024, 1024), page, cropping=False),  # another resolution mode
+        request_of(make_processor(), jpeg(1600, 1000, color=40)),  # another upload
+    ]
+    grids, keys = zip(*requests)
+    assert all(key > 0 for key in keys)
+    assert keys[1] == keys[0] and len(set(keys)) == 4
+    assert grids[2] != grids[0]
+
+    model = make_model()
+    first = model.get_multimodal_embeddings(**image_kwargs(grids[:1], keys[:1]))
+    assert (vision_cache.hits, vision_cache.misses) == (0, 1)
+    rest = model.get_multimodal_embeddings(**image_kwargs(grids[1:], keys[1:]))
+    assert (vision_cache.hits, vision_cache.misses) == (1, 4)
+    assert rest[0] is first[0]
+    assert [tuple(features.shape) for features in rest] == [
+        (count_image_tokens(cols, rows, 1024, 640), N_EMBED) for cols, rows in grids[1:]]
+
+
+def view(value, size):
+    return torch.full((3, size, size), value, dtype=torch.uint8)
+
+
+def test_two_images_are_stitched_in_order():
+    """One request with a 3x2 and a 2x3 image: each tile lands in its own row-major slot"""
+    model = make_model(MeanSam())
+    with torch.no_grad():
+        model.projector.weight.fill_(1 / 8)
+        model.projector.bias.zero_()
+        model.image_newline.fill_(-3)
+        model.view_seperator.fill_(5)
+
+    grids = [(3, 2), (2, 3)]
+    tile_values = [[10 * (idx + 1) for idx in range(6)], [100 + 10 * idx for idx in range(6)]]
+    global_values = [200, 230]
+    embeddings = model.get_multimodal_embeddings(
+        pixel_values=torch.stack([view(value, 1024) for value in global_values]).unsqueeze(0),
+        images_crop=[[torch.stack([view(value, 640) for value in values]) for values in tile_values]],
+        images_spatial_crop=host_tensor([grids]),
+        image_hashes=host_tensor([[0, 0]]),
+    )
+
+    def feature(pixel):
+        # (pixel / 255 - 0.5) / 0.5 through MeanSam, StandInClip (x2) and the averaging projector
+        return 1.5 * (pixel / 127.5 - 1)
+
+    for (cols, rows), values, global_value, features in zip(grids, tile_values, global_values, embeddings):
+        expected = []
+        for row in range(rows):
+            for _ in range(10):
+                expected += [feature(values[row * cols + col]) for col in range(cols) for _ in range(10)] + [-3]
+        for _ in range(16):
+            expected += [feature(global_value)] * 16 + [-3]
+        expected.append(5)
+        assert features.shape == (count_image_tokens(cols, rows, 1024, 640), N_EMBED)
+        assert torch.allclose(features[:, 0].float(), torch.tensor(expected), atol=0.02)
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from benchmark import grounding_page, reference_grounding
+from grounding import DET_RE, MAX_DET_CHARS, page_boxes, parse_det, postprocess
+
+MALFORMED = [
+    "__import__('os').system('true')",
+    "[[1, 2, 3, 4]] * 10 ** 9",
+    "[[1, 2, 3]]",
+    "[[1, 2, 3, 4, 5]]",
+    "[1, 2, 3, 4]",
+    "[[[1, 2, 3, 4]]]",
+    "[[1, 2, 3, 4], [5, 6, 7, 'x']]",
+    "[[1, 2, 3, 4],]",
+    "{'x1': 1}",
+    "[" * 1000 + "]" * 1000,
+    "[[1, 2, 3, 4], " * 100,
+    "",
+]
+
+
+# grounded output as the model writes it: blocks after their refs, an image ref followed by blank lines, a formula
+PAGE = (
+    "<|ref|>title<|/ref|><|det|>[[62, 40, 937, 80]]<|/det|>\n# Annual Report 2023\n\n"
+    "<|ref|>text<|/ref|><|det|>[[62, 100, 937, 200]]<|/det|>\nWe define $x \\coloneqq y$ and $y \\eqqcolon z$.\n\n"
+    "<|ref|>image<|/ref|><|det|>[[100, 220, 900, 600]]<|/det|>\n\n\n"
+    "<|ref|>image_caption<|/ref|><|det|>[[100, 610, 900, 640]]<|/det|>\n<center>Figure 1: Revenue</center>\n\n"
+    "<|ref|>table<|/ref|><|det|>[[62, 660, 937, 900]]<|/det|>\n<table><tr><td>Q1</td><td>10</td></tr></table>\n\n"
+    "<|ref|>image<|/ref|><|det|>[[100, 910, 500, 990]]<|/det|>\n\n"
+    "<|ref|>text<|/ref|><|det|>[[62, 910, 937, 990]]<|/det|>\nFootnote.\n\n\n\n"
+    "<|ref|>equation<|/ref|><|det|>[[62, 40, 937, 80]]<|/det|>\n\\[ E = mc^2 \\quad (1) \\]\n"
+)
+
+
+def image_link(idx, det):
+    return f'![](images/0_{idx}.jpg)\n'
+
+
+@pytest.mark.parametrize('page', [PAGE, grounding_page(1), grounding_page(20)], ids=['page', '1 block', '20 blocks'])
+def test_postprocess_matches_the_replace_pipeline(page):
+    assert postprocess(page, image_link=image_link) == reference_grounding(page)
+
+
+def test_postprocess_differs_from_the_replace_pipeline_where_it_was_inconsistent():
+    # the old chain only ran after dropping a non-image ref, so image-only pages kept \coloneqq and blank-line runs
+    images_only = '<|ref|>image<|/ref|><|det|>[[0, 0, 9, 9]]<|/det|>\n\n\nx \\coloneqq y'
+    assert reference_grounding(images_only) == '![](images/0_0.jpg)\n\n\n\nx \\coloneqq y'
+    assert postprocess(images_only, image_link=image_link) == '![](images/0_0.jpg)\n\nx := y'
+    # \n\n\n\n -> \n\n then \n\n\n -> \n\n left three newlines of a run of six
+    long_run = '<|ref|>text<|/ref|><|det|>[[0, 0, 9, 9]]<|/det|>a\n\n\n\n\n\nb'
+    assert reference_grounding(long_run) == 'a\n\n\nb'
+    assert postprocess(long_run) == 'a\n\nb'
+    # str.replace gave every copy of a repeated image ref the first one's link
+    twice = '<|ref|>image<|/ref|><|det|>[[0, 0, 9, 9]]<|/det|>' * 2
+    assert reference_grounding(twice) == image_link(0, '') * 2
+    assert postprocess(twice, image_link=image_link) == image_link(0, '') + image_link(1, '')
+
+
+def test_a_well_formed_payload_is_read_as_boxes():
+    boxes = parse_det('[[100, 200, 300.5, 400], [0,0,999,999]]')
+    assert boxes.dtype == np.float64
+    assert boxes.tolist() == [[100, 200, 300.5, 400], [0, 0, 999, 999]]
+    assert parse_det(' [ ] ').shape == (0, 4)
+
+
+@pytest.mark.parametrize('payload', MALFORMED)
+def test_malformed_payloads_are_rejected(payload):
+    assert DET_RE.fullmatch(payload) is None
+    with pytest.raises(ValueError, match='malformed det payload'):
+        parse_det(payload)
+
+
+def test_oversized_payloads_are_rejected_before_matching():
+    box = '[1, 2, 3, 4], '
+    payload = '[' + box * (MAX_DET_CHARS // len(box)) + '[1, 2, 3, 4]]'
+    assert len(payload) > MAX_DET_CHARS and DET_RE.fullmatch(payload) is not None
+    with pytest.raises(ValueError):
+        parse_det(payload)
+
+
+def test_page_boxes_skip_malformed_refs():
+    refs = [('', 'image', '[[0, 0, 999, 999]]'), ('', 'text', "__import__('os')"), ('', 'title', '[[0, 0, 499.5, 999]]')]
+    first, bad, last = page_boxes(refs, 1000, 2000)
+    assert bad is None
+    assert first[0] == 'image' and first[1].tolist() == [[0, 0, 1000, 2000]]
+    assert last[0] == 'title' and last[1].tolist() == [[0, 0, 500, 2000]]
+
+
+@pytest.mark.parametrize('module, name', [('pdf_to_markdown_processor_enhanced', 'PDFToMarkdownProcessor'),
+                                          ('pdf_to_ocr_enhanced', 'PDFToOCRProcessor'),
+                                          ('pdf_to_custom_prompt_enhanced', 'PDFToCustomPromptProcessor')])
+def test_clients_drop_image_refs_with_malformed_payloads(module, name, tmp_path):
+    # the host-side clients need PyMuPDF and requests, which the server image does not install
+    pytest.importorskip('fitz')
+    pytest.importorskip('requests')
+    processor_class = getattr(pytest.importorskip(module), name)
+    processor = processor_class.__new__(processor_class)
+    processor.extract_images = True
+    processor.images_folder = tmp_path
+    processor._pdf_to_images = lambda pdf_path: [Image.new('RGB', (1000, 1000), 'white')]
+
+    saved = []
+    image_link = processor._image_link('doc.pdf', 0, saved)
+    content = ("<|ref|>image<|/ref|><|det|>__import__('os').system('true')<|/det|>\ntext\n"
+               "<|ref|>image<|/ref|><|det|>[[0, 0, 500, 500]]<|/det|>\n")
+    assert postprocess(content, image_link=image_link) == "\ntext\n![](images/doc_page0_0.jpg)\n\n"
+    assert saved == ['doc_page0_0.jpg'] and (tmp_path / 'doc_page0_0.jpg').exists()
@@ -0,0 +1,133 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+from typing import NamedTuple
+
+import pytest
+
+from load_control import EngineWorker, LoadController
+
+
+class Level(NamedTuple):
+    crops: int
+
+    def describe(self):
+        return f"max_crops={self.crops}"
+
+
+LEVELS = [Level(6), Level(4)]
+
+
+def make_controller():
+    return LoadController(LEVELS, queue_high=1, queue_low=0, latency_slo=60.0, restore_fraction=0.5,
+                          window=50, hold_seconds=0.0, default_lane='interactive', policies={})
+
+
+class FakeEngine:
+    """LLMEngine stand-in: a request finishes after `params` steps, and every step advances all unfinished requests"""
+
+    def __init__(self, gate=None):
+        self.gate = gate
+        self.remaining = {}
+        self.prompts = {}
+        self.steps = []  # prompts advanced by each step
+
+    def add_request(self, request_id, prompt, params):
+        self.remaining[request_id] = params
+        self.prompts[request_id] = prompt
+
+    def abort_request(self, request_id):
+        del self.remaining[request_id]
+
+    def step(self):
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.steps.append(sorted(self.prompts[request_id] for request_id in self.remaining))
+        time.sleep(0.01)
+        outputs = []
+        for request_id in list(self.remaining):
+            self.remaining[request_id] -= 1
+            finished = not self.remaining[request_id]
+            if finished:
+                del self.remaining[request_id]
+            outputs.append(SimpleNamespace(request_id=request_id, prompt=self.prompts[request_id], finished=finished))
+        return outputs
+
+
+def prompts(outputs):
+    return [output.prompt for output in outputs]
+
+
+def test_concurrent_requests_are_admitted_on_arrival():
+    controller = make_controller()
+    engine = EngineWorker(controller)
+    released = threading.Event()
+    engine.start(FakeEngine(gate=released))
+
+    def generate(page):
+        return prompts(engine.generate([page], [2])), controller.level_for(lane='bulk')
+
+    async def serve():
+        calls = [asyncio.ensure_future(engine.run(1, lambda page=page: generate(page))) for page in 'abc']
+        await asyncio.sleep(0.05)
+        # every request is counted on arrival, while the engine is still busy
+        assert controller.queued == 3
+        assert controller.level == 1
+        released.set()
+        return await asyncio.gather(*calls)
+
+    assert asyncio.run(serve()) == [(['a'], 1), (['b'], 1), (['c'], 1)]
+    assert controller.queued == 0
+    assert controller.latency() >= 0.05
+
+
+def test_pages_of_concurrent_requests_share_engine_steps():
+    engine = EngineWorker()
+    fake = FakeEngine()
+    engine.start(fake)
+
+    async def serve():
+        long = asyncio.ensure_future(engine.run(2, lambda: prompts(engine.generate(['a1', 'a2'], [20, 20]))))
+        await asyncio.sleep(0.05)
+        # arrives while the first request decodes: joins its batch and finishes first instead of waiting for it
+        short = await engine.run(1, lambda: prompts(engine.generate(['b1'], [2])))
+        assert not long.done()
+        return await long, short
+
+    assert asyncio.run(serve()) == (['a1', 'a2'], ['b1'])
+    assert ['a1', 'a2', 'b1'] in fake.steps
+    assert len(fake.steps) == 20
+
+
+def test_a_failed_engine_step_fails_its_requests_and_the_loop_goes_on():
+    engine = EngineWorker()
+    fake = FakeEngine()
+    engine.start(fake)
+
+    def step():
+        fake.step = FakeEngine.step.__get__(fake)
+        raise RuntimeError("CUDA error")
+
+    fake.step = step
+    with pytest.raises(RuntimeError):
+        engine.generate(['a'], [1])
+    assert not fake.remaining
+    assert prompts(engine.generate(['b'], [1])) == ['b']
+
+
+def test_event_loop_stays_free_while_a_request_runs():
+    engine = EngineWorker()
+    ticks = []
+
+    async def tick():
+        while len(ticks) < 5:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.02)
+
+    async def serve():
+        return await asyncio.gather(engine.run(1, lambda: time.sleep(0.2) or 'done'), tick())
+
+    result, _ = asyncio.run(serve())
+    assert result == 'done'
+    assert ticks[-1] - ticks[0] < 0.2
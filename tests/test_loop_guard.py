@@ -0,0 +1,90 @@
+import pytest
+import torch
+
+pytest.importorskip('config')
+
+from config import LOOP_MIN_SPAN  # noqa: E402
+from loop_guard import LoopAbortLogitsProcessor, find_loop, loop_at_end  # noqa: E402
+
+EOS = 1
+# small thresholds for the online tests: loops of up to 8 tokens, confirmed over 16 tokens and 3 copies
+SMALL = dict(max_period=8, min_span=16, min_repeats=3)
+
+
+def table_rows(count):
+    """<tr><td>n</td><td>n+1</td></tr> rows: the same markup every row, different cell contents"""
+    return [token for n in range(count) for token in (10, 11, 1000 + n, 12, 11, 2000 + n, 12, 13)]
+
+
+def dotted_leader(dots, page=3000):
+    """'Chapter ........ 12' with a run of one dot token"""
+    return [20, 21] + [22] * dots + [page]
+
+
+def aborted(logits):
+    return bool(logits[EOS] == 0 and torch.isinf(logits).sum() == logits.numel() - 1)
+
+
+def test_a_loop_is_salvaged_as_its_start_plus_one_copy():
+    prefix, span = list(range(100, 140)), list(range(200, 250))
+    ids = prefix + span * 15
+    for loop in (find_loop(ids), loop_at_end(ids)):
+        assert (loop.start, loop.period) == (len(prefix), len(span))
+        assert ids[:loop.salvaged] == prefix + span
+    assert find_loop(ids).end == len(prefix) + len(span) + LOOP_MIN_SPAN - 1
+    assert loop_at_end(ids).end == len(ids) - 1
+
+
+def test_table_rows_and_dotted_leaders_do_not_abort_below_the_thresholds():
+    # markup repeating every row with fresh contents, exact rows repeated over less than LOOP_MIN_SPAN, and a long leader
+    exact_rows = [10, 11, 5000, 12, 13] * ((LOOP_MIN_SPAN - 1) // 5)
+    for ids in (table_rows(200), exact_rows, dotted_leader(LOOP_MIN_SPAN - 1)):
+        assert find_loop(ids) is None
+        assert loop_at_end(ids) is None
+        assert not aborted(LoopAbortLogitsProcessor(EOS)(ids, torch.zeros(8)))
+    # a leader that keeps going past LOOP_MIN_SPAN is a loop
+    assert find_loop([20, 21] + [22] * (LOOP_MIN_SPAN + 1)).period == 1
+
+
+def decode(processor, rows, steps):
+    """Feed the rows' (seq_id, token ids) one token per step; the step at which each row was aborted"""
+    stopped = {}
+    for length in range(1, steps + 1):
+        live = [(row, seq_id, ids[:length]) for row, (seq_id, ids) in enumerate(rows) if row not in stopped]
+        logits = processor.apply_batch(torch.zeros(len(rows), 8), [row for row, _, _ in live],
+                                       [seq_id for _, seq_id, _ in live], [ids for _, _, ids in live])
+        for row, _, ids in live:
+            # the per-sequence path agrees with the batched one at every step
+            assert aborted(logits[row]) == aborted(processor(ids, torch.zeros(8)))
+            if aborted(logits[row]):
+                stopped[row] = length
+    return stopped
+
+
+def test_batched_abort_matches_the_offline_detector_per_row():
+    looping = [5, 6, 7] + [30, 31, 32] * 20
+    clean = list(range(100, 160))
+    leader = [20] + [22] * 15 + list(range(300, 344))
+    processor = LoopAbortLogitsProcessor(EOS, **SMALL)
+    stopped = decode(processor, [(0, looping), (1, clean), (2, leader)], 60)
+    # only the looping row is stopped, right after the token confirming its loop
+    assert stopped == {0: find_loop(looping, **SMALL).end + 1}
+    assert find_loop(clean, **SMALL) is None and find_loop(leader, **SMALL) is None
+
+
+def test_run_counters_do_not_carry_over_to_the_next_sequence_in_a_row():
+    pattern = [40, 41] * 12
+    confirmed = find_loop(pattern, **SMALL).end + 1
+    processor = LoopAbortLogitsProcessor(EOS, **SMALL)
+    # the first sequence finishes one token short of confirming its loop
+    assert decode(processor, [(0, pattern[:confirmed - 1])], confirmed - 1) == {}
+    # the next sequence in the same batch row continues the pattern, but its own run starts from zero
+    assert decode(processor, [(1, pattern)], len(pattern)) == {0: confirmed}
+
+    # rows freed by finished sequences are reused once the buffer is full, and rebuilt from the new tokens
+    processor = LoopAbortLogitsProcessor(EOS, **SMALL)
+    assert decode(processor, [(seq_id, pattern[:confirmed - 1]) for seq_id in range(64)], confirmed - 1) == {}
+    capacity = processor._slots.capacity
+    stopped = decode(processor, [(64 + seq_id, pattern) for seq_id in range(64)], len(pattern))
+    assert processor._slots.capacity == capacity
+    assert set(stopped.values()) == {confirmed}
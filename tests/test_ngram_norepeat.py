@@ -0,0 +1,115 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from benchmark import reference_no_repeat_ngram
+
+try:
+    from process.ngram_norepeat import NoRepeatNGramLogitsProcessor, batched_logits_processors
+except ImportError:  # outside the Docker image the module keeps its repository name
+    from custom_ngram_norepeat import NoRepeatNGramLogitsProcessor, batched_logits_processors
+
+NGRAM, WINDOW, WHITELIST, VOCAB = 3, 12, {5}, 8
+
+
+def make_processor():
+    return NoRepeatNGramLogitsProcessor(ngram_size=NGRAM, window_size=WINDOW, whitelist_token_ids=WHITELIST)
+
+
+def random_outputs(count, length, seed=0):
+    """Token ids from a tiny vocabulary, so repeated n-grams (and whitelisted ones) occur often"""
+    rng = random.Random(seed)
+    return [[rng.randrange(VOCAB) for _ in range(length)] for _ in range(count)]
+
+
+def expected_bans(logits, prefixes):
+    expected = logits.clone()
+    for row, ids in enumerate(prefixes):
+        expected[row] = reference_no_repeat_ngram(ids, expected[row], NGRAM, WINDOW, WHITELIST)
+    return expected
+
+
+def metadata_for(params, seq_ids, prefixes):
+    """vLLM sampling metadata with one sequence per group, row i holding seq_ids[i]"""
+    seq_data = {seq_id: SimpleNamespace(output_token_ids=ids) for seq_id, ids in zip(seq_ids, prefixes)}
+    return SimpleNamespace(seq_groups=[
+        SimpleNamespace(sampling_params=params, seq_ids=[seq_id], sample_indices=[row], seq_data=seq_data)
+        for row, seq_id in enumerate(seq_ids)])
+
+
+def run_batched(params, seq_ids, prefixes, logits):
+    with batched_logits_processors(metadata_for(params, seq_ids, prefixes)) as apply:
+        return apply(logits.clone())
+
+
+def test_batched_context_matches_the_per_sequence_reference_at_every_step():
+    outputs = random_outputs(6, 40)
+    params = SimpleNamespace(logits_processors=[make_processor()])
+    logits = torch.randn(len(outputs), VOCAB)
+    banned = 0
+    for step in range(40):
+        prefixes = [ids[:step] for ids in outputs]
+        expected = expected_bans(logits, prefixes)
+        assert torch.equal(run_batched(params, list(range(len(outputs))), prefixes, logits), expected), step
+        banned += int(torch.isinf(expected).sum())
+    assert banned
+
+
+def test_apply_batch_and_call_match_the_reference():
+    outputs = random_outputs(4, 30, seed=1)
+    logits = torch.randn(len(outputs), VOCAB)
+    batched, single = make_processor(), make_processor()
+    for step in (0, NGRAM - 1, NGRAM, 17, 30):
+        prefixes = [ids[:step] for ids in outputs]
+        expected = expected_bans(logits, prefixes)
+        # rows of the logits need not follow the sequence order
+        rows = [2, 0, 3, 1]
+        actual = batched.apply_batch(logits.clone(), rows, [10, 11, 12, 13], [prefixes[row] for row in rows])
+        assert torch.equal(actual, expected)
+        for row, ids in enumerate(prefixes):
+            assert torch.equal(single(ids, logits[row]), expected[row])
+
+
+def test_rows_of_finished_sequences_are_reused_without_their_tokens():
+    processor = make_processor()
+    params = SimpleNamespace(logits_processors=[processor])
+    first = random_outputs(64, 20, seed=2)
+    logits = torch.randn(64, VOCAB)
+    for step in (10, 20):
+        prefixes = [ids[:step] for ids in first]
+        assert torch.equal(run_batched(params, list(range(64)), prefixes, logits), expected_bans(logits, prefixes))
+    capacity = processor._slots.capacity
+
+    # every first sequence has finished: the new ones take over their rows instead of growing the buffer
+    second = random_outputs(64, 20, seed=3)
+    for step in (1, NGRAM, 15, 20):
+        prefixes = [ids[:step] for ids in second]
+        actual = run_batched(params, list(range(64, 128)), prefixes, logits)
+        assert torch.equal(actual, expected_bans(logits, prefixes))
+    assert processor._slots.capacity == capacity
+
+
+def test_a_sequence_id_restarting_shorter_gets_a_fresh_row():
+    processor = make_processor()
+    params = SimpleNamespace(logits_processors=[processor])
+    old, new = random_outputs(2, 25, seed=4)
+    logits = torch.randn(1, VOCAB)
+    run_batched(params, [0], [old], logits)
+    for step in (2, 8, 25):
+        assert torch.equal(run_batched(params, [0], [new[:step]], logits), expected_bans(logits, [new[:step]]))
+
+
+def test_processor_lists_are_restored_when_the_step_raises():
+    def other(ids, scores):
+        return scores
+
+    processors = [make_processor(), other]
+    params = SimpleNamespace(logits_processors=processors)
+    with pytest.raises(RuntimeError):
+        with batched_logits_processors(metadata_for(params, [0, 1], [[1, 2], [3, 4]])):
+            # vLLM's per-row loop only sees the regular processors during the step
+            assert params.logits_processors == [other]
+            raise RuntimeError("sampler failed")
+    assert params.logits_processors is processors
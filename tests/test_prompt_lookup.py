@@ -0,0 +1,66 @@
+import pytest
+
+pytest.importorskip('config')
+
+from prompt_lookup import DocumentContext, PromptLookupProposer  # noqa: E402
+
+
+def decode_document(num_pages, batch, lookback):
+    """Decode num_pages pages of 20 tokens, at most batch at a time, in page order; pages kept after each step"""
+    proposer = PromptLookupProposer(2, 4)
+    document = DocumentContext(lookback)
+    kept = []
+    waiting = list(range(num_pages))
+    running = {}
+    while waiting or running:
+        while waiting and len(running) < batch:
+            running[waiting.pop(0)] = 0
+        for page in running:
+            running[page] += 1
+            proposer.propose(page, list(range(running[page])), 3, str(page), document, page)
+        running = {page: length for page, length in running.items() if length < 20}
+        proposer.retire(set(running))
+        kept.append(set(document.pages))
+    return document, kept
+
+
+def test_one_page_at_a_time_keeps_the_lookback_window():
+    document, kept = decode_document(10, batch=1, lookback=2)
+    assert max(len(pages) for pages in kept) <= 3
+    assert set(document.pages) == {8, 9}
+
+
+def test_pages_decoding_together_keep_their_earlier_pages():
+    document, kept = decode_document(10, batch=4, lookback=2)
+    # a batch of four pages needs up to two pages before its oldest one
+    assert max(len(pages) for pages in kept) <= 6
+    assert set(document.pages) >= {8, 9}
+
+
+def test_earlier_follows_the_window():
+    document = DocumentContext(2)
+    proposer = PromptLookupProposer(2, 4)
+    for page in range(5):
+        proposer.propose(page, [1, 2, 3], 3, str(page), document, page)
+    proposer.retire({3, 4})
+    assert set(document.pages) == {1, 2, 3, 4}
+    assert document.earlier(4) == [document.pages[3], document.pages[2]]
+
+
+def test_speculative_config_refuses_a_vllm_without_the_pinned_ngram_worker(monkeypatch):
+    vllm = pytest.importorskip('vllm')
+    import prompt_lookup
+    from vllm.spec_decode import spec_decode_worker
+
+    monkeypatch.setattr(prompt_lookup, 'SPECULATIVE_NGRAM', True)
+    # restored after the test, whichever worker speculative_config leaves behind
+    monkeypatch.setattr(spec_decode_worker, 'NGramWorker', spec_decode_worker.NGramWorker)
+    monkeypatch.setattr(vllm, '__version__', '0.9.0')
+    with pytest.raises(RuntimeError, match='SPECULATIVE_NGRAM = False'):
+        prompt_lookup.speculative_config()
+    assert spec_decode_worker.NGramWorker is not prompt_lookup.DocumentNGramWorker
+
+    monkeypatch.setattr(vllm, '__version__', prompt_lookup.VLLM_VERSION)
+    monkeypatch.delattr(spec_decode_worker, 'NGramWorker')
+    with pytest.raises(RuntimeError, match='without it'):
+        prompt_lookup.speculative_config()
@@ -0,0 +1,75 @@
+import random
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('config')
+
+from PIL import Image  # noqa: E402
+
+from config import CASCADE_MAX_REPETITION, CASCADE_MIN_LOGPROB, CASCADE_MIN_TEXT_RATIO, PROMPT  # noqa: E402
+from quality_cascade import completion_signals, escalation_reasons, page_signals, repetition_score  # noqa: E402
+from token_budget import estimate_tokens  # noqa: E402
+
+# a page inking 2% of its area, read with the default grounding prompt
+INK = 0.02
+EXPECTED = estimate_tokens(INK, 0, PROMPT)
+
+
+def prose(count, seed=0):
+    """Token ids of running text: no n-gram comes back"""
+    rng = random.Random(seed)
+    return [rng.randrange(100000) for _ in range(count)]
+
+
+def signals_of(token_ids, eos=True, mean_logprob=-0.05, ink=INK):
+    return page_signals(token_ids, eos, mean_logprob * len(token_ids), ink, 0, PROMPT)
+
+
+def test_repetition_score():
+    assert repetition_score(prose(500), n=8) == 0.0
+    assert repetition_score([7] * 8, n=8) == 0.0
+    # 93 windows of 8 over a 10-token span repeated 10 times, 10 of them distinct
+    assert repetition_score(list(range(10)) * 10, n=8) == pytest.approx(1 - 10 / 93)
+
+
+def test_a_clean_page_stays_at_the_cheap_mode():
+    signals = signals_of(prose(EXPECTED))
+    assert signals.eos and signals.repetition == 0.0 and signals.text_ratio == pytest.approx(1.0)
+    assert escalation_reasons(signals) == []
+
+
+def test_an_empty_page_is_escalated_for_its_text_ratio():
+    signals = signals_of([])
+    assert signals.tokens == 0 and signals.mean_logprob is None
+    assert escalation_reasons(signals) == ['text ratio 0.00']
+    # a blank page is expected to be empty
+    assert escalation_reasons(signals_of([], ink=0.0)) == []
+
+
+def test_a_looping_page_is_escalated_for_its_repetition():
+    looping = prose(200) + list(range(100, 130)) * 50
+    signals = signals_of(looping)
+    assert signals.repetition > CASCADE_MAX_REPETITION
+    assert escalation_reasons(signals) == [f'repetition {signals.repetition:.0%}']
+
+
+def test_a_truncated_page_is_escalated_for_missing_eos():
+    assert escalation_reasons(signals_of(prose(EXPECTED), eos=False)) == ['no EOS']
+
+
+def test_an_unsure_or_short_page_is_escalated():
+    unsure = signals_of(prose(EXPECTED), mean_logprob=2 * CASCADE_MIN_LOGPROB)
+    assert escalation_reasons(unsure) == [f'mean logprob {2 * CASCADE_MIN_LOGPROB:.2f}']
+    short = signals_of(prose(int(EXPECTED * CASCADE_MIN_TEXT_RATIO / 2)))
+    assert escalation_reasons(short) == [f'text ratio {short.text_ratio:.2f}']
+
+
+def test_completion_signals_drop_the_eos_token():
+    eos_token_id = 1
+    completion = SimpleNamespace(token_ids=prose(100) + [eos_token_id], cumulative_logprob=-5.0)
+    signals = completion_signals(completion, True, eos_token_id, Image.new('RGB', (640, 640), 'white'), PROMPT)
+    assert signals.tokens == 100 and signals.mean_logprob == pytest.approx(-0.05)
+    # a white page sets no text expectation
+    assert signals.text_ratio is None
+    assert escalation_reasons(signals) == []
@@ -0,0 +1,91 @@
+import torch
+from torch import nn
+
+from vision_encoder import EncoderStats, VisionEncoder
+
+
+class StandInSam(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.conv = nn.Conv2d(3, 4, kernel_size=16, stride=16)
+
+    def forward(self, views):
+        return self.conv(views)
+
+
+class StandInClip(nn.Module):
+    def forward(self, views, sam_features):
+        tokens = sam_features.flatten(2).permute(0, 2, 1)
+        return torch.cat([tokens.new_zeros(tokens.shape[0], 1, tokens.shape[2]), tokens], dim=1)
+
+
+def make_encoder():
+    torch.manual_seed(0)
+    return VisionEncoder(StandInSam(), StandInClip(), nn.Linear(8, 6), batch_pixels=8 * 64 * 64,
+                         buckets=(1, 2, 4, 8), stats=EncoderStats())
+
+
+def fail_compiled(views):
+    raise RuntimeError('compiled forward failed')
+
+
+def test_compile_failure_falls_back_to_eager():
+    encoder = make_encoder()
+    encoder.compile_mode = 'default'
+    encoder._forward = fail_compiled
+    views = torch.randn(3, 3, 64, 64)
+
+    with torch.no_grad():
+        features = encoder(views)
+        expected = encoder.eager_forward(views)
+
+    assert features.shape == (3, 16, 6)
+    assert torch.equal(features, expected)
+    assert encoder.compile_mode is None
+    info = encoder.stats.info()
+    assert info["compile_failures"] == 1
+    assert "(4, 3, 64, 64)" in info["last_compile_failure"]
+
+
+def test_warmup_stops_at_compile_failure():
+    encoder = make_encoder()
+    encoder.compile_mode = 'default'
+    encoder._forward = fail_compiled
+
+    assert encoder.warmup(encoder.warmup_shapes([(64, 64)]), dtype=torch.float32) is False
+    assert encoder.compile_mode is None
+    assert encoder.stats.compile_failures == 1
+
+
+def test_padded_rows_are_dropped():
+    encoder = make_encoder()
+    encoder.compile_mode = 'default'
+    views = torch.randn(3, 3, 64, 64)
+
+    with torch.no_grad():
+        features = encoder(views)
+        expected = encoder.eager_forward(views)
+
+    assert features.shape == (3, 16, 6)
+    assert torch.allclose(features, expected, atol=1e-6)
+    assert encoder.stats.padded_views == 1
+
+
+def test_compiled_buckets_match_eager():
+    encoder = make_encoder()
+    encoder.compile('default')
+    torch._dynamo.reset()
+
+    with torch.no_grad():
+        assert encoder.warmup(encoder.warmup_shapes([(64, 64)]), dtype=torch.float32)
+        for num_views in (1, 3, 5, 8):
+            views = torch.randn(num_views, 3, 64, 64)
+            features = encoder(views)
+            # padded to a bucket, run through the compiled graph, and sliced back to the real views
+            assert features.shape == (num_views, 16, 6)
+            assert torch.allclose(features, encoder.eager_forward(views), atol=1e-5)
+
+    assert encoder.compile_mode == 'default'
+    assert encoder.stats.compile_failures == 0, encoder.stats.last_failure
+    assert encoder.stats.shapes == {(size, 3, 64, 64) for size in (1, 2, 4, 8)}
+    assert encoder.stats.padded_views == 1 + 3
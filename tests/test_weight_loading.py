@@ -0,0 +1,34 @@
+import pytest
+import torch
+
+pytest.importorskip('vllm')
+
+from deepseek_ocr import DeepseekOCRForCausalLM  # noqa: E402
+
+# checkpoint names of the released model, and where DeepseekOCRForCausalLM keeps each of them
+RENAMED = {
+    'model.sam_model.blocks.0.attn.qkv.weight': 'sam_model.blocks.0.attn.qkv.weight',
+    'model.vision_model.embeddings.patch_embedding.weight': 'vision_model.embeddings.patch_embedding.weight',
+    'model.projector.layers.weight': 'projector.layers.weight',
+    'model.image_newline': 'image_newline',
+    'model.view_seperator': 'view_seperator',
+    'model.embed_tokens.weight': 'language.model.embed_tokens.weight',
+    'model.layers.0.mlp.experts.0.down_proj.weight': 'language.model.layers.0.mlp.experts.0.down_proj.weight',
+    'lm_head.weight': 'language.lm_head.weight',
+}
+
+
+def test_checkpoint_names_are_renamed_one_tensor_at_a_time():
+    read = []
+
+    def checkpoint():
+        for name in RENAMED:
+            read.append(name)
+            yield name, torch.zeros(1)
+
+    renamed = DeepseekOCRForCausalLM._rename_weights(checkpoint())
+    # nothing is read until the loader asks for a tensor, and then only that tensor
+    assert read == []
+    assert next(renamed)[0] == 'sam_model.blocks.0.attn.qkv.weight'
+    assert read == list(RENAMED)[:1]
+    assert ['sam_model.blocks.0.attn.qkv.weight'] + [name for name, _ in renamed] == list(RENAMED.values())
@@ -0,0 +1,95 @@
+"""
+Per-page output token budgets
+
+Estimates how many output tokens a page needs from cheap signals (the ink
+density of the page image, the character count of a PDF text layer and the
+kind of prompt), so max_tokens can follow the page instead of reserving the
+full ceiling for every sequence. A page that reaches its budget without EOS
+is re-run by the caller with MAX_TOKENS, at the same mode, before any fallback.
+"""
+
+import math
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from config import MAX_TOKENS, MIN_PAGE_TOKENS, TOKEN_BUDGET_SAFETY
+
+# PIL Image.info key carrying the character count of a page's PDF text layer
+TEXT_CHARS_KEY = 'text_chars'
+
+# Calibration of the estimates, before the safety multiplier: a page of ~7500
+# characters (~2000 tokens) in a small bitmap font inks 4% of its area; larger
+# or bolder fonts ink more per character, so this errs on the high side. English
+# text averages ~3.5 characters per token; 1.5 leaves room for CJK and markup
+TOKENS_PER_INK = 50000
+CHARS_PER_TOKEN = 1.5
+GROUNDING_FACTOR = 1.5  # <|ref|>/<|det|> tags around every block
+
+# Prompts whose output scales with the amount of text on the page
+PROPORTIONAL_PROMPTS = {
+    'document': 'convert the document to markdown',
+    'ocr': 'ocr this image',
+    'free': 'free ocr',
+    'figure': 'parse the figure',
+}
+# Prompts whose output length does not depend on the page
+FIXED_BUDGETS = {
+    'describe': ('describe this image', 2048),
+    'locate': ('locate <|ref|>', 256),
+}
+
+BUDGET_STEP = 256
+
+
+def ink_density(image: Image.Image, size: int = 256) -> float:
+    """Fraction of the page covered by ink, measured on a small grayscale thumbnail"""
+    thumbnail = image.convert('L')
+    thumbnail.thumbnail((size, size), Image.BILINEAR)
+    gray = np.asarray(thumbnail, dtype=np.float32)
+    # darkness relative to the paper colour, so tinted or grey scans are not counted as ink
+    background = max(float(np.percentile(gray, 95)), 1.0)
+    return float(np.clip((background - gray) / background, 0.0, 1.0).mean())
+
+
+def prompt_kind(prompt: str) -> Optional[str]:
+    """'document', 'ocr', 'free', 'figure', 'describe', 'locate', or None for prompts with no estimate"""
+    text = prompt.lower()
+    for kind, marker in PROPORTIONAL_PROMPTS.items():
+        if marker in text:
+            return kind
+    for kind, (marker, _) in FIXED_BUDGETS.items():
+        if marker in text:
+            return kind
+    return None
+
+
+def estimate_tokens(ink: float, text_chars: int, prompt: str) -> Optional[int]:
+    """Expected output tokens of a page, or None when the prompt gives no basis for an estimate"""
+    kind = prompt_kind(prompt)
+    if kind in FIXED_BUDGETS:
+        return FIXED_BUDGETS[kind][1]
+    if kind is None:
+        return None
+    # the larger of the two, so a born-digital page with scanned figures is not underestimated
+    estimate = max(ink * TOKENS_PER_INK, text_chars / CHARS_PER_TOKEN)
+    if '<|grounding|>' in prompt:
+        estimate *= GROUNDING_FACTOR
+    return int(estimate)
+
+
+def page_token_budget(image: Image.Image, prompt: str, ceiling: int = MAX_TOKENS,
+                      floor: int = MIN_PAGE_TOKENS, safety: float = TOKEN_BUDGET_SAFETY) -> int:
+    """max_tokens for one page: the estimate times the safety multiplier, between floor and ceiling.
+
+    Budgets are rounded up to multiples of BUDGET_STEP so pages share a few
+    sampling parameter sets. Prompts without an estimate get the ceiling.
+    """
+    kind = prompt_kind(prompt)
+    if kind is None:
+        return ceiling
+    ink = 0.0 if kind in FIXED_BUDGETS else ink_density(image)
+    estimate = estimate_tokens(ink, image.info.get(TEXT_CHARS_KEY, 0), prompt)
+    budget = math.ceil(estimate * safety / BUDGET_STEP) * BUDGET_STEP
+    return max(floor, min(ceiling, budget))
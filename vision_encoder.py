@@ -0,0 +1,235 @@
+"""
+Vision encoder runner for DeepseekOCRForCausalLM
+
+Wraps the SAM, CLIP and projector forward of a batch of same-size views so it
+can be torch.compile'd, int8-quantized and warmed up at startup. Depends only
+on torch, so it runs (and can be checked) on CPU without vLLM or a GPU.
+"""
+
+import threading
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import torch
+from torch import nn
+
+COMPILE_MODES = ('default', 'reduce-overhead', 'max-autotune')
+
+
+class EncoderStats:
+    """Shape and compile counters of the vision encoder, exported by the server's /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.compile_mode = None
+        self.shapes = set()
+        self.new_shapes_after_warmup = 0  # batch shapes warmup did not cover, each a compile on a request
+        self.views = 0
+        self.padded_views = 0
+        self.compile_failures = 0
+        self.last_failure = None
+
+    def record(self, shape: Tuple[int, ...], num_views: int, warm: bool):
+        with self._lock:
+            if shape not in self.shapes:
+                self.shapes.add(shape)
+                if warm:
+                    self.new_shapes_after_warmup += 1
+            self.views += num_views
+            self.padded_views += shape[0] - num_views
+
+    def record_failure(self, shape: Tuple[int, ...], error: Exception):
+        with self._lock:
+            self.compile_failures += 1
+            self.last_failure = f"{shape}: {type(error).__name__}: {error}"
+
+    def info(self) -> dict:
+        with self._lock:
+            return {"compile_mode": self.compile_mode, "compiled_shapes": len(self.shapes),
+                    "new_shapes_after_warmup": self.new_shapes_after_warmup,
+                    "views": self.views, "padded_views": self.padded_views,
+                    "compile_failures": self.compile_failures, "last_compile_failure": self.last_failure}
+
+
+VISION_ENCODER_STATS = EncoderStats()
+
+
+class Int8Linear(nn.Module):
+    """nn.Linear with int8 weights and dynamically quantized int8 activations.
+
+    Weights are quantized once per output channel; activations per row on every
+    call. On CUDA the product runs as an int8 GEMM (torch._int_mm) when the
+    shapes allow it, elsewhere as a float matmul of the same int8 values.
+    """
+
+    def __init__(self, weight_int8: torch.Tensor, weight_scale: torch.Tensor, bias: Optional[torch.Tensor]):
+        super().__init__()
+        self.out_features, self.in_features = weight_int8.shape
+        self.register_buffer('weight_int8', weight_int8)
+        self.register_buffer('weight_scale', weight_scale)
+        self.register_buffer('bias', bias)
+
+    @classmethod
+    def from_linear(cls, linear: nn.Linear) -> 'Int8Linear':
+        weight = linear.weight.detach().float()
+        weight_scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        weight_int8 = torch.round(weight / weight_scale[:, None]).clamp(-127, 127).to(torch.int8)
+        bias = None if linear.bias is None else linear.bias.detach().clone()
+        return cls(weight_int8, weight_scale, bias)
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        rows = x.reshape(-1, self.in_features).float()
+        x_scale = rows.abs().amax(dim=1, keepdim=True).clamp(min=1e-8) / 127
+        x_int8 = torch.round(rows / x_scale).clamp(-127, 127).to(torch.int8)
+
+        if (x_int8.is_cuda and x_int8.shape[0] > 16
+                and self.in_features % 8 == 0 and self.out_features % 8 == 0):
+            acc = torch._int_mm(x_int8, self.weight_int8.t()).float()
+        else:
+            acc = x_int8.float() @ self.weight_int8.float().t()
+
+        out = acc * x_scale * self.weight_scale
+        if self.bias is not None:
+            out = out + self.bias.float()
+        return out.to(x.dtype).reshape(*x.shape[:-1], self.out_features)
+
+
+def quantize_int8(module: nn.Module) -> int:
+    """Replace every nn.Linear inside module with an Int8Linear, in place. Returns how many were replaced."""
+    replaced = 0
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int8Linear.from_linear(child))
+            replaced += 1
+        else:
+            replaced += quantize_int8(child)
+    return replaced
+
+
+class VisionEncoder:
+    """SAM + CLIP + projector features of a stack of same-size views.
+
+    Holds plain references to the model's modules (it is not an nn.Module, so
+    parameter names and weight loading are unaffected) and runs them eagerly or
+    through torch.compile. Views are encoded in micro-batches of at most
+    batch_pixels input pixels. When compiled, each micro-batch is zero-padded up
+    to one of the bucket sizes and the padded rows are dropped after the
+    projector, so the compiled graph only ever sees a fixed set of shapes. A
+    compiled forward that fails (e.g. on a view size warmup did not cover) is
+    recorded in the stats and the encoder switches to eager for good.
+    """
+
+    def __init__(self, sam_model, vision_model, projector, batch_pixels: int = 16 * 1024 * 1024,
+                 buckets: Iterable[int] = (1, 2, 4, 8, 16, 32), stats: EncoderStats = VISION_ENCODER_STATS):
+        self.sam_model = sam_model
+        self.vision_model = vision_model
+        self.projector = projector
+        self.batch_pixels = batch_pixels
+        self.buckets = tuple(sorted(set(buckets)))
+        self.stats = stats
+        self.compile_mode = None
+        self.warm = False
+        self._forward = self.eager_forward
+
+    def eager_forward(self, views: torch.Tensor) -> torch.Tensor:
+        features_1 = self.sam_model(views)
+        features_2 = self.vision_model(views, features_1)
+        features = torch.cat((features_2[:, 1:], features_1.flatten(2).permute(0, 2, 1)), dim=-1)
+        return self.projector(features)
+
+    def max_batch(self, height: int, width: int) -> int:
+        return max(1, self.batch_pixels // (height * width))
+
+    def batch_sizes(self, height: int, width: int) -> List[int]:
+        """Bucket sizes used for views of this size: the buckets below the micro-batch cap, plus the cap"""
+        max_batch = self.max_batch(height, width)
+        return [size for size in self.buckets if size < max_batch] + [max_batch]
+
+    def __call__(self, views: torch.Tensor) -> torch.Tensor:
+        if self.compile_mode is None:
+            return self.eager_forward(views)
+
+        num_views = views.shape[0]
+        padded_size = next(size for size in self.batch_sizes(views.shape[-2], views.shape[-1]) if size >= num_views)
+        padded = views
+        if padded_size > num_views:
+            padded = torch.cat([views, views.new_zeros((padded_size - num_views,) + tuple(views.shape[1:]))])
+        self.stats.record(tuple(padded.shape), num_views, self.warm)
+
+        try:
+            if self.compile_mode == 'reduce-overhead':
+                # CUDA graph outputs are overwritten by the next replay, and the step keeps several batches alive
+                torch.compiler.cudagraph_mark_step_begin()
+                return self._forward(padded)[:num_views].clone()
+            # views are encoded independently, so dropping the padded rows leaves the real ones unchanged
+            return self._forward(padded)[:num_views]
+        except torch.cuda.OutOfMemoryError:
+            raise
+        except Exception as e:
+            # a compile failure at request time must not fail the engine step: finish it (and all later ones) eagerly
+            print(f"compiled vision encoder failed on {tuple(padded.shape)}, falling back to eager: {e}")
+            self.stats.record_failure(tuple(padded.shape), e)
+            self.use_eager()
+            return self.eager_forward(views)
+
+    def encode(self, views: torch.Tensor, preprocess: Optional[Callable] = None) -> torch.Tensor:
+        """Features of all views, in micro-batches; preprocess (e.g. normalization) is applied per micro-batch"""
+        step = self.max_batch(views.shape[-2], views.shape[-1])
+        features = []
+        for start in range(0, views.shape[0], step):
+            chunk = views[start:start + step]
+            features.append(self(preprocess(chunk) if preprocess is not None else chunk))
+        return features[0] if len(features) == 1 else torch.cat(features)
+
+    def compile(self, mode: Optional[str]):
+        """Route forwards through torch.compile(mode); None keeps eager. Compilation happens on first call."""
+        if not mode:
+            return
+        if mode not in COMPILE_MODES:
+            raise ValueError(f"unknown compile mode {mode!r}, expected one of {COMPILE_MODES} or None")
+        try:
+            # one static graph per bucket shape instead of a dynamic-shape graph
+            self._forward = torch.compile(self.eager_forward, mode=mode, dynamic=False)
+            self.compile_mode = mode
+            self.stats.compile_mode = mode
+        except Exception as e:
+            print(f"torch.compile unavailable, vision encoder stays eager: {e}")
+            self.use_eager()
+
+    def quantize_int8(self) -> int:
+        """Quantize the linear layers of SAM, CLIP and the projector; call after weights are loaded"""
+        replaced = sum(quantize_int8(module) for module in (self.sam_model, self.vision_model, self.projector))
+        print(f"vision encoder: {replaced} linear layers quantized to int8")
+        return replaced
+
+    def use_eager(self):
+        self._forward = self.eager_forward
+        self.compile_mode = None
+        self.stats.compile_mode = None
+
+    def warmup_shapes(self, view_sizes: Iterable[Tuple[int, int]]) -> List[Tuple[int, ...]]:
+        """Every padded batch shape the compiled forward can see for these (height, width) view sizes"""
+        return [(batch, 3, height, width) for height, width in view_sizes for batch in self.batch_sizes(height, width)]
+
+    def warmup(self, shapes: Iterable[Tuple[int, ...]], device=None, dtype=torch.bfloat16) -> bool:
+        """Run each input shape once so compilation happens at startup rather than on a request.
+
+        Stops at the first shape whose compiled forward fails, as __call__ has then
+        switched to eager. Returns whether the encoder is still compiled.
+        """
+        if self.compile_mode is None:
+            return False
+        shapes = list(shapes)
+        if hasattr(torch, '_dynamo'):
+            # keep every bucket shape cached instead of falling back to eager past the default limit
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 2 * len(shapes))
+        start = time.perf_counter()
+        with torch.no_grad():
+            for shape in shapes:
+                self(torch.zeros(shape, device=device, dtype=dtype))
+                if self.compile_mode is None:
+                    return False
+        self.warm = True
+        print(f"vision encoder compiled ({self.compile_mode}) for {len(shapes)} shapes "
+              f"and warmed up in {time.perf_counter() - start:.1f}s")
+        return True